@@ -203,6 +203,7 @@ void bitbang_backdoor()
      * Fill words   96 word(address) word(pattern) word(wordcount)  -> word(pattern ^ (4+last_address))
      * Exit         87                                              -> 55
      * Fill bytes   78 word(address) byte(pattern) word(bytecount)  -> word(pattern ^ (1+last_address))
+     * Write block  69 word(address) word(wordcount) word(data) * wordcount -> word(last_data ^ (4+last_address))
      * Signature    (other)                                               -> (text line)
      */
 
@@ -289,6 +290,17 @@ void bitbang_backdoor()
                 }
                 break;
 
+            case 0x69:      // Write block
+                address = bitbang_read32();
+                aux = bitbang_read32();
+                while (aux) {
+                    data = bitbang_read32();
+                    *(uint32_t*)address = data;
+                    address += 4;
+                    aux--;
+                }
+                break;
+
             default:
             bitbang_read32();
                 bitbang("~MeS`14 [bitbang]\r\n");
@@ -174,6 +174,15 @@ class BitbangDevice:
         self._check(check, last_word, address + 4 * wordcount)
         return data[:-4]
 
+    @_auto_retry
+    @_maintain_sync
+    def write_block(self, address, data):
+        wordcount = len(data) // 4
+        self._write(struct.pack('<BII', 0x69, address, wordcount) + data[:4 * wordcount])
+        last_word = struct.unpack('<I', data[4 * wordcount - 4 : 4 * wordcount])[0]
+        check = struct.unpack('<I', self.port.read(4))[0]
+        self._check(check, last_word, address + 4 * wordcount)
+
     @_auto_retry
     @_maintain_sync
     def fill_words(self, address, word, wordcount):
@@ -7,7 +7,7 @@ import sys, struct, time
 __all__ = [
     'words_from_string',
     'poke_words', 'poke_words_from_string', 'poke_bytes',
-    'read_block', 'scsi_read_buffer',
+    'read_block', 'write_block', 'scsi_read_buffer',
     'hexdump', 'hexdump_words',
     'dump', 'dump_words',
     'search_block'
@@ -74,6 +74,21 @@ def poke_words(d, address, words, verbose = True, reporting_interval = 0.1):
     progress.complete(l, l)
 
 
+def write_block(d, address, data, max_words = 0x100):
+    """Write a word-aligned string of whole words.
+
+    Uses the device's write_block() command if it has one, in pieces of up
+    to 'max_words', and falls back on one poke per word if it doesn't.
+    """
+    assert not (address & 3) and not (len(data) & 3)
+    if not hasattr(d, 'write_block'):
+        for i, w in enumerate(words_from_string(data)):
+            d.poke(address + 4*i, w)
+        return
+    for i in range(0, len(data), 4 * max_words):
+        d.write_block(address + i, data[i:i + 4 * max_words])
+
+
 def poke_bytes(d, address, bytes, verbose = True, reporting_interval = 0.1):
     """Send a block of bytes (VERY slowly)"""
     progress = progress_reporter('bytes sent',
@@ -0,0 +1,191 @@
+# A stand-in for the remote device, backed by a firmware image file.
+#
+# Compatible with the remote.Device and BitbangDevice interfaces, so the
+# simulator and most of the shell helpers can run with no hardware attached.
+# Flash comes from an mmap of the firmware image, everything else is sparse
+# RAM that reads as zero until written.
+#
+# There's no ARM to run blx() on, so calls go to a Python handler if one is
+# registered for the address, or else into a SimARM running on this device.
+
+__all__ = [ 'ImageDevice' ]
+
+import struct, mmap
+from sim_arm_core import SimARM, SimARMMemory
+from target_memory import sim_blx_stack
+
+
+class ImageDevice:
+    """Device implemented with a firmware image and local memory.
+
+    'filename' is the flash image, normally bin/SE-506CB_TS01.bin. With no
+    filename, flash starts out erased and can be filled in with write_flash().
+    The image file is never modified.
+
+    Python handlers for blx() go in the 'handlers' dict, keyed by address.
+    They're called as fn(device, r0) and return r0 or an (r0, r1) tuple.
+    """
+
+    flash_size = 0x200000
+    page_size = 0x1000
+
+    # Most instructions blx() will simulate before giving up, like a timeout
+    blx_step_limit = 10000000
+
+    # Where the simulated call returns to. bx to our initial lr lands here.
+    blx_return = 0xfffffffe
+
+    def __init__(self, filename = None, peripherals = None):
+        self.filename = filename
+        if filename:
+            with open(filename, 'rb') as f:
+                self.flash = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        else:
+            self.flash = bytearray('\xff' * self.flash_size)
+        self.flash_image_size = min(len(self.flash), self.flash_size)
+
+        self.pages = {}
+        self.handlers = {}
+        self.peripherals = peripherals
+        self.sim = None
+
+    def __repr__(self):
+        return '<ImageDevice %s, %d KiB RAM>' % (
+            self.filename or 'blank', len(self.pages) * self.page_size // 1024)
+
+    def write_flash(self, address, data):
+        """Change the local copy of the flash image. Pokes to flash are ignored."""
+        if address + len(data) > self.flash_image_size:
+            raise IndexError("Flash write at %08x runs past the image" % address)
+        self.flash[address:address + len(data)] = data
+
+    def read(self, address, size):
+        """Read a string of bytes from anywhere in the address space"""
+        parts = []
+        while size > 0:
+            if address < self.flash_size:
+                chunk = min(size, self.flash_size - address)
+                if address < self.flash_image_size:
+                    chunk = min(chunk, self.flash_image_size - address)
+                    parts.append(str(self.flash[address:address + chunk]))
+                else:
+                    parts.append('\xff' * chunk)
+            else:
+                offset = address & (self.page_size - 1)
+                chunk = min(size, self.page_size - offset)
+                page = self.pages.get(address // self.page_size)
+                if page is None:
+                    parts.append('\0' * chunk)
+                else:
+                    parts.append(str(page[offset:offset + chunk]))
+            address += chunk
+            size -= chunk
+        return ''.join(parts)
+
+    def write(self, address, data):
+        """Write a string of bytes. Writes to flash are dropped, like on hardware."""
+        while data:
+            if address < self.flash_size:
+                chunk = min(len(data), self.flash_size - address)
+            else:
+                offset = address & (self.page_size - 1)
+                chunk = min(len(data), self.page_size - offset)
+                pnum = address // self.page_size
+                page = self.pages.get(pnum)
+                if page is None:
+                    page = self.pages[pnum] = bytearray(self.page_size)
+                page[offset:offset + chunk] = data[:chunk]
+            address += chunk
+            data = data[chunk:]
+
+    def _peripheral(self, address):
+        if self.peripherals is not None:
+            return self.peripherals.find(address)
+
+    def peek(self, address):
+        p = self._peripheral(address)
+        if p:
+            return p.load(address, 4)
+        return struct.unpack('<I', self.read(address, 4))[0]
+
+    def poke(self, address, data):
+        p = self._peripheral(address)
+        if p:
+            return p.store(address, data, 4)
+        self.write(address, struct.pack('<I', data & 0xffffffff))
+
+    def peek_byte(self, address):
+        p = self._peripheral(address)
+        if p:
+            return p.load(address, 1)
+        return ord(self.read(address, 1))
+
+    def poke_byte(self, address, data):
+        p = self._peripheral(address)
+        if p:
+            return p.store(address, data, 1)
+        self.write(address, chr(data & 0xff))
+
+    def read_block(self, address, wordcount):
+        wordcount = min(wordcount, 0x100)
+        return self.read(address, 4 * wordcount)
+
+    def write_block(self, address, data):
+        if self.peripherals is not None and self.peripherals.overlaps(address, len(data) & ~3):
+            for i in range(0, len(data) & ~3, 4):
+                self.poke(address + i, struct.unpack_from('<I', data, i)[0])
+        else:
+            self.write(address, data[:len(data) & ~3])
+
+    def fill_words(self, address, word, wordcount):
+        if self.peripherals is not None and self.peripherals.overlaps(address, 4 * wordcount):
+            for i in range(wordcount):
+                self.poke(address + 4 * i, word)
+        else:
+            self.write(address, struct.pack('<I', word & 0xffffffff) * wordcount)
+
+    def fill_bytes(self, address, byte, bytecount):
+        if self.peripherals is not None and self.peripherals.overlaps(address, bytecount):
+            for i in range(bytecount):
+                self.poke_byte(address + i, byte)
+        else:
+            self.write(address, chr(byte & 0xff) * bytecount)
+
+    def blx(self, address, r0 = 0, timeout = 30):
+        handler = self.handlers.get(address)
+        if handler:
+            result = handler(self, r0)
+            if isinstance(result, tuple):
+                return result
+            return (result, 0)
+        return self.simulate_call(address, r0)
+
+    def simulate_call(self, address, r0 = 0):
+        """Run a function in the simulator until it returns, as blx() would.
+        The simulator is created on first use and keeps its caches between calls.
+        Returns (r0, r1).
+        """
+        if self.sim is None:
+            self.sim = SimARM(SimARMMemory(self))
+        arm = self.sim
+        arm.reset(address)
+        arm.regs[0] = r0
+        arm.regs[13] = sim_blx_stack
+
+        remaining = self.blx_step_limit
+        try:
+            while arm.regs[15] != self.blx_return:
+                if remaining <= 0:
+                    raise IOError("Simulated call to %08x didn't return" % address)
+                start = arm.step_count
+                arm.step(min(remaining, 10000), breakpoint = self.blx_return)
+                remaining -= arm.step_count - start
+        finally:
+            # Stores still in the write buffer belong in our RAM now
+            arm.memory.flush()
+
+        return (arm.regs[0], arm.regs[1])
+
+    def exit(self):
+        if isinstance(self.flash, mmap.mmap):
+            self.flash.close()
@@ -0,0 +1,133 @@
+# Record and replay sessions with a device.
+#
+# RecordingDevice wraps any device object (remote.Device, BitbangDevice,
+# BackdoorDevice, ImageDevice...) and writes every method call and its result
+# to a journal file. ReplayDevice reads that journal back, and answers the
+# same calls in the same order without any hardware. A %sim boot trace or a
+# memsquare run captured once on the real drive can then be replayed as often
+# as we like, for debugging or for benchmarking the code above the device.
+#
+# The journal is a header, then a stream of marshal'ed records:
+#
+#   header   { 'methods': [names...], 'device': repr }
+#   call     (method index, args, kwargs, ok, result, microseconds)
+#
+# 'ok' is False when the call raised; the result is then the exception's
+# message, and replay raises IOError with it. Replay is strict: any call that
+# doesn't match the next record in the journal raises IOError, since after
+# that point the results we have no longer mean anything.
+#
+# Each record is flushed as soon as it's written, so a session that crashes
+# or hangs the drive still leaves a journal of everything up to that point.
+
+__all__ = [ 'RecordingDevice', 'ReplayDevice' ]
+
+import marshal, time
+
+journal_magic = 'coastermelt device journal v1\n'
+
+
+class RecordingDevice:
+    """Device proxy that journals every method call to 'filename'"""
+
+    def __init__(self, device, filename):
+        self.device = device
+        self.filename = filename
+        self.calls = 0
+        self.methods = [ name for name in dir(device)
+                         if not name.startswith('_') and callable(getattr(device, name)) ]
+        self.method_index = dict((name, i) for i, name in enumerate(self.methods))
+        self.file = open(filename, 'wb')
+        self.file.write(journal_magic)
+        marshal.dump({ 'methods': self.methods, 'device': repr(device) }, self.file)
+
+    def __repr__(self):
+        return '<RecordingDevice %s, %d calls, %r>' % (self.filename, self.calls, self.device)
+
+    def __getattr__(self, name):
+        attr = getattr(self.device, name)
+        index = self.method_index.get(name)
+        if index is None:
+            return attr
+
+        def fn(*args, **kw):
+            kwargs = tuple(sorted(kw.items()))
+            timestamp = time.time()
+            try:
+                result = attr(*args, **kw)
+            except Exception, e:
+                self._record(index, args, kwargs, False, str(e), timestamp)
+                raise
+            self._record(index, args, kwargs, True, result, timestamp)
+            return result
+        return fn
+
+    def _record(self, index, args, kwargs, ok, result, timestamp):
+        elapsed = int((time.time() - timestamp) * 1e6)
+        marshal.dump((index, args, kwargs, ok, result, elapsed), self.file)
+        self.file.flush()
+        self.calls += 1
+
+    def finish_recording(self):
+        """Close the journal, and return the device we were wrapping"""
+        self.file.close()
+        return self.device
+
+
+class ReplayDevice:
+    """Device that answers calls from a journal written by RecordingDevice.
+
+    With 'latency', each call also sleeps for its recorded duration times
+    this scale factor, to approximate the timing of the original device.
+    """
+
+    def __init__(self, filename, latency = 0):
+        self.filename = filename
+        self.latency = latency
+        with open(filename, 'rb') as f:
+            if f.read(len(journal_magic)) != journal_magic:
+                raise IOError("%s is not a device journal" % filename)
+            header = marshal.load(f)
+            self.records = []
+            while True:
+                try:
+                    self.records.append(marshal.load(f))
+                except EOFError:
+                    break
+        self.methods = header['methods']
+        self.device_repr = header['device']
+        self.rewind()
+
+    def __repr__(self):
+        return '<ReplayDevice %s, call %d of %d, from %s>' % (
+            self.filename, self.position, len(self.records), self.device_repr)
+
+    def rewind(self):
+        """Start replaying again from the beginning of the journal"""
+        self.position = 0
+
+    @property
+    def remaining(self):
+        return len(self.records) - self.position
+
+    def __getattr__(self, name):
+        if name.startswith('_') or name not in self.methods:
+            raise AttributeError(name)
+
+        def fn(*args, **kw):
+            return self._replay(name, args, tuple(sorted(kw.items())))
+        return fn
+
+    def _replay(self, name, args, kwargs):
+        if self.position >= len(self.records):
+            raise IOError("Replay ran past the end of %s with %s%r" % (self.filename, name, args))
+        index, r_args, r_kwargs, ok, result, elapsed = self.records[self.position]
+        if self.methods[index] != name or r_args != args or r_kwargs != kwargs:
+            raise IOError("Replay diverged at call %d: expected %s%r, got %s%r" % (
+                self.position, self.methods[index], r_args, name, args))
+        self.position += 1
+        if self.latency:
+            time.sleep(elapsed * 1e-6 * self.latency)
+        if not ok:
+            raise IOError(result)
+        return result
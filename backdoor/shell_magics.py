@@ -26,11 +26,20 @@ from bitfuzz import *
 from bitbang import *
 from sim_arm import *
 from cpu8051 import *
+from journal import *
+from sim_arm_profile import *
+from sim_arm_trace import *
+from sim_arm_timetravel import *
+from sim_arm_watch import *
+from sim_arm_breakpoints import *
 
 
 @magic.magics_class
 class ShellMagics(magic.Magics):
 
+    # Most steps %sim takes in one step() call when it's running in bulk
+    sim_chunk = 10000
+
     def __init__(self, shell, *kw):
         magic.Magics.__init__(self, shell, *kw)
 
@@ -735,14 +744,71 @@ class ShellMagics(magic.Magics):
         if args.cpu8051:
             self.shell.user_ns['d8'] = cpu8051_backdoor(d)
 
+    @magic.line_magic
+    @magic_arguments()
+    @argument('filename', type=str, nargs='?', help='Journal file to write')
+    @argument('-s', '--stop', action='store_true', help='Stop recording, and go back to the original device')
+    def record(self, line):
+        """Record every call to the current device in a journal file
+
+        The debug device 'd' is wrapped in a RecordingDevice, which saves each
+        call along with its result. Stop with %record -s, and play the journal
+        back later without any hardware using %replay.
+        """
+        args = parse_argstring(self.record, line)
+        d = self.shell.user_ns['d']
+
+        if args.stop:
+            if not isinstance(d, RecordingDevice):
+                raise UsageError("Not recording")
+            self.shell.write('* Recorded %d calls to %s\n' % (d.calls, d.filename))
+            self.shell.user_ns['d'] = d.finish_recording()
+
+        else:
+            if not args.filename:
+                raise UsageError("Need a journal filename")
+            if isinstance(d, RecordingDevice):
+                raise UsageError("Already recording to %s" % d.filename)
+            self.shell.user_ns['d'] = RecordingDevice(d, args.filename)
+
+        d = self.shell.user_ns['d']
+        self.shell.write('* Debug interface switched to %r\n' % d)
+
+    @magic.line_magic
+    @magic_arguments()
+    @argument('filename', type=str, help='Journal file written by %%record')
+    @argument('-l', '--latency', type=float, default=0, help='Sleep for the recorded duration of each call, times this scale factor')
+    def replay(self, line):
+        """Replay a device journal written by %record
+
+        The debug device 'd' becomes a ReplayDevice, which answers the same
+        calls in the same order they were recorded. Anything else is an error.
+        """
+        args = parse_argstring(self.replay, line)
+        d = ReplayDevice(args.filename, latency=args.latency)
+        self.shell.user_ns['d'] = d
+        self.shell.write('* Debug interface switched to %r\n' % d)
+
     @magic.line_magic
     @magic_arguments()
     @argument('-l', '--log', type=argparse.FileType('a'), default='trace.log', metavar='FILE', help='Append logs to a file')
     @argument('-r', '--reset', type=hexint, help='Reset the processor, sending it to the indicated vector')
     @argument('-c', '--continuous', action='store_true', help='Keep taking steps until interrupted')
     @argument('-b', '--breakpoint', type=hexint, help='Run until the program counter matches')
+    @argument('-B', '--break-if', action='append', default=[], metavar='EXPR', help='Add a conditional breakpoint, like "pc==0x18cc8 and r0>3", and run until it holds')
+    @argument('--unbreak', action='store_true', help='Remove all conditional breakpoints')
+    @argument('-w', '--watch', action='append', default=[], metavar='[rwc:]ADDR[-END]', help='Stop on memory reads (r), writes (w, default), or changes (c) to a hex address range')
+    @argument('--unwatch', action='store_true', help='Remove all watchpoints')
     @argument('-S', '--save', type=str, metavar='FILE', help='Save local simulation state to files')
+    @argument('-D', '--delta', type=str, metavar='PARENT', help='With -S, only save memory that changed since the PARENT snapshot')
     @argument('-L', '--load', type=str, metavar='FILE', help='Load local simulation state from files')
+    @argument('-k', '--checkpoint', type=int, metavar='N', help='Enable time travel, with a checkpoint every N steps')
+    @argument('-R', '--reverse', action='store_true', help='Step backwards, or with -b run backwards to the breakpoint. Needs -k')
+    @argument('-g', '--goto', type=int, metavar='STEP', help='Jump forwards or backwards to a step count. Needs -k')
+    @argument('-T', '--trace', type=str, metavar='FILE', help='Write a binary trace instead of text logs, from now on. See sim_arm_trace.py')
+    @argument('-P', '--profile', type=str, metavar='FILE', help='Profile simulated code, saving FILE.pstats and FILE.folded after each run')
+    @argument('--unprofile', action='store_true', help='Stop profiling')
+    @argument('-C', '--coverage', type=str, metavar='FILE', help='Save flash code coverage so far as FILE.cov, FILE.txt and FILE.png after each run')
     @argument('steps', nargs='?', type=int, help='Number of steps to take (decimal int)')
     def sim(self, line):
         """Take a step in a simulated ARM processor.
@@ -750,6 +816,10 @@ class ShellMagics(magic.Magics):
         The first time you call %sim, it creates a simulation state object as
         'arm' in the shell. Afterwards, %sim by default takes a single step,
         and bridges simulated registers to and from shell variables.
+
+        With -c, -b, -B or -w, steps are taken in bulk until something stops
+        them, and the log gets one line per chunk of steps instead of one per
+        step. A binary trace (-T) still records every step.
         """
         args = parse_argstring(self.sim, line)
         ns = self.shell.user_ns
@@ -758,7 +828,7 @@ class ShellMagics(magic.Magics):
         steps = args.steps
         state = 'idle'
         logfile = args.log
-        if args.continuous or args.breakpoint:
+        if args.continuous or args.breakpoint or args.break_if:
             steps = 1e100
         pc_break = (args.breakpoint or -1) & 0xfffffffe
 
@@ -791,21 +861,87 @@ class ShellMagics(magic.Magics):
             arm.reset(args.reset)
 
         if args.save:
-            arm.save_state(args.save)
+            arm.save_state(args.save, args.delta)
+            steps = 0
+
+        if args.unprofile:
+            arm.profiler = None
+        if args.profile and not arm.profiler:
+            arm.profiler = SimProfiler()
+
+        if args.unbreak:
+            arm.remove_breakpoint()
+        for condition in args.break_if:
+            try:
+                bp = arm.add_breakpoint(condition)
+            except ValueError as e:
+                raise UsageError(str(e))
+            self.shell.write('- added %r\n' % bp)
+
+        if args.unwatch:
+            arm.memory.unwatch()
+        for spec in args.watch:
+            try:
+                wp = arm.memory.watch(parse_watch_spec(spec, hexint))
+            except ValueError as e:
+                raise UsageError(str(e))
+            self.shell.write('- watching %r\n' % wp)
+
+        timetravel = getattr(arm, 'timetravel', None)
+        if args.checkpoint and not timetravel:
+            timetravel = arm.timetravel = TimeTravel(arm, args.checkpoint)
+        if (args.reverse or args.goto is not None) and not timetravel:
+            raise UsageError("Time travel isn't on. Start it with -k")
+
+        if args.goto is not None:
+            state = 'GOTO'
+            timetravel.goto(args.goto)
+            steps = 0
+        elif args.reverse:
+            state = 'REV'
+            if args.breakpoint:
+                if not timetravel.reverse_continue(pc_break):
+                    self.shell.write('- breakpoint not found in history\n')
+            else:
+                timetravel.reverse_step(args.steps or 1)
             steps = 0
+        if state in ('GOTO', 'REV'):
+            arm.copy_registers_to(ns)
+
+        trace = arm.memory.trace
+        if args.trace and not (trace and trace.filename == args.trace):
+            if trace:
+                trace.close()
+            trace = arm.memory.trace = TraceWriter(args.trace)
 
         min_timestamp = 0
+        bulk = (args.continuous or args.breakpoint or args.break_if or args.watch) and not trace
 
         # Capture 'print' output from hook functions
         saved_stdout = sys.stdout
-        sys.stdout = Tee(self.shell, logfile)
+        sys.stdout = Tee(self.shell, trace or logfile)
 
         try:
             while True:
-                if steps > 0:
-                    state = 'step'
-                    arm.step()
-                    steps -= 1
+                if steps > 0 and bulk:
+                    # Let step() watch for breakpoints and watchpoints
+                    state = 'run'
+                    before = arm.step_count
+                    (timetravel or arm).step(int(min(steps, self.sim_chunk)), pc_break)
+                    steps -= max(1, arm.step_count - before)
+                    arm.copy_registers_to(ns)
+
+                elif steps > 0:
+                    # Recognized loops run in bulk, everything else one step at a time.
+                    # The profiler has to see every step, so loops don't run in bulk then.
+                    taken = 0 if timetravel or arm.profiler else arm.run_idiom(min(steps, 1 << 32), pc_break)
+                    if taken:
+                        state = 'LOOP'
+                    else:
+                        state = 'step'
+                        (timetravel or arm).step()
+                        taken = 1
+                    steps -= taken
                     arm.copy_registers_to(ns)
 
                 # Throttled summary output to shell
@@ -815,19 +951,41 @@ class ShellMagics(magic.Magics):
                     min_timestamp = now + 0.25
 
                 # Write detailed output to log file
-                logfile.write('# %-70s %s\n' % (arm.summary_line(), arm.register_trace_line()))
+                if trace:
+                    trace.step(arm)
+                else:
+                    logfile.write('# %-70s %s\n' % (arm.summary_line(), arm.register_trace_line()))
                 assert logfile == arm.memory.logfile
 
                 if (arm.regs[15] & ~1) == pc_break:
                     self.shell.write('- breakpoint reached\n%s' % arm.register_trace())
                     break
 
-                if steps == 0:
+                if state in ('step', 'LOOP', 'run') and arm.breakpoint_hit:
+                    self.shell.write('- breakpoint %r\n%s' % (arm.breakpoint_hit, arm.register_trace()))
+                    break
+
+                if state in ('step', 'LOOP', 'run') and arm.memory.watch_hits:
+                    for hit in arm.memory.watch_hits:
+                        self.shell.write('- watchpoint %r\n' % hit)
+                    self.shell.write(arm.register_trace())
+                    break
+
+                if steps <= 0:
                     self.shell.write(arm.register_trace())
                     break
         finally:
             sys.stdout = saved_stdout
             logfile.flush()
+            if trace:
+                trace.flush()
+            if args.profile:
+                arm.profiler.dump_stats(args.profile + '.pstats')
+                arm.profiler.dump_folded(args.profile + '.folded')
+            if args.coverage:
+                arm.coverage.save(args.coverage + '.cov')
+                arm.coverage.write_ranges(args.coverage + '.txt')
+                arm.coverage.write_png(args.coverage + '.png')
 
 
 class Tee(object):
@@ -13,17 +13,40 @@
 
 __all__ = [ 'simulate_arm' ]
 
+import os, hashlib
 from code import *
 from sim_arm_core import *
+from sim_arm_cache import *
+from sim_arm_mmio import default_peripherals
+from sim_arm_events import Interrupt
 
 includes['sim_arm'] = '#include "sim_arm.h"'
 
 
-def simulate_arm(device):
+# Decoded instructions are kept here between sessions, next to this file
+default_decode_cache = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'sim_arm.icache')
+
+
+def simulate_arm(device, decode_cache = default_decode_cache, emulate_mmio = False,
+                 irq_interval = 100000, flash_image = None):
     """Create a new ARM simulator, backed by the provided remote device
     Returns a SimARM object with regs[], memory, and step().
+    Decoded instructions are kept in 'decode_cache' across sessions; pass None to disable.
+    With 'flash_image', the firmware file that's in the device's flash, cached code
+    is found without reading flash from the device first.
+    With 'emulate_mmio', the peripherals we have Python models for never touch hardware.
+    The timer IRQ fires every 'irq_interval' steps once we reach the main loop.
     """
     m = SimARMMemory(device)
+    if decode_cache:
+        image = None
+        if flash_image:
+            with open(flash_image, 'rb') as f:
+                image = hashlib.sha1(f.read()).hexdigest()
+        m.decode_cache = DecodeCache(decode_cache, image)
+    if emulate_mmio:
+        for p in default_peripherals():
+            m.peripherals.add(p)
 
     # These only exist during boot; after we hit the main loop, all skips are cleared.
     m.skip(0x04001000, "Reset control?")
@@ -44,21 +67,20 @@ def simulate_arm(device):
     m.patch(0x0007bc3c, 'nop; nop')
 
     # Stub out encrypted functions related to DRM. Hopefully we don't need to bother supporting them.
+    def fn(arm):
+        arm.memory.hle_log("Stubbed DRM functions at 0x11000")
     m.patch(0x11080, '''
         mov     r0, #0
         bx      lr
-    ''', thumb=False, hle='''
-        println("Stubbed DRM functions at 0x11000");
-    ''')
+    ''', thumb=False, hle=fn)
 
     # This routine overlays another function from flash with a chunk of RAM, presumably for speed.
     # It just makes things slower here; stub it out, and log that it's happening.
+    def fn(arm):
+        arm.memory.hle_log("overlay_flash_with_ram %08x (stub)" % arm.regs[0])
     m.patch(0xcfce8, '''
         bx      lr
-    ''', hle='''
-        console("overlay_flash_with_ram", r0);
-        println(" (stub)");
-    ''')
+    ''', hle=fn)
 
     # Low level read from 8051
     m.patch(0x4b6a8, '''
@@ -85,11 +107,11 @@ def simulate_arm(device):
     ''')
 
     # Don't bother copying 8051 firmware to DRAM (performance)
+    def fn(arm):
+        arm.memory.hle_log("Skipped copying 8051 firmware to DRAM")
     m.patch(0xd7608, '''
         pop     {r4,pc}
-    ''', hle='''
-        println("Skipped copying 8051 firmware to DRAM");
-    ''')
+    ''', hle=fn)
 
     # Install 8051 firmware directly from the TS01 image in flash memory
     # The original function here calculates a checksum along the way.
@@ -113,19 +135,18 @@ def simulate_arm(device):
     # Autostep through the firmware decompression code; it's very slow with tracing on.
     m.hook(0x168928, autostep_until(0x168d04, 'firmware decompression function'))
 
-    # Use some hook functions to multiplex the main loop and IRQ handlers, to
-    # make this easier to follow (and avoid implementing real interrupts
+    # Once we reach the main loop, the timer IRQ starts firing every
+    # 'irq_interval' steps. The ISR chain starts at 0x158 and continues
+    # with isr_1c at 0x22114; the interrupted state is saved and restored by
+    # SimARM.interrupt() and return_from_interrupt().
 
     def fn(arm):
         # Clear all our skips when we hit the main loop
         arm.memory.skip_stores.clear()
 
-        # First ISR, 0x18
-        print "SIM: isr_18"
-        arm.irq_saved = arm.state
-        arm.regs[15] = 0x158
-        arm.regs[13] = 0x20009d0
-        arm.thumb = False
+        if not [ e for e in arm.events.queue if e[2].name == 'isr_18' ]:
+            print "SIM: main loop, isr_18 every %d steps" % irq_interval
+            arm.events.every(irq_interval, Interrupt(0x158, sp=0x20009d0, name='isr_18'))
     m.hook(0x18cc8, fn)
 
     def fn(arm):
@@ -137,9 +158,9 @@ def simulate_arm(device):
     m.hook(0x190, fn)
 
     def fn(arm):
-        # Return to the main loop
-        print "SIM: main loop"
-        arm.state = arm.irq_saved
+        # Return to the main loop, if the ISR didn't already
+        if arm.return_from_interrupt():
+            print "SIM: main loop"
     m.hook(0x2203e, fn)
     m.hook(0x22138, fn)
 
@@ -148,14 +169,16 @@ def simulate_arm(device):
     # higher-level functions into an infinite loop if the timer advances too
     # quickly. The higher level functions use a routine at 8519c to read a
     # 16-bit timer at a selected frequency. To help simulation coverage, this
-    # returns an integer that advances by 1 every time it's read.
+    # returns an integer that follows virtual time from the event scheduler,
+    # and advances by at least 1 every time it's read.
 
     sim_clock = [0]
-    rates = ('512*1024 Hz', '16*1024 Hz', '1024 Hz')
+    rates = (512*1024, 16*1024, 1024)
     def fn(arm):
-        sim_clock[0] = (sim_clock[0] + 1) & 0xffff
-        print "SIM: Fake clock %04x (requested rate %s)" % (sim_clock[0], rates[arm.regs[0]])
-        arm.regs[0] = sim_clock[0]
+        rate = rates[arm.regs[0]]
+        sim_clock[0] = max(sim_clock[0] + 1, int(arm.events.time * rate))
+        print "SIM: Fake clock %04x (requested rate %d Hz)" % (sim_clock[0] & 0xffff, rate)
+        arm.regs[0] = sim_clock[0] & 0xffff
     m.patch(0x8519c, 'bx lr')
     m.hook(0x8519c, fn)
 
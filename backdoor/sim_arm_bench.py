@@ -0,0 +1,249 @@
+#!/usr/bin/env python
+#
+# Throughput benchmarks for the ARM simulator.
+#
+# Each workload is a small hand-assembled loop that runs out of flash on an
+# ImageDevice, so no hardware and no toolchain are needed. With a firmware
+# image, we also run the first part of the real firmware decompressor.
+#
+# Results are appended to a JSON file, one line per run, so we can see how
+# changes to sim_arm_core.py move the numbers over time:
+#
+#   ./sim_arm_bench.py
+#   ./sim_arm_bench.py --image bin/SE-506CB_TS01.bin -o bench.json
+#
+# For each workload we report instructions per second (cold, including
+# decoding, and warm), instruction cache miss rate, the average time to fill
+# a miss, and the cost of each opcode when single-stepped. Loop idioms are
+# off unless a workload asks for them, so we measure the instructions
+# themselves; thumb_memcpy_loop measures the bulk path separately.
+
+__all__ = [ 'Workload', 'workloads', 'decompress_workload', 'run_workload', 'run_benchmarks' ]
+
+import struct, json, time, sys, platform, subprocess, argparse
+from sim_arm_core import *
+from sim_arm_mmio import default_peripherals
+from sim_arm_program import DecodedProgram
+from image_device import ImageDevice
+from target_memory import sim_blx_stack
+
+
+def thumb_code(*halfwords):
+    return struct.pack('<%dH' % len(halfwords), *halfwords)
+
+def arm_code(*words):
+    return struct.pack('<%dI' % len(words), *words)
+
+literals = arm_code
+
+
+class Workload:
+    """A benchmark program, entered at 'entry' (with the Thumb bit) and run
+    for 'steps' instructions. If there's any 'code' it's loaded into flash
+    at the entry point first. The program should loop forever; we stop it
+    by counting. Registers in 'regs' are set up before each run.
+    With 'loops', recognized loops run in bulk as they normally would.
+    """
+    def __init__(self, name, entry, steps, code = None, regs = {}, loops = False):
+        self.name = name
+        self.entry = entry
+        self.steps = steps
+        self.code = code
+        self.regs = regs
+        self.loops = loops
+
+    def setup(self, device):
+        if self.code:
+            device.write_flash(self.entry & ~1, self.code)
+
+
+thumb_memcpy_code = thumb_code(
+    0x4803,         # 1100  ldr     r0, [pc, #12]   ; 1110
+    0x4904,         # 1102  ldr     r1, [pc, #16]   ; 1114
+    0x2240,         # 1104  movs    r2, #64
+    0xc878,         # 1106  ldmia   r0!, {r3, r4, r5, r6}
+    0xc178,         # 1108  stmia   r1!, {r3, r4, r5, r6}
+    0x3a01,         # 110a  subs    r2, #1
+    0xd1fb,         # 110c  bne.n   1106
+    0xe7f7,         # 110e  b.n     1100
+) + literals(0x1c00000, 0x1c01000) + thumb_code(0x46c0, 0x46c0)
+
+
+workloads = [
+
+    Workload('thumb_alu', 0x1001, 100000, code = thumb_code(
+        0x2000,         # 1000  movs    r0, #0
+        0x4905,         # 1002  ldr     r1, [pc, #20]   ; 1018
+        0x1840,         # 1004  adds    r0, r0, r1
+        0x0083,         # 1006  lsls    r3, r0, #2
+        0x404b,         # 1008  eors    r3, r1
+        0x434b,         # 100a  muls    r3, r1, r3
+        0x3901,         # 100c  subs    r1, #1
+        0xd1f9,         # 100e  bne.n   1004
+        0xe7f6,         # 1010  b.n     1000
+        0x46c0,         # 1012  nop
+        0x46c0,         # 1014  nop
+        0x46c0,         # 1016  nop
+    ) + literals(0x1000)),
+
+    Workload('thumb_memcpy', 0x1101, 100000, code = thumb_memcpy_code),
+    Workload('thumb_memcpy_loop', 0x1101, 100000, code = thumb_memcpy_code, loops = True),
+
+    Workload('thumb_branchy', 0x1201, 100000, code = thumb_code(
+        0x2000,         # 1200  movs    r0, #0
+        0x2400,         # 1202  movs    r4, #0
+        0x3001,         # 1204  adds    r0, #1
+        0x0841,         # 1206  lsrs    r1, r0, #1
+        0xd202,         # 1208  bcs.n   1210
+        0x0881,         # 120a  lsrs    r1, r0, #2
+        0xd302,         # 120c  bcc.n   1214
+        0x3403,         # 120e  adds    r4, #3
+        0x2cc8,         # 1210  cmp     r4, #200
+        0xd801,         # 1212  bhi.n   1218
+        0x3c01,         # 1214  subs    r4, #1
+        0xe7f5,         # 1216  b.n     1204
+        0x2400,         # 1218  movs    r4, #0
+        0xe7f3,         # 121a  b.n     1204
+        0x46c0,         # 121c  nop
+        0x46c0,         # 121e  nop
+    )),
+
+    Workload('arm_alu', 0x1300, 100000, code = arm_code(
+        0xe3a00000,     # 1300  mov     r0, #0
+        0xe3a01a01,     # 1304  mov     r1, #4096
+        0xe0800081,     # 1308  add     r0, r0, r1, lsl #1
+        0xe02021a0,     # 130c  eor     r2, r0, r0, lsr #3
+        0xe2511001,     # 1310  subs    r1, r1, #1
+        0x1afffffb,     # 1314  bne     1308
+        0xeafffff8,     # 1318  b       1300
+        0xe1a00000,     # 131c  nop
+        0xe1a00000,     # 1320  nop
+    )),
+]
+
+
+def decompress_workload(steps = 200000):
+    """The firmware's own decompressor, unpacking the image loaded at boot.
+    See doc/compressed-firmware-notes.txt. Needs the real firmware image.
+    """
+    return Workload('decompress', 0xd1da9, steps, regs = { 0: 0x18e000, 1: 0x1f77000 })
+
+
+def new_simulator(device, workload):
+    # A private DecodedProgram, so nothing decoded by an earlier run is shared
+    m = SimARMMemory(device, program=DecodedProgram())
+    m.local_ram(0x1c00000, 0x200ffff)
+    for p in default_peripherals():
+        m.peripherals.add(p)
+    arm = SimARM(m)
+    arm.recognize_loops = workload.loops
+    return arm
+
+
+def start(arm, workload):
+    arm.reset(workload.entry)
+    arm.regs[13] = sim_blx_stack
+    for r, value in workload.regs.items():
+        arm.regs[r] = value
+
+
+def run_workload(device, workload, repeat = 3, profile_steps = 20000):
+    """Benchmark one workload, returning a dictionary of results"""
+    workload.setup(device)
+    result = { 'steps': workload.steps }
+
+    # Cold runs start with an empty instruction cache. Best of 'repeat'.
+    cold = None
+    for i in range(repeat):
+        arm = new_simulator(device, workload)
+        start(arm, workload)
+        timestamp = time.time()
+        arm.step(workload.steps)
+        elapsed = time.time() - timestamp
+        if cold is None or elapsed < cold:
+            cold = elapsed
+    m = arm.memory
+    result['cold_ips'] = workload.steps / cold
+    result['icache_misses'] = m.icache_misses
+    result['icache_miss_rate'] = m.icache_misses / float(workload.steps)
+    result['fetch_latency_us'] = m.icache_miss_time / max(1, m.icache_misses) * 1e6
+
+    # Warm runs reuse the last simulator, with everything already translated
+    warm = None
+    for i in range(repeat):
+        start(arm, workload)
+        timestamp = time.time()
+        arm.step(workload.steps)
+        elapsed = time.time() - timestamp
+        if warm is None or elapsed < warm:
+            warm = elapsed
+    result['warm_ips'] = workload.steps / warm
+
+    # Single steps, to see what each opcode costs on its own
+    ops = {}
+    start(arm, workload)
+    for i in range(min(profile_steps, workload.steps)):
+        op = arm.get_next_instruction().op
+        timestamp = time.time()
+        arm.step()
+        elapsed = time.time() - timestamp
+        total = ops.setdefault(op, [0, 0.0])
+        total[0] += 1
+        total[1] += elapsed
+    result['op_cost_us'] = dict((op, t / n * 1e6) for op, (n, t) in ops.items())
+    result['op_counts'] = dict((op, n) for op, (n, t) in ops.items())
+
+    return result
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       stderr=subprocess.STDOUT).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_benchmarks(image = None, repeat = 3, names = None, verbose = True):
+    """Run every workload we can, returning results for the whole suite"""
+    suite = list(workloads)
+    if image:
+        suite.append(decompress_workload())
+    if names:
+        suite = [ w for w in suite if w.name in names ]
+
+    run = {
+        'timestamp': time.time(),
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'host': platform.node(),
+        'image': image,
+        'workloads': {},
+    }
+
+    for w in suite:
+        # A fresh device each time, so workloads can't see each other's RAM
+        result = run_workload(ImageDevice(image), w, repeat = repeat)
+        run['workloads'][w.name] = result
+        if verbose:
+            print '%-16s %9.0f ips cold %9.0f ips warm %6.2f%% miss %8.1f us/fetch' % (
+                w.name, result['cold_ips'], result['warm_ips'],
+                result['icache_miss_rate'] * 100, result['fetch_latency_us'])
+            for op, cost in sorted(result['op_cost_us'].items(), key=lambda i: -i[1]):
+                print '    %-10s %8.2f us  x%d' % (op, cost, result['op_counts'][op])
+
+    return run
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Benchmark the ARM simulator')
+    parser.add_argument('-o', '--output', default = 'sim_arm_bench.json', help = 'Append results to this file, one JSON object per line')
+    parser.add_argument('-i', '--image', help = 'Firmware image, enables the decompression workload')
+    parser.add_argument('-r', '--repeat', type = int, default = 3, help = 'Runs per measurement, we keep the best')
+    parser.add_argument('workload', nargs = '*', help = 'Only run these workloads')
+    args = parser.parse_args()
+
+    run = run_benchmarks(args.image, args.repeat, args.workload)
+    with open(args.output, 'a') as f:
+        f.write(json.dumps(run, sort_keys=True) + '\n')
+    print 'Appended results to %s' % args.output
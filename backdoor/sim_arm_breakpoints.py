@@ -0,0 +1,136 @@
+# Conditional breakpoints for the ARM simulator.
+#
+# A condition is a Python expression over the simulated CPU, like
+#
+#   pc == 0x18cc8 and r0 > 3
+#   pc in (0x1000, 0x1100) and word(sp + 4) == 0 and not Z
+#
+# Names can be registers (r0-r15, sp, lr, pc, and the APCS aliases), the
+# flags N Z C V, 'thumb', and 'step' for the step count. word(), half() and
+# byte() read simulated memory. The 'pc' is the address of the next
+# instruction, as with %sim -b.
+#
+# Every condition needs a top-level 'pc == ADDRESS' or 'pc in (...)' term.
+# That's how it gets filed in SimARM.breakpoints, keyed by PC, so step()
+# only ever evaluates a condition when the PC is already right. Expressions
+# are parsed and rewritten once, into a closure that reads the CPU directly.
+#
+# A breakpoint with an 'action' is a conditional hook instead: when the
+# condition holds, action(arm) runs, and we only stop if it returns True.
+
+__all__ = [ 'Breakpoint', 'compile_condition' ]
+
+import ast
+
+reg_names = ('r0', 'r1', 'r2', 'r3', 'r4', 'r5', 'r6', 'r7',
+             'r8', 'r9', 'r10', 'r11', 'r12', 'sp', 'lr', 'pc')
+alt_names = ('a1', 'a2', 'a3', 'a4', 'v1', 'v2', 'v3', 'v4',
+             'v5', 'sb', 'sl', 'fp', 'ip', 'r13', 'r14', 'r15')
+reg_numbers = dict([ (n, i) for i, n in enumerate(reg_names) ] +
+                   [ (n, i) for i, n in enumerate(alt_names) ])
+
+attr_names = { 'N': 'cpsrN', 'Z': 'cpsrZ', 'C': 'cpsrC', 'V': 'cpsrV',
+               'thumb': 'thumb', 'step': 'step_count' }
+
+memory_functions = { 'word': 'load', 'half': 'load_half', 'byte': 'load_byte' }
+
+allowed_nodes = (ast.Expression, ast.BoolOp, ast.BinOp, ast.UnaryOp, ast.Compare,
+                 ast.IfExp, ast.Call, ast.Name, ast.Num, ast.Tuple, ast.List, ast.Load,
+                 ast.boolop, ast.operator, ast.unaryop, ast.cmpop)
+
+
+def pc_terms(tree):
+    """Addresses named by a top-level 'pc == X' or 'pc in (X, Y)' term, or None"""
+    body = tree.body
+    terms = body.values if isinstance(body, ast.BoolOp) and isinstance(body.op, ast.And) else [body]
+    for t in terms:
+        if not (isinstance(t, ast.Compare) and len(t.ops) == 1):
+            continue
+        left, op, right = t.left, t.ops[0], t.comparators[0]
+        if isinstance(op, ast.Eq) and isinstance(right, ast.Name):
+            left, right = right, left
+        if not (isinstance(left, ast.Name) and reg_numbers.get(left.id) == 15):
+            continue
+        if isinstance(op, ast.Eq) and isinstance(right, ast.Num):
+            return [ right.n ]
+        if (isinstance(op, ast.In) and isinstance(right, (ast.Tuple, ast.List))
+                and all(isinstance(e, ast.Num) for e in right.elts)):
+            return [ e.n for e in right.elts ]
+
+
+class Rewriter(ast.NodeTransformer):
+    """Turn names into reads from the simulator 'A'"""
+
+    def visit_Name(self, node):
+        arm = ast.Name(id='A', ctx=ast.Load())
+        if node.id in reg_numbers:
+            regs = ast.Attribute(value=arm, attr='regs', ctx=ast.Load())
+            new = ast.Subscript(value=regs, slice=ast.Index(value=ast.Num(n=reg_numbers[node.id])), ctx=ast.Load())
+        elif node.id in attr_names:
+            new = ast.Attribute(value=arm, attr=attr_names[node.id], ctx=ast.Load())
+        else:
+            return node
+        return ast.copy_location(new, node)
+
+    def visit_Call(self, node):
+        self.generic_visit(node)
+        memory = ast.Attribute(value=ast.Name(id='A', ctx=ast.Load()), attr='memory', ctx=ast.Load())
+        node.func = ast.copy_location(ast.Attribute(
+            value=memory, attr=memory_functions[node.func.id], ctx=ast.Load()), node.func)
+        return node
+
+
+def compile_condition(arm, condition):
+    """Compile a condition for 'arm'. Returns (pcs, predicate).
+    Raises ValueError if it's not an expression we support.
+    """
+    try:
+        tree = ast.parse(condition.strip(), mode='eval')
+    except SyntaxError as e:
+        raise ValueError("Can't parse breakpoint condition %r: %s" % (condition, e))
+
+    for node in ast.walk(tree):
+        if not isinstance(node, allowed_nodes):
+            raise ValueError("Breakpoint conditions can't use %s" % type(node).__name__)
+        if isinstance(node, ast.Name) and not (
+                node.id in reg_numbers or node.id in attr_names or node.id in memory_functions):
+            raise ValueError("Unknown name %r in breakpoint condition" % node.id)
+        if isinstance(node, ast.Call) and not (
+                isinstance(node.func, ast.Name) and node.func.id in memory_functions
+                and len(node.args) == 1 and not (node.keywords or node.starargs or node.kwargs)):
+            raise ValueError("Only word(addr), half(addr), and byte(addr) can be called in breakpoint conditions")
+
+    pcs = pc_terms(tree)
+    if not pcs:
+        raise ValueError("Breakpoint condition needs a top-level 'pc == ADDRESS' or 'pc in (...)' term")
+
+    body = Rewriter().visit(tree).body
+    fn = ast.Expression(body=ast.Lambda(
+        args=ast.arguments(args=[], vararg=None, kwarg=None, defaults=[]), body=body))
+    ast.fix_missing_locations(fn)
+    predicate = eval(compile(fn, '<breakpoint %s>' % condition, 'eval'), { '__builtins__': {}, 'A': arm })
+    return [ pc & ~1 for pc in pcs ], predicate
+
+
+class Breakpoint(object):
+    """A compiled conditional breakpoint, or with an 'action', a conditional hook.
+    Add these with SimARM.add_breakpoint().
+    """
+    def __init__(self, arm, condition, action = None):
+        self.condition = condition
+        self.action = action
+        self.pcs, self.predicate = compile_condition(arm, condition)
+        self.hits = 0
+
+    def __repr__(self):
+        return '<Breakpoint %r%s, %d hits>' % (
+            self.condition, ' with action' if self.action else '', self.hits)
+
+    def check(self, arm):
+        """Returns True if the simulator should stop here"""
+        if not self.predicate():
+            return False
+        self.hits += 1
+        if self.action:
+            return bool(self.action(arm))
+        return True
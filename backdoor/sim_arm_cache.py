@@ -0,0 +1,116 @@
+# Persistent cache of decoded instructions for the ARM simulator.
+#
+# Each record holds the decoded form of one prefetched block of code, keyed by
+# (address, thumb, sha1 of the block's bytes). Since the key includes the
+# bytes themselves, a cache built from one firmware image is never wrong for
+# another; stale entries just stop being hit.
+#
+# The file is append-only: a short header, then records made of a fixed
+# struct header and a marshal payload. The index is rebuilt by skipping
+# through record headers on open, and payloads are only read when used.
+# Records written before instructions carried structured operands don't have
+# them; those instructions get their operands parsed from text when used.
+# A record truncated by a crash is discarded, along with anything after it.
+#
+# Hashing the bytes means reading them from the device first, which is most
+# of what a cold start costs. If we're told which image is in flash, blocks
+# are also stored under a key made from the image's name instead of their
+# bytes, and lookup_image() can find them without touching the device. That
+# key is only as good as the name: after reflashing, use a different one.
+
+__all__ = [ 'DecodeCache' ]
+
+import os, struct, marshal, hashlib
+from sim_arm_decode import decoded_instruction
+
+
+class DecodeCache(object):
+    """On-disk cache of decoded instruction blocks, shared between sessions."""
+
+    magic = 'SimARM decode cache v1\n'
+    record = struct.Struct('<IB20sI')
+
+    def __init__(self, filename, image = None):
+        self.filename = filename
+        self.index = {}
+        self.hits = 0
+        self.misses = 0
+
+        # 'image' names the flash contents, like the sha1 of the firmware file
+        self.image_key = image and hashlib.sha1('image ' + image).digest()
+
+        if os.path.exists(filename):
+            self.file = open(filename, 'r+b')
+            self._read_index()
+        else:
+            self.file = open(filename, 'w+b')
+            self.file.write(self.magic)
+
+    def _read_index(self):
+        f = self.file
+        if f.read(len(self.magic)) != self.magic:
+            # Not ours, or an older format. Start over.
+            f.seek(0)
+            f.truncate()
+            f.write(self.magic)
+            return
+
+        offset = len(self.magic)
+        size = os.fstat(f.fileno()).st_size
+        while offset + self.record.size <= size:
+            f.seek(offset)
+            address, thumb, digest, length = self.record.unpack(f.read(self.record.size))
+            payload = offset + self.record.size
+            if payload + length > size:
+                break
+            self.index[(address, thumb, digest)] = (payload, length)
+            offset = payload + length
+
+        f.seek(offset)
+        f.truncate()
+
+    def close(self):
+        self.file.close()
+
+    def __len__(self):
+        return len(self.index)
+
+    def lookup(self, address, thumb, data):
+        """Find decoded instructions for a block of code.
+        Returns a list of decoded_instruction objects, or None.
+        """
+        return self._read((address, thumb, hashlib.sha1(data).digest()))
+
+    def lookup_image(self, address, thumb):
+        """Find decoded flash code by address, in the image we were opened with.
+        Needs no flash data. Returns None without an image, or on a miss.
+        """
+        if self.image_key is not None:
+            return self._read((address, thumb, self.image_key))
+
+    def _read(self, key):
+        loc = self.index.get(key)
+        if loc is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.file.seek(loc[0])
+        return [ decoded_instruction(*t) for t in marshal.loads(self.file.read(loc[1])) ]
+
+    def store(self, address, thumb, data, lines):
+        """Save the decoded instructions for a block of code"""
+        payload = marshal.dumps([ (i.address, i.next_address - i.address, i.op, i.args, i.comment,
+                                   i.operands) for i in lines ])
+        self._append((address, thumb, hashlib.sha1(data).digest()), payload)
+        if self.image_key is not None and address < 0x200000:
+            self._append((address, thumb, self.image_key), payload)
+
+    def _append(self, key, payload):
+        if key in self.index:
+            return
+        f = self.file
+        f.seek(0, 2)
+        f.write(self.record.pack(key[0], key[1], key[2], len(payload)))
+        self.index[key] = (f.tell(), len(payload))
+        f.write(payload)
+        f.flush()
@@ -1,37 +1,59 @@
 # The jankiest simulator for our janky debugger.
 # This simulation core is more of an assembly language interpreter than a CPU emulator.
 
-__all__ = [ 'SimARM', 'SimARMMemory' ]
+__all__ = [ 'SimARM', 'SimARMMemory', 'CoreState' ]
 
-import cStringIO, struct, json, sys
+import struct, json, sys, os, re, time, copy
+from array import array
 from code import *
 from dump import *
 from console import *
-
-
-class RunEncoder(object):
-    """Find runs that write the same pattern to consecutive addresses.
-    Both 'write' and 'flush' return a (count, address, pattern, size) tuple,
-    where 'count' might be zero if no work needs to be done.
+from sim_arm_decode import *
+from sim_arm_mmio import *
+from sim_arm_snapshot import *
+from sim_arm_watch import *
+from sim_arm_breakpoints import *
+from sim_arm_idiom import *
+from sim_arm_idle import *
+from sim_arm_events import *
+from sim_arm_program import *
+from sim_arm_coverage import *
+
+
+store_formats = { 1: '<B', 2: '<H', 4: '<I' }
+
+
+class WriteCombiner(object):
+    """Collect stores to consecutive addresses into one contiguous run.
+    'write' adds a store as a string of bytes. If it doesn't extend or overlap
+    the current run, that run is returned as an (address, data) tuple for the
+    caller to send before we start a new one. 'flush' returns the run, or None.
+    Later stores to bytes that are already in the run replace them.
     """
     def __init__(self):
-        self.count = 0
-        self.key = (None, None, None)
-
-    def write(self, address, pattern, size):
-        if self.key == (address - self.count * size, pattern, size):
-            self.count += 1
-            return (0, None, None, None)
-        else:
-            r = self.flush()
-            self.key = (address, pattern, size)
-            self.count = 1
-            return r
+        self.address = None
+        self.data = bytearray()
+
+    def __len__(self):
+        return len(self.data)
+
+    def write(self, address, data):
+        if self.data:
+            offset = address - self.address
+            if 0 <= offset <= len(self.data):
+                self.data[offset:offset + len(data)] = data
+                return None
+        r = self.flush()
+        self.address = address
+        self.data = bytearray(data)
+        return r
 
     def flush(self):
-        r = (self.count,) + self.key
-        self.count = 0
-        self.key = (None, None, None)
+        if not self.data:
+            return None
+        r = (self.address, self.data)
+        self.address = None
+        self.data = bytearray()
         return r
 
 
@@ -91,36 +113,211 @@ def rrx(a, b, carry):
     return (a & 0xffffffff, 1 & (a >> 32))
 
 
+class RoundTripCounter(object):
+    """Wraps a device, counting the commands sent through it.
+    Each method call on a debug device is one round trip.
+    """
+    def __init__(self, device):
+        self.device = device
+        self.round_trips = 0
+
+    def __getattr__(self, name):
+        attr = getattr(self.device, name)
+        if not callable(attr):
+            return attr
+        def fn(*args, **kw):
+            self.round_trips += 1
+            return attr(*args, **kw)
+        return fn
+
+
+# Condition flags are evaluated lazily. SimARM._flags holds a tuple of
+# (evaluator, r, x, y, z) describing the last flag-setting operation, and
+# the evaluator turns the rest into an (N, Z, C, V) tuple when needed. Every
+# evaluator except flags_set keeps the result in 'r', so the N and Z tests
+# can skip the evaluator entirely.
+
+def flags_set(n, z, c, v):
+    """Flags that are already known"""
+    return (n, z, c, v)
+
+def flags_add(r, a, b, _):
+    return ((r >> 31) & 1, not (r & 0xffffffff), r > 0xffffffff,
+        ((a >> 31) & 1) == ((b >> 31) & 1) and ((a >> 31) & 1) != ((r >> 31) & 1) and ((b >> 31) & 1) != ((r >> 31) & 1))
+
+def flags_sub(r, a, b, _):
+    return ((r >> 31) & 1, not (r & 0xffffffff), (a & 0xffffffff) >= (b & 0xffffffff),
+        ((a >> 31) & 1) != ((b >> 31) & 1) and ((a >> 31) & 1) != ((r >> 31) & 1))
+
+def flags_logic(r, c, _, prev):
+    """Logical ops and shifts set N, Z, and C but leave V alone.
+    'prev' is never another flags_logic record, so these don't chain.
+    """
+    return ((r >> 31) & 1, not (r & 0xffffffff), c, prev[0](prev[1], prev[2], prev[3], prev[4])[3])
+
+def flags_tuple(f):
+    return f[0](f[1], f[2], f[3], f[4])
+
+
+class CoreState(object):
+    """Compact copy of the CPU state, from SimARM.capture().
+
+    'regs' is an array('I'), and 'cpsr' packs the flags and Thumb bit where
+    the real CPSR keeps them. Two of these are equal if the CPU state is,
+    whatever the step counts were, so they're handy for lockstep comparisons.
+    """
+    __slots__ = ('regs', 'cpsr', 'step_count', 'irq_saved', 'irq_banked')
+
+    def __init__(self, regs, cpsr, step_count, irq_saved, irq_banked):
+        self.regs = regs
+        self.cpsr = cpsr
+        self.step_count = step_count
+        self.irq_saved = irq_saved
+        self.irq_banked = irq_banked
+
+    def __repr__(self):
+        return '<CoreState at step %d, pc=%08x cpsr=%08x>' % (self.step_count, self.regs[15], self.cpsr)
+
+    def __eq__(self, other):
+        return (isinstance(other, CoreState) and self.regs == other.regs and self.cpsr == other.cpsr
+                and self.irq_saved == other.irq_saved and self.irq_banked == other.irq_banked)
+
+    def __ne__(self, other):
+        return not self == other
+
+    __hash__ = None
+
+    def diff(self, other):
+        """Names of the registers and other state that differ from 'other'"""
+        names = [ SimARM.reg_names[i] for i in range(16) if self.regs[i] != other.regs[i] ]
+        for name in ('cpsr', 'irq_saved', 'irq_banked'):
+            if getattr(self, name) != getattr(other, name):
+                names.append(name)
+        return names
+
+
+# Local memory is managed in pages of this size
+PAGE_SHIFT = 8
+PAGE_SIZE = 1 << PAGE_SHIFT
+PAGE_MASK = PAGE_SIZE - 1
+
+
 class SimARMMemory(object):
     """Memory manager for a simulated ARM core, backed by a remote device.
 
     This manages a tiny bit of caching and write consolidation, to conserve
     bandwidth on the bitbang debug pipe.
     """
-    def __init__(self, device, logfile=None):
+
+    # Hardware registers start here. Stores to them are never combined.
+    mmio_base = 0x04000000
+
+    # Repeated words in a combined run that are worth a separate fill_words()
+    min_fill_words = 8
+
+    def __init__(self, device, logfile=None, program=None):
         self.device = device
         self.logfile = logfile
 
-        # Instruction cache
+        # Optional binary TraceWriter, takes the place of logfile when set
+        self.trace = None
+
+        # Instruction cache, and translated blocks built from it by SimARM.
+        # Decoded flash comes from a DecodedProgram that other simulators can
+        # share; the icache only points at its instructions.
         self.instructions = {}
+        self.blocks = {}
+        self.program = program or shared_program
+
+        # Optional DecodeCache, persists decoded flash between sessions
+        self.decode_cache = None
+
+        # Instruction cache misses, and wall-clock seconds spent filling them
+        self.icache_misses = 0
+        self.icache_miss_time = 0.0
+
+        # Peripheral models, consulted before the device
+        self.peripherals = PeripheralRegistry()
 
         # Special addresses
         self.skip_stores = {}
         self.patch_notes = {}
         self.patch_hle = {}
         self.hle_handlers = {}
+        self.hle_python = {}
+        self.hle_stats = {}
         self.hooks = {}
 
-        # Local RAM and cached flash, reads and writes don't go to hardware
-        self.local_addresses = cStringIO.StringIO()
-        self.local_data = cStringIO.StringIO()
+        # Memory watchpoints. While there are any, loads and stores are
+        # wrapped by _watched(), and SimARM.step() stops when watch_hits fills.
+        self.watchpoints = WatchpointIndex()
+        self.watch_hits = []
+
+        # Local RAM and cached flash, reads and writes don't go to hardware.
+        # Pages that are entirely local are listed in local_pages, and their
+        # storage is allocated in 'pages' on first touch. Pages with only some
+        # local bytes keep a (data, flags) pair in partial_pages.
+        self.pages = {}
+        self.local_pages = set()
+        self.partial_pages = {}
+
+        # Pages frozen by the last checkpoint(). Local pages that aren't in
+        # 'pages' yet are copied from here on first touch.
+        self.shared_pages = {}
 
-        # Detect fills
-        self.rle = RunEncoder()
+        # Stores to device memory wait here, so runs of them can go out as
+        # fills and block writes. Loads from the device flush it first.
+        self.write_buffer = WriteCombiner()
 
     def skip(self, address, reason):
+        # Stores made before this should still land
+        self.flush()
         self.skip_stores[address] = reason
 
+    # Methods wrapped while watchpoints are set: (name, size, is_store)
+    watched_methods = (('load', 4, False), ('load_half', 2, False), ('load_byte', 1, False),
+                       ('store', 4, True), ('store_half', 2, True), ('store_byte', 1, True))
+
+    def watch(self, begin, end = None, kind = 'w'):
+        """Stop the simulator on accesses to 'begin' through 'end', inclusive.
+        'kind' has any of 'r' for reads, 'w' for writes, 'c' for writes that change the value.
+        Takes a Watchpoint instead of an address too. Returns the Watchpoint.
+        """
+        wp = begin if isinstance(begin, Watchpoint) else Watchpoint(begin, end, kind)
+        if 'c' in wp.kind:
+            data = self.read_local(wp.begin, wp.end + 1 - wp.begin)
+            if data is not None:
+                for i, c in enumerate(data):
+                    wp.known[wp.begin + i] = ord(c)
+
+        if not self.watchpoints:
+            for name, size, is_store in self.watched_methods:
+                setattr(self, name, self._watched(name, size, is_store))
+        return self.watchpoints.add(wp)
+
+    def unwatch(self, wp = None):
+        """Remove one watchpoint, or by default all of them"""
+        for w in ([wp] if wp else list(self.watchpoints)):
+            self.watchpoints.remove(w)
+        if not self.watchpoints:
+            for name, size, is_store in self.watched_methods:
+                self.__dict__.pop(name, None)
+
+    def _watched(self, name, size, is_store):
+        method = getattr(type(self), name).__get__(self)
+        check = self.watchpoints.check
+        hits = self.watch_hits
+        if is_store:
+            def fn(address, data):
+                check(address, size, data, True, hits)
+                method(address, data)
+        else:
+            def fn(address):
+                data = method(address)
+                check(address, size, data, False, hits)
+                return data
+        return fn
+
     def patch(self, address, code = None, hle = None, thumb = True):
         """Replace simulated code with new assembly, optionally adding a high level emulation call
         The 'code' will be assembled and then disassembled to normalize its format and validate it.
@@ -128,6 +325,9 @@ class SimARMMemory(object):
 
         HLE markers will propagage to the icache, and they instruct us to invoke C++ code from sim_arm.h
         HLE markers run after the patched code, they're blocks of C++ that can optionally modify r0.
+
+        The 'hle' can also be a Python callable, fn(arm), which runs locally with no device
+        round trips. It can modify any of arm.regs, and log with arm.memory.hle_log().
         """
         if code:
             # Note the extra nop to facilitate the way load_assembly sizes instructions
@@ -148,7 +348,10 @@ class SimARMMemory(object):
         # The handler is a block of code that can optionally modify r0
         if hle:
             name = 'hle_%08x' % address
-            self.hle_handlers[name] = '{uint32_t r0 = arg; %s; r0;}' % hle
+            if callable(hle):
+                self.hle_python[name] = hle
+            else:
+                self.hle_handlers[name] = '{uint32_t r0 = arg; %s; r0;}' % hle
             self.patch_hle[hle_addr] = name
 
         if code:
@@ -159,31 +362,187 @@ class SimARMMemory(object):
             if hle_addr in self.instructions:
                 del self.instructions[hle_addr]
 
+        # Translated blocks may include the old code
+        self.blocks.clear()
+
     def hook(self, address, fn):
         """At a particular address, invoke fn(arm)
         Hooks run after both the simulator proper and the HLE runs.
         """
         self.hooks[address & ~1] = fn
 
-    def save_state(self, filebase):
-        """Save state to disk, using files beginning with 'filebase'"""
-        with open(filebase + '.addr', 'wb') as f:
-            f.write(self.local_addresses.getvalue())
-        with open(filebase + '.data', 'wb') as f:
-            f.write(self.local_data.getvalue())
+        # Blocks must end at hooked instructions; retranslate
+        self.blocks.clear()
+
+    def save_state(self, filebase, core = None, parent = None):
+        """Save local memory and 'core' state to the snapshot file filebase + '.snap'.
+        With a 'parent' filebase, only pages that changed since that snapshot are stored.
+        See sim_arm_snapshot.py.
+        """
+        self.flush()
+        if parent is not None:
+            parent = Snapshot(parent + '.snap')
+        write_snapshot(filebase + '.snap', core or {}, PAGE_SIZE, self.local_pages,
+            lambda pnum: self.pages.get(pnum, self.shared_pages.get(pnum)),
+            self.partial_pages, parent)
 
     def load_state(self, filebase):
-        """Load state from save_state()"""
-        with open(filebase + '.addr', 'rb') as f:
-           self.local_addresses = cStringIO.StringIO()
-           self.local_addresses.write(f.read())
-        with open(filebase + '.data', 'rb') as f:
-            self.local_data = cStringIO.StringIO()
-            self.local_data.write(f.read())
+        """Load state from save_state(), returning the saved core state.
+        Pages are read lazily, as they're touched.
+
+        Older saves in the '.addr' and '.data' format are loaded all at once,
+        and return None since their core state is kept separately.
+        """
+        self.pages = {}
+        self.local_pages = set()
+        self.partial_pages = {}
+        self.shared_pages = {}
+
+        if os.path.exists(filebase + '.snap'):
+            snapshot = Snapshot(filebase + '.snap')
+            self.local_pages = set(snapshot.local)
+            self.shared_pages = SnapshotPages(snapshot)
+            for pnum, (data, flags) in snapshot.partial.items():
+                self.partial_pages[pnum] = (bytearray(data), bytearray(flags))
+            return snapshot.core
+
+        chunk_size = 0x10000
+        with open(filebase + '.addr', 'rb') as addr_file:
+            with open(filebase + '.data', 'rb') as data_file:
+                address = 0
+                while True:
+                    flags = addr_file.read(chunk_size)
+                    if not flags:
+                        break
+                    if '\xff' in flags:
+                        data_file.seek(address)
+                        data = data_file.read(len(flags))
+                        data += '\x00' * (len(flags) - len(data))
+                        self._load_state_chunk(address, flags, data)
+                    address += len(flags)
+
+    def _load_state_chunk(self, address, flags, data):
+        for offset in range(0, len(flags), PAGE_SIZE):
+            page_flags = flags[offset:offset + PAGE_SIZE]
+            if '\xff' not in page_flags:
+                continue
+            pnum = (address + offset) >> PAGE_SHIFT
+            page_data = bytearray(data[offset:offset + PAGE_SIZE].ljust(PAGE_SIZE, '\x00'))
+            if page_flags == '\xff' * PAGE_SIZE:
+                self.local_pages.add(pnum)
+                if page_data.strip('\x00'):
+                    self.pages[pnum] = page_data
+            else:
+                self.partial_pages[pnum] = (page_data, bytearray(page_flags.ljust(PAGE_SIZE, '\x00')))
 
     def local_ram(self, begin, end):
-        self.local_addresses.seek(begin)
-        self.local_addresses.write('\xff' * (end - begin + 1))
+        """Keep the addresses from 'begin' to 'end' inclusive in the simulator, rather than hardware"""
+        address = begin
+        while address <= end:
+            pnum = address >> PAGE_SHIFT
+            offset = address & PAGE_MASK
+            count = min(PAGE_SIZE - offset, end + 1 - address)
+            address += count
+
+            if pnum in self.local_pages:
+                continue
+            if count == PAGE_SIZE:
+                self.local_pages.add(pnum)
+                partial = self.partial_pages.pop(pnum, None)
+                if partial:
+                    self.pages[pnum] = partial[0]
+                continue
+
+            data, flags = self.partial_pages.setdefault(pnum, (bytearray(PAGE_SIZE), bytearray(PAGE_SIZE)))
+            flags[offset:offset + count] = '\xff' * count
+            if '\x00' not in flags:
+                self.local_ram(pnum << PAGE_SHIFT, (pnum << PAGE_SHIFT) + PAGE_MASK)
+
+    def _local_page(self, pnum):
+        """Find the storage for a page with any local bytes. Returns (data, flags) or None.
+        Entirely local pages have flags of None, and they're allocated here on first use.
+        """
+        data = self.pages.get(pnum)
+        if data is not None:
+            return data, None
+        if pnum in self.local_pages:
+            shared = self.shared_pages.get(pnum)
+            data = self.pages[pnum] = bytearray(PAGE_SIZE) if shared is None else bytearray(shared)
+            return data, None
+        return self.partial_pages.get(pnum)
+
+    def checkpoint(self):
+        """Snapshot local memory and peripheral state, for restore().
+        This is cheap: the snapshot takes over our pages, and we copy them
+        back one at a time as they're touched.
+        """
+        self.flush()
+        shared = self.shared_pages.copy()
+        shared.update(self.pages)
+        self.shared_pages = shared
+        self.pages = {}
+        return (shared, frozenset(self.local_pages),
+                copy.deepcopy(self.partial_pages),
+                copy.deepcopy(self.peripherals),
+                dict(self.skip_stores))
+
+    def restore(self, snapshot):
+        """Go back to the state saved by checkpoint().
+        Flash cached since then stays cached, since it can't have changed.
+        Pending stores are dropped rather than sent.
+        """
+        shared, local_pages, partial_pages, peripherals, skip_stores = snapshot
+        flash = set(pnum for pnum in self.local_pages - local_pages
+                    if pnum < (0x200000 >> PAGE_SHIFT))
+        pages = {}
+        for pnum in flash:
+            data = self.pages.get(pnum, self.shared_pages.get(pnum))
+            if data is not None:
+                pages[pnum] = data
+
+        self.shared_pages = shared
+        self.pages = pages
+        self.local_pages = set(local_pages) | flash
+        self.partial_pages = copy.deepcopy(partial_pages)
+        self.peripherals = copy.deepcopy(peripherals)
+        self.skip_stores = dict(skip_stores)
+        self.write_buffer = WriteCombiner()
+
+    def _local_spans(self, address, size):
+        """Split a local address range into (data, offset, count) spans, one per page.
+        Returns None if any byte in the range isn't local.
+        """
+        spans = []
+        while size > 0:
+            offset = address & PAGE_MASK
+            count = min(size, PAGE_SIZE - offset)
+            page = self._local_page(address >> PAGE_SHIFT)
+            if page is None:
+                return None
+            data, flags = page
+            if flags is not None and flags.find('\x00', offset, offset + count) >= 0:
+                return None
+            spans.append((data, offset, count))
+            address += count
+            size -= count
+        return spans
+
+    def read_local(self, address, size):
+        """Read a string of bytes from local memory, or return None if any of it isn't local"""
+        spans = self._local_spans(address, size)
+        if spans is not None:
+            return ''.join(str(data[offset:offset + count]) for data, offset, count in spans)
+
+    def write_local(self, address, s):
+        """Write a string of bytes to local memory. Returns False without writing if any of it isn't local."""
+        spans = self._local_spans(address, len(s))
+        if spans is None:
+            return False
+        pos = 0
+        for data, offset, count in spans:
+            data[offset:offset + count] = s[pos:pos + count]
+            pos += count
+        return True
 
     def note(self, address):
         return self.patch_notes.get(address & ~1, '')
@@ -203,23 +562,31 @@ class SimARMMemory(object):
             return address + 2
 
     def log_store(self, address, data, size='word', message=''):
-        if self.logfile:
+        if self.trace:
+            self.trace.store(address, data, size, message)
+        elif self.logfile:
             self.logfile.write("arm-mem-STORE %4s[%08x] <- %08x %s\n" % (size, address, data, message))
             self.log_replayable_write(address, data, size)
 
     def log_fill(self, address, pattern, count, size='word'):
-        if self.logfile:
+        if self.trace:
+            self.trace.fill(address, pattern, count, size)
+        elif self.logfile:
             self.logfile.write("arm-mem-FILL  %4s[%08x] <- %08x * %04x\n" % (size, address, pattern, count))
             while count > 0:
                 count -= 1
                 address = self.log_replayable_write(address, pattern, size)
 
     def log_load(self, address, data, size='word'):
-        if self.logfile:
+        if self.trace:
+            self.trace.load(address, data, size)
+        elif self.logfile:
             self.logfile.write("arm-mem-LOAD  %4s[%08x] -> %08x\n" % (size, address, data))
 
     def log_prefetch(self, address):
-        if self.logfile:
+        if self.trace:
+            self.trace.prefetch(address)
+        elif self.logfile:
             self.logfile.write("arm-prefetch [%08x]\n" % address)
 
     def check_address(self, address):
@@ -227,81 +594,183 @@ class SimARMMemory(object):
         if address >= 0x05000000:
             raise IndexError("Address %08x doesn't look valid. Simulator bug?" % address)
 
-    def post_rle_store(self, count, address, pattern, size):
-        """Process stores after RLE consolidation has happened"""
-
-        if count > 1 and size == 4:
-            self.check_address(address)
-            self.log_fill(address, pattern, count)
-            self.device.fill_words(address, pattern, count)
-            return
+    def post_store(self, address, data, size):
+        """Send one store to the device, exactly as the CPU made it"""
+        self.check_address(address)
 
-        if count > 1 and size == 1:
-            self.check_address(address)
-            self.log_fill(address, pattern, count, 'byte')
-            self.device.fill_bytes(address, pattern, count)
-            return
+        if size == 4:
+            self.log_store(address, data)
+            self.device.poke(address, data)
 
-        while count > 0:
-            self.check_address(address)
+        elif size == 2:
+            self.log_store(address, data, 'half')
+            self.device.poke_byte(address, data & 0xff)
+            self.device.poke_byte(address + 1, data >> 8)
 
-            if size == 4:
-                self.log_store(address, pattern)
-                self.device.poke(address, pattern)
+        else:
+            assert size == 1
+            self.log_store(address, data, 'byte')
+            self.device.poke_byte(address, data)
+
+    def post_stores(self, address, data):
+        """Send a run of combined stores to the device, in as few commands as we can.
+        Repeating patterns become fills, and other whole words go out with write_block().
+        Never for MMIO, where each store has to go out as itself with post_store().
+        """
+        data = bytearray(data)
+        size = len(data)
+        if not size:
+            return
+        self.check_address(address + size - 1)
+        assert address + size <= self.mmio_base, "Can't combine stores to MMIO at %08x" % address
 
-            elif size == 2:
-                self.log_store(address, pattern, 'half')
-                self.device.poke_byte(address, pattern & 0xff)
-                self.device.poke_byte(address + 1, pattern >> 8)
+        if size > 4 and not (address & 3) and not (size & 3) and data == data[:4] * (size // 4):
+            word = struct.unpack_from('<I', data)[0]
+            self.log_fill(address, word, size // 4)
+            self.device.fill_words(address, word, size // 4)
+            return
 
-            else:
-                assert size == 1
-                self.log_store(address, pattern, 'byte')
-                self.device.poke_byte(address, pattern)
+        if size > 1 and (address & 3 or size & 3) and data == data[:1] * size:
+            self.log_fill(address, data[0], size, 'byte')
+            self.device.fill_bytes(address, data[0], size)
+            return
 
-            count -= 1
-            address += size
+        # Unaligned bytes at either end
+        head = min(size, -address & 3)
+        tail = (size - head) & 3
+        for i in range(head):
+            self.post_store(address + i, data[i], 1)
+
+        # Words, with long repeats as fills
+        words = struct.unpack_from('<%dI' % ((size - head - tail) // 4), data, head)
+        first = i = 0
+        while i < len(words):
+            j = i + 1
+            while j < len(words) and words[j] == words[i]:
+                j += 1
+            if j - i >= self.min_fill_words:
+                self._post_words(address + head, words, first, i)
+                self.log_fill(address + head + 4 * i, words[i], j - i)
+                self.device.fill_words(address + head + 4 * i, words[i], j - i)
+                first = j
+            i = j
+        self._post_words(address + head, words, first, len(words))
+
+        for i in range(size - tail, size):
+            self.post_store(address + i, data[i], 1)
+
+    def _post_words(self, address, words, first, last):
+        # Block write for words[first:last], relative to 'address'
+        if last - first == 1:
+            self.post_store(address + 4 * first, words[first], 4)
+        elif last > first:
+            for i in range(first, last):
+                self.log_store(address + 4 * i, words[i])
+            write_block(self.device, address + 4 * first,
+                struct.pack('<%dI' % (last - first), *words[first:last]))
 
     def flush(self):
-        # If there's a cached fill, make it happen
-        self.post_rle_store(*self.rle.flush())
+        # Send any stores that are waiting to be combined
+        run = self.write_buffer.flush()
+        if run:
+            self.post_stores(*run)
+
+    def buffer_store(self, address, data, size):
+        """Queue a store to device memory. MMIO stores go out right away, in order."""
+        if address + size > self.mmio_base:
+            self.flush()
+            self.post_store(address, data, size)
+        else:
+            run = self.write_buffer.write(address, struct.pack(store_formats[size], data))
+            if run:
+                self.post_stores(*run)
 
     def fetch_local_data(self, address, size, max_round_trips = None):
         """Immediately read a block of data from the remote device into the local cache.
         All cached bytes will stay in the cache permanently, and writes will no longer go to hardware.
         Returns the length of the block we actually read, in bytes.
         """
+        self.flush()
         block = read_block(self.device, address, size, max_round_trips=max_round_trips)
-        self.local_ram(address, address + len(block) - 1)
-        self.local_data.seek(address)
-        self.local_data.write(block)
+        if block:
+            self.local_ram(address, address + len(block) - 1)
+            self.write_local(address, block)
         return len(block)
 
     def local_data_available(self, address, limit = 0x100):
         """How many bytes of local data are available at an address?"""
-        self.local_addresses.seek(address)
-        flags = self.local_addresses.read(limit)
-        return len(flags[:flags.find('\x00')])
+        avail = 0
+        while avail < limit:
+            page = self._local_page((address + avail) >> PAGE_SHIFT)
+            if page is None:
+                break
+            offset = (address + avail) & PAGE_MASK
+            flags = page[1]
+            if flags is None:
+                avail += PAGE_SIZE - offset
+            else:
+                end = flags.find('\x00', offset)
+                avail += (end if end >= 0 else PAGE_SIZE) - offset
+                if end >= 0:
+                    break
+        return min(avail, limit)
+
+    def region_kind(self, address, size, store = False):
+        """Is a range of addresses all 'local', or all 'device' memory we can
+        access in bulk? Otherwise None, if it's mixed or touches peripherals or
+        MMIO space, where the number and width of accesses matter.
+        With 'store', flash and skipped stores also rule out 'device'.
+        """
+        end = address + size
+        if address < 0 or end > self.mmio_base:
+            return None
+        if self._local_spans(address, size) is not None:
+            return 'local'
+        for pnum in xrange(address >> PAGE_SHIFT, ((end - 1) >> PAGE_SHIFT) + 1):
+            if pnum in self.local_pages or pnum in self.partial_pages:
+                return None
+        for p in self.peripherals:
+            if p.base < end and address < p.base + p.size:
+                return None
+        if store:
+            if address < 0x200000:
+                return None
+            for a in self.skip_stores:
+                if address <= a < end:
+                    return None
+        return 'device'
 
     def flash_prefetch_hint(self, address):
         """We're accessing an address, if it's flash maybe prefetch around it.
         Returns the number of bytes prefetched or the number of bytes already available.
         Guaranteed to have at least 8 bytes available for flash addresses.
         """
-        # Flash prefetch, whatever we can get quickly
+        # Flash prefetch, a page at a time. Whatever we can get quickly
         avail = self.local_data_available(address)
         if address < 0x200000 and avail < 8:
             self.flush()
             self.log_prefetch(address)
-            avail = self.fetch_local_data(address, size=0x100, max_round_trips=1)
+            begin = address & ~PAGE_MASK
+            size = PAGE_SIZE * (1 + ((address & PAGE_MASK) > PAGE_SIZE - 8))
+            self.fetch_local_data(begin, size=size, max_round_trips=1)
+            avail = self.local_data_available(address)
         return avail
 
     def load(self, address):
+        page = self.pages.get(address >> PAGE_SHIFT)
+        if page is not None and (address & PAGE_MASK) <= PAGE_SIZE - 4:
+            return struct.unpack_from('<I', page, address & PAGE_MASK)[0]
+
         self.flash_prefetch_hint(address)
-        self.local_addresses.seek(address)
-        if self.local_addresses.read(4) == '\xff\xff\xff\xff':
-            self.local_data.seek(address)
-            return struct.unpack('<I', self.local_data.read(4))[0]
+        data = self.read_local(address, 4)
+        if data is not None:
+            return struct.unpack('<I', data)[0]
+
+        p = self.peripherals.find(address)
+        if p:
+            data = p.load(address, 4)
+            self.log_load(address, data)
+            return data
 
         # Non-cached device address
         self.flush()
@@ -311,11 +780,20 @@ class SimARMMemory(object):
         return data
 
     def load_half(self, address):
+        page = self.pages.get(address >> PAGE_SHIFT)
+        if page is not None and (address & PAGE_MASK) <= PAGE_SIZE - 2:
+            return struct.unpack_from('<H', page, address & PAGE_MASK)[0]
+
         self.flash_prefetch_hint(address)
-        self.local_addresses.seek(address)
-        if self.local_addresses.read(2) == '\xff\xff':
-            self.local_data.seek(address)
-            return struct.unpack('<H', self.local_data.read(2))[0]
+        data = self.read_local(address, 2)
+        if data is not None:
+            return struct.unpack('<H', data)[0]
+
+        p = self.peripherals.find(address)
+        if p:
+            data = p.load(address, 2)
+            self.log_load(address, data, 'half')
+            return data
 
         # Doesn't seem to be architecturally necessary; emulate with bytes
         self.flush()
@@ -325,11 +803,20 @@ class SimARMMemory(object):
         return data
 
     def load_byte(self, address):
+        page = self.pages.get(address >> PAGE_SHIFT)
+        if page is not None:
+            return page[address & PAGE_MASK]
+
         self.flash_prefetch_hint(address)
-        self.local_addresses.seek(address)
-        if self.local_addresses.read(1) == '\xff':
-            self.local_data.seek(address)
-            return ord(self.local_data.read(1))
+        data = self.read_local(address, 1)
+        if data is not None:
+            return ord(data)
+
+        p = self.peripherals.find(address)
+        if p:
+            data = p.load(address, 1)
+            self.log_load(address, data, 'byte')
+            return data
 
         self.flush()
         data = self.device.peek_byte(address)
@@ -338,10 +825,17 @@ class SimARMMemory(object):
         return data
 
     def store(self, address, data):
-        self.local_addresses.seek(address)
-        if self.local_addresses.read(4) == '\xff\xff\xff\xff':
-            self.local_data.seek(address)
-            self.local_data.write(struct.pack('<I', data))
+        page = self.pages.get(address >> PAGE_SHIFT)
+        if page is not None and (address & PAGE_MASK) <= PAGE_SIZE - 4:
+            struct.pack_into('<I', page, address & PAGE_MASK, data)
+            return
+        if self.write_local(address, struct.pack('<I', data)):
+            return
+
+        p = self.peripherals.find(address)
+        if p:
+            self.log_store(address, data, message='(%s)' % p.name)
+            p.store(address, data, 4)
             return
 
         if address in self.skip_stores:
@@ -349,13 +843,20 @@ class SimARMMemory(object):
                 message='(skipped: %s)'% self.skip_stores[address])
             return
 
-        self.post_rle_store(*self.rle.write(address, data, 4))
+        self.buffer_store(address, data, 4)
 
     def store_half(self, address, data):
-        self.local_addresses.seek(address)
-        if self.local_addresses.read(2) == '\xff\xff':
-            self.local_data.seek(address)
-            self.local_data.write(struct.pack('<H', data))
+        page = self.pages.get(address >> PAGE_SHIFT)
+        if page is not None and (address & PAGE_MASK) <= PAGE_SIZE - 2:
+            struct.pack_into('<H', page, address & PAGE_MASK, data)
+            return
+        if self.write_local(address, struct.pack('<H', data)):
+            return
+
+        p = self.peripherals.find(address)
+        if p:
+            self.log_store(address, data, 'half', message='(%s)' % p.name)
+            p.store(address, data, 2)
             return
 
         if address in self.skip_stores:
@@ -363,13 +864,20 @@ class SimARMMemory(object):
                 message='(skipped: %s)'% self.skip_stores[address])
             return
 
-        self.post_rle_store(*self.rle.write(address, data, 2))
+        self.buffer_store(address, data, 2)
 
     def store_byte(self, address, data):
-        self.local_addresses.seek(address)
-        if self.local_addresses.read(1) == '\xff':
-            self.local_data.seek(address)
-            self.local_data.write(chr(data))
+        page = self.pages.get(address >> PAGE_SHIFT)
+        if page is not None:
+            page[address & PAGE_MASK] = data
+            return
+        if self.write_local(address, chr(data)):
+            return
+
+        p = self.peripherals.find(address)
+        if p:
+            self.log_store(address, data, 'byte', message='(%s)' % p.name)
+            p.store(address, data, 1)
             return
 
         if address in self.skip_stores:
@@ -377,26 +885,41 @@ class SimARMMemory(object):
                 message='(skipped: %s)'% self.skip_stores[address])
             return
 
-        self.post_rle_store(*self.rle.write(address, data, 1))
+        self.buffer_store(address, data, 1)
 
     def fetch(self, address, thumb):
         try:
             return self.instructions[thumb | (address & ~1)]
         except KeyError:
             self.check_address(address)
+            timestamp = time.time()
             self._load_instruction(address, thumb)
+            self.icache_misses += 1
+            self.icache_miss_time += time.time() - timestamp
             return self.instructions[thumb | (address & ~1)]
 
     def _load_instruction(self, address, thumb):
-        self.flush()
-        block_size = self.flash_prefetch_hint(address)
-        assert block_size >= 8
-        self.local_data.seek(address)
-        data = self.local_data.read(block_size)
-        lines = disassembly_lines(disassemble_string(data, address, thumb=thumb))
-        self._load_assembly(address, lines, thumb=thumb)
+        # If the cache knows our flash image, we may not need to read the code
+        lines = address < 0x200000 and self.program.lookup_image(address, thumb, self.decode_cache)
+        if not lines:
+            self.flush()
+            block_size = self.flash_prefetch_hint(address)
+            assert block_size >= 8
+            data = self.read_local(address, block_size)
+            lines = self.program.lookup(address, thumb, data, self.decode_cache)
+
+        # These are shared, so HLE markers go on a copy
+        for instr in lines[:-1]:
+            addr = thumb | (instr.address & ~1)
+            if addr not in self.instructions:
+                hle = self.patch_hle.get(addr)
+                if hle:
+                    instr = copy.copy(instr)
+                    instr.hle = hle
+                self.instructions[addr] = instr
 
     def _load_assembly(self, address, lines, thumb):
+        # Patched code, these instructions are ours alone.
         # NOTE: Requires an extra instruction of padding at the end
         for i in range(len(lines) - 1):
             instr = lines[i]
@@ -408,26 +931,142 @@ class SimARMMemory(object):
 
     def hle_init(self, code_address = pad):
         """Install a C++ library to handle high-level emulation operations
+        Python handlers don't need installing; if there are only Python handlers we skip the compiler.
         """
+        if not self.hle_handlers:
+            self.hle_symbols = {}
+            return
         self.hle_symbols = compile_library(self.device, code_address, self.hle_handlers)
         print "* Installed High Level Emulation handlers at %08x" % code_address
 
-    def hle_invoke(self, instruction, r0):
+    def hle_invoke(self, instruction, r0, arm = None):
         """Invoke the high-level emulation operation for an instruction
-        Captures console output to the log.
+        Python handlers need the 'arm'. C++ handlers capture console output to the log.
+        Returns the new r0.
         """
-        cb = ConsoleBuffer(self.device)
-        cb.discard()
-        r0, _ = self.device.blx(self.hle_symbols[instruction.hle], r0)
-        logdata = cb.read(max_round_trips = None)
+        name = instruction.hle
+        device = self.device
+        self.device = counter = RoundTripCounter(device)
+        try:
+            fn = self.hle_python.get(name)
+            if fn:
+                arm.regs[0] = r0
+                fn(arm)
+                r0 = arm.regs[0]
+            else:
+                # Pending stores must land before the handler runs on the device
+                self.flush()
+                cb = ConsoleBuffer(counter)
+                cb.discard()
+                r0, _ = counter.blx(self.hle_symbols[name], r0)
+                self.hle_log(cb.read(max_round_trips = None))
+        finally:
+            self.device = device
+
+        stats = self.hle_stats.setdefault(name, [0, 0])
+        stats[0] += 1
+        stats[1] += counter.round_trips
+        return r0
 
+    def hle_log(self, logdata):
+        """Write HLE output to stdout and the log, with each line prefixed"""
         # Prefix log lines, normalize trailing newline
         logdata = '\n'.join([ 'HLE: ' + l for l in logdata.rstrip().split('\n') ]) + '\n'
 
         sys.stdout.write(logdata)
-        if self.logfile:
+        if self.trace:
+            self.trace.write(logdata)
+        elif self.logfile:
             self.logfile.write(logdata)
-        return r0
+
+    # Round trips used by a typical C++ handler that prints: discard() is a peek and a poke,
+    # then the blx, then two pointer peeks and a read_block to collect the console output.
+    hle_cpp_round_trips = 6
+
+    def hle_report(self):
+        """Summarize HLE handler usage, as a string with one line per handler.
+        Python handlers are credited with the round trips a C++ handler would have used.
+        """
+        cpp_calls = sum(calls for name, (calls, trips) in self.hle_stats.items() if name not in self.hle_python)
+        cpp_trips = sum(trips for name, (calls, trips) in self.hle_stats.items() if name not in self.hle_python)
+        per_call = float(cpp_trips) / cpp_calls if cpp_calls else self.hle_cpp_round_trips
+
+        lines = ['%-14s %-6s %8s %12s %12s' % ('handler', 'kind', 'calls', 'round trips', 'saved')]
+        for name, (calls, trips) in sorted(self.hle_stats.items()):
+            if name in self.hle_python:
+                lines.append('%-14s %-6s %8d %12d %12d' % (name, 'python', calls, trips, calls * per_call - trips))
+            else:
+                lines.append('%-14s %-6s %8d %12d %12s' % (name, 'c++', calls, trips, '-'))
+        return '\n'.join(lines)
+
+
+# Branch mnemonics, with or without a condition code
+# Exception returns: data processing into the pc with flags set, or ldm with the pc and '^'
+exception_return_re = re.compile(r'^((subs|movs)(\.\w+)? pc, |ldm\w* .*\bpc\}\^$)')
+
+branch_op_re = re.compile(r'^b(l|x|lx)?(eq|ne|cs|hs|cc|lo|mi|pl|vs|vc|hi|ls|ge|lt|gt|le|al)?$')
+
+
+def may_branch(instr):
+    """Conservatively, can this instruction write to the program counter?"""
+    if branch_op_re.match(instr.op.split('.', 1)[0]):
+        return True
+    if instr.args.split(',', 1)[0].strip('!') == 'pc':
+        return True
+    if '{' in instr.args:
+        return 'pc' in instr.args.split('{', 1)[1].strip('}^').split(', ')
+    return False
+
+
+class BasicBlock(object):
+    """A straight-line run of cached instructions, translated by SimARM.
+
+    Only the last instruction in a block may branch, carry an HLE marker, or
+    have a hook attached. The whole block executes with one call to run();
+    if an instruction raises, it's left in 'fault' so the caller can point
+    the PC at it. If a watchpoint fires, run() stops early and returns the
+    last instruction it finished.
+    """
+    def __init__(self, arm, instructions, thumb):
+        self.instructions = instructions
+        self.length = len(instructions)
+        self.last = instructions[-1]
+        self.fault = None
+
+        # LoopIdiom or IdleLoop, if this block is a loop we can run in bulk
+        self.idiom = None
+
+        # Marked in arm.coverage yet? Only once it runs all the way through.
+        self.covered = False
+
+        # Breakpoints at any of these addresses can't be honored mid-block
+        self.inner = frozenset(i.next_address for i in instructions[:-1])
+
+        # Each instruction sees its own pipelined PC value
+        body = []
+        for instr in instructions:
+            if thumb:
+                pc = (instr.next_address + 3) & ~3
+            else:
+                pc = instr.address + 8
+            body.append((instr, pc, arm._opfunc(instr)))
+        body = tuple(body)
+
+        hits = arm.memory.watch_hits
+        last = self.last
+
+        def run():
+            regs = arm.regs
+            try:
+                for instr, pc, opfunc in body:
+                    regs[15] = pc
+                    opfunc()
+                    if hits and instr is not last:
+                        return instr
+            except:
+                self.fault = instr
+                raise
+        self.run = run
 
 
 class SimARM(object):
@@ -438,16 +1077,38 @@ class SimARM(object):
 
     The lightweight CPU state is available as a dictionary property 'state'.
     Full local state including local memory can be stored with save_state().
+    A compact CoreState for checkpoints and comparisons comes from capture().
     """
+
+    # Register lookup
+    reg_names = ('r0', 'r1', 'r2', 'r3', 'r4', 'r5', 'r6', 'r7',
+                 'r8', 'r9', 'r10', 'r11', 'r12', 'sp', 'lr', 'pc')
+    alt_names = ('a1', 'a2', 'a3', 'a4', 'v1', 'v2', 'v3', 'v4',
+                 'v5', 'sb', 'sl', 'fp', 'ip', 'r13', 'r14', 'r15')
+
     def __init__(self, memory):
         self.memory = memory
         self.reset(0)
 
-        # Register lookup
-        self.reg_names = ('r0', 'r1', 'r2', 'r3', 'r4', 'r5', 'r6', 'r7',
-                          'r8', 'r9', 'r10', 'r11', 'r12', 'sp', 'lr', 'pc')
-        self.alt_names = ('a1', 'a2', 'a3', 'a4', 'v1', 'v2', 'v3', 'v4',
-                          'v5', 'sb', 'sl', 'fp', 'ip', 'r13', 'r14', 'r15')
+        # The functions that run each instruction, keyed by instruction
+        # object. These belong to us; the instructions may be shared.
+        self.opfuncs = {}
+
+        # Flash we've run code from, see sim_arm_coverage.py
+        self._coverage = Coverage()
+
+        # Optional SimProfiler; while it's set, step() runs through it
+        self.profiler = None
+
+        # Recognize simple loops when translating, see sim_arm_idiom.py
+        # and sim_arm_idle.py
+        self.recognize_loops = True
+
+        # Conditional breakpoints, as lists of Breakpoint keyed by PC.
+        # The last one that stopped step() is in breakpoint_hit.
+        self.breakpoints = {}
+        self.breakpoint_hit = None
+
         self.reg_numbers = {}
         for i, name in enumerate(self.reg_names): self.reg_numbers[name] = i
         for i, name in enumerate(self.alt_names): self.reg_numbers[name] = i
@@ -467,22 +1128,133 @@ class SimARM(object):
     def reset(self, vector):
         self.regs = [0] * 16
         self.thumb = vector & 1
-        self.cpsrV = False
-        self.cpsrC = False
-        self.cpsrZ = False
-        self.cpsrN = False
+        self._flags = (flags_set, False, False, False, False)
         self.regs[15] = vector & 0xfffffffe
         self.regs[14] = 0xffffffff
         self.step_count = 0
 
+        # Scheduled events and interrupts, see sim_arm_events.py
+        self.events = EventScheduler(self)
+
+        # While an ISR runs, irq_saved has what the interrupt took from us:
+        # the interrupted pc, sp, lr, flags and Thumb state. The IRQ mode's
+        # own sp and lr are banked in irq_banked the rest of the time.
+        self.irq_saved = None
+        self.irq_banked = [0, 0]
+
+    def interrupt(self, vector = 0x18, sp = None):
+        """Take an IRQ before the next instruction, entering 'vector' in ARM state.
+        With 'sp', the IRQ mode stack pointer starts there. Returns False if an ISR
+        is already running, since IRQs are masked.
+        """
+        if self.irq_saved is not None:
+            return False
+        regs = self.regs
+        self.irq_saved = { 'pc': regs[15] | self.thumb, 'sp': regs[13], 'lr': regs[14],
+                           'nzcv': self.nzcv, 'thumb': self.thumb }
+        if sp is not None:
+            self.irq_banked[0] = sp
+        regs[13] = self.irq_banked[0]
+        regs[14] = (regs[15] + 4) & 0xffffffff
+        regs[15] = vector & 0xfffffffe
+        self.thumb = 0
+        return True
+
+    def return_from_interrupt(self, pc = None):
+        """Leave the ISR, restoring what interrupt() saved. Execution continues
+        at 'pc' if it's given, or else where the interrupt was taken.
+        Returns False if there's no ISR running.
+        """
+        saved = self.irq_saved
+        if saved is None:
+            return False
+        regs = self.regs
+        self.irq_banked = [regs[13], regs[14]]
+        regs[13] = saved['sp']
+        regs[14] = saved['lr']
+        self._flags = (flags_set,) + tuple(saved['nzcv'])
+        self.thumb = saved['thumb']
+        if pc is None:
+            pc = saved['pc']
+        regs[15] = pc & 0xfffffffe
+        self.irq_saved = None
+        self.events.interrupt_returned()
+        return True
+
+    def _exception_return(self, fn):
+        # Wraps the op for 'subs pc, lr, #4' and friends. Outside an ISR they're
+        # ordinary branches; inside, they also restore the interrupted state.
+        def wrapper():
+            fn()
+            if self.irq_saved is not None and self._branch is not None:
+                target = self._branch
+                self.return_from_interrupt(target)
+                self._branch = target
+        return wrapper
+
     _state_fields = ('thumb', 'cpsrV', 'cpsrC', 'cpsrZ', 'cpsrN', 'step_count')
 
+    @property
+    def nzcv(self):
+        """Condition flags as an (N, Z, C, V) tuple"""
+        f = self._flags
+        if f[0] is not flags_set:
+            f = self._flags = (flags_set,) + flags_tuple(f)
+        return f[1:]
+
+    def _set_flag(self, index, value):
+        flags = list(self.nzcv)
+        flags[index] = value
+        self._flags = (flags_set,) + tuple(flags)
+
+    cpsrN = property(lambda self: self.nzcv[0], lambda self, v: self._set_flag(0, v))
+    cpsrZ = property(lambda self: self.nzcv[1], lambda self, v: self._set_flag(1, v))
+    cpsrC = property(lambda self: self.nzcv[2], lambda self, v: self._set_flag(2, v))
+    cpsrV = property(lambda self: self.nzcv[3], lambda self, v: self._set_flag(3, v))
+
+    @property
+    def cpsr(self):
+        """Flags and Thumb state, packed into bits 31-28 and 5 like the CPSR"""
+        n, z, c, v = self.nzcv
+        return (bool(n) << 31) | (bool(z) << 30) | (bool(c) << 29) | (bool(v) << 28) | (bool(self.thumb) << 5)
+
+    @cpsr.setter
+    def cpsr(self, value):
+        self._flags = (flags_set, (value >> 31) & 1, bool(value & (1 << 30)),
+                       bool(value & (1 << 29)), bool(value & (1 << 28)))
+        self.thumb = (value >> 5) & 1
+
+    def capture(self):
+        """The CPU state as a CoreState, a single compact copy"""
+        return CoreState(array('I', self.regs), self.cpsr, self.step_count,
+                         self.irq_saved and dict(self.irq_saved), tuple(self.irq_banked))
+
+    def restore(self, core):
+        """Go back to a CoreState from capture()"""
+        self.regs[:] = map(int, core.regs)
+        self.cpsr = core.cpsr
+        self.step_count = core.step_count
+        self.irq_saved = core.irq_saved and dict(core.irq_saved)
+        self.irq_banked = list(core.irq_banked)
+
+    @property
+    def coverage(self):
+        return self._coverage
+
+    @coverage.setter
+    def coverage(self, value):
+        # Cached blocks were marked in the old map
+        self._coverage = value
+        self.memory.blocks.clear()
+
     @property
     def state(self):
         d = {}
         for name in self._state_fields:
             d[name] = getattr(self, name)
         d['regs'] = self.regs[:]
+        d['irq_saved'] = self.irq_saved and dict(self.irq_saved)
+        d['irq_banked'] = self.irq_banked[:]
         return d
 
     @state.setter
@@ -490,25 +1262,129 @@ class SimARM(object):
         for name in self._state_fields:
             setattr(self, name, value[name])
         self.regs[:] = value['regs']
+        saved = value.get('irq_saved')
+        self.irq_saved = saved and dict(saved)
+        self.irq_banked = list(value.get('irq_banked', (0, 0)))
 
-    def save_state(self, filebase):
-        """Save state to disk, using files beginning with 'filebase'"""
-        self.memory.save_state(filebase)
-        with open(filebase + '.core', 'w') as f:
-            json.dump(self.state, f)
+    def save_state(self, filebase, parent = None):
+        """Save state to disk, as filebase + '.snap'.
+        With a 'parent' filebase, the snapshot is a delta against that one.
+        """
+        self.memory.save_state(filebase, self.state, parent)
 
     def load_state(self, filebase):
         """Load state from save_state()"""
-        self.memory.load_state(filebase)
-        with open(filebase + '.core', 'r') as f:
-            self.state = json.load(f)
+        core = self.memory.load_state(filebase)
+        if core is None:
+            with open(filebase + '.core', 'r') as f:
+                core = json.load(f)
+        self.state = core
+
+    # Longest run of instructions we'll translate into one block
+    max_block_length = 64
 
     def step(self, repeat = 1, breakpoint = None):
         """Step the simulated ARM by one or more instructions
-        Stops when the repeat count is exhausted or we hit a breakpoint.
+        Stops when the repeat count is exhausted, we hit a breakpoint, a
+        conditional breakpoint holds (see add_breakpoint() and breakpoint_hit),
+        or a memory watchpoint fires (see memory.watch() and memory.watch_hits).
+        Scheduled events and interrupts happen in between (see events).
+
+        Straight-line runs of instructions are translated into cached blocks
+        that execute together, and recognized loops run in bulk. We fall back
+        on single instructions for runs too short to be sure a new block would
+        finish, and when a block would overrun the repeat count or pass over
+        the breakpoint.
         """
+        if self.profiler is not None:
+            return self.profiler.step(self, repeat, breakpoint)
+
+        del self.memory.watch_hits[:]
+        self.breakpoint_hit = None
+        events = self.events
+
+        # Run right up to each event in one piece, then let it happen
+        while repeat > 0:
+            if events.queue:
+                events.run_due()
+            count = repeat
+            if events.queue:
+                count = max(1, min(count, events.next_step - self.step_count))
+            left = self._run(count, breakpoint)
+            if left is True:
+                return
+            repeat -= count - left
+
+    def _run(self, repeat, breakpoint):
+        # The body of step(), between events. Returns True if we stopped early,
+        # otherwise how many steps we left undone because a hook scheduled an
+        # event that comes due before then.
         regs = self.regs
+        events = self.events
+        blocks = self.memory.blocks
+        watch_hits = self.memory.watch_hits
+        breakpoints = self.breakpoints
         while repeat > 0:
+            block = blocks.get(self.thumb | regs[15])
+            if block is None and repeat >= self.max_block_length:
+                # Only translate when whatever we get is sure to run.
+                # Short runs, like single steps, go one instruction at a time.
+                block = self._translate_block(regs[15], self.thumb)
+
+            if block and block.idiom:
+                taken = block.idiom.run(self, repeat, breakpoint)
+                if taken:
+                    repeat -= taken
+                    if not block.covered:
+                        self._cover_block(block)
+                    if regs[15] == breakpoint:
+                        return True
+                    if regs[15] in breakpoints and self._check_breakpoints():
+                        return True
+                    continue
+
+            if block and block.length <= repeat and breakpoint not in block.inner:
+                repeat -= block.length
+                self._branch = None
+
+                try:
+                    stopped = block.run()
+                except:
+                    # Count up to and including the faulting instruction
+                    self.step_count += block.instructions.index(block.fault) + 1
+                    regs[15] = block.fault.address
+                    self._coverage.mark(block.instructions[0].address, block.fault.address)
+                    raise
+
+                if stopped:
+                    # Watchpoint, partway through the block
+                    self.step_count += block.instructions.index(stopped) + 1
+                    regs[15] = stopped.next_address
+                    self._coverage.mark(block.instructions[0].address, stopped.next_address)
+                    return True
+
+                self.step_count += block.length
+                if not block.covered:
+                    self._cover_block(block)
+                instr = block.last
+                regs[15] = self._branch or instr.next_address
+                if regs[15] == breakpoint:
+                    return True
+
+                if instr.hle:
+                    regs[0] = self.memory.hle_invoke(instr, regs[0], self)
+                hook = self.memory.hooks.get(instr.address)
+                if hook:
+                    # Hooks can do anything including reentrantly step()'ing
+                    hook(self)
+                if watch_hits:
+                    return True
+                if regs[15] in breakpoints and self._check_breakpoints():
+                    return True
+                if hook and events.queue and events.next_step < self.step_count + repeat:
+                    return repeat
+                continue
+
             repeat -= 1
             self.step_count += 1
 
@@ -522,18 +1398,11 @@ class SimARM(object):
                 regs[15] += 8
 
             try:
-
-                # The op_ function does some precalculation and returns a function that
-                # actually runs the operation. We cache the latter function.
-                try:
-                    opfunc = instr.opfunc
-                except AttributeError:
-                    opfunc = instr.opfunc = getattr(self, 'op_' + instr.op.split('.', 1)[0])(instr)
-
-                opfunc()
+                self._opfunc(instr)()
                 regs[15] = self._branch or instr.next_address
+                self._coverage.mark(instr.address, instr.next_address)
                 if regs[15] == breakpoint:
-                    return
+                    return True
 
             except:
                 # If we don't finish, point the PC at that instruction
@@ -541,20 +1410,117 @@ class SimARM(object):
                 raise
 
             if instr.hle:
-                regs[0] = self.memory.hle_invoke(instr, regs[0])
+                regs[0] = self.memory.hle_invoke(instr, regs[0], self)
             if hook:
                 # Hooks can do anything including reentrantly step()'ing
                 hook(self)
+            if watch_hits:
+                return True
+            if regs[15] in breakpoints and self._check_breakpoints():
+                return True
+            if hook and events.queue and events.next_step < self.step_count + repeat:
+                return repeat
+        return 0
+
+    def _check_breakpoints(self):
+        for bp in self.breakpoints[self.regs[15]]:
+            if bp.check(self):
+                self.breakpoint_hit = bp
+                return True
+        return False
+
+    def add_breakpoint(self, condition, action = None):
+        """Stop step() when a condition like 'pc == 0x18cc8 and r0 > 3' holds.
+        With an 'action', call action(arm) instead, stopping only if it returns True.
+        See sim_arm_breakpoints.py. Returns the Breakpoint.
+        """
+        bp = Breakpoint(self, condition, action)
+        for pc in bp.pcs:
+            self.breakpoints.setdefault(pc, []).append(bp)
+
+        # Blocks must end before breakpoints; retranslate
+        self.memory.blocks.clear()
+        return bp
+
+    def remove_breakpoint(self, bp = None):
+        """Remove one conditional breakpoint, or by default all of them"""
+        for pc, bps in self.breakpoints.items():
+            bps[:] = [ b for b in bps if bp is not None and b is not bp ]
+            if not bps:
+                del self.breakpoints[pc]
+
+    def _opfunc(self, instr):
+        # The op_ function does some precalculation and returns a function that
+        # actually runs the operation. We cache the latter function.
+        try:
+            return self.opfuncs[instr]
+        except KeyError:
+            fn = getattr(self, 'op_' + instr.op.split('.', 1)[0])(instr)
+            if exception_return_re.match(instr.op + ' ' + instr.args):
+                fn = self._exception_return(fn)
+            self.opfuncs[instr] = fn
+            return fn
+
+    def _translate_block(self, address, thumb):
+        """Translate a straight-line run of instructions starting at 'address'.
+        Returns a BasicBlock, or None if even the first instruction can't be
+        translated, in which case step() handles it (and any errors) alone.
+        """
+        instructions = []
+        while len(instructions) < self.max_block_length:
+            try:
+                instr = self.memory.fetch(address, thumb)
+                self._opfunc(instr)
+            except Exception:
+                # Let these happen when we actually get to the instruction
+                break
+
+            instructions.append(instr)
+            if instr.hle or may_branch(instr) or (instr.address in self.memory.hooks):
+                break
+            if instr.next_address in self.breakpoints:
+                break
+            address = instr.next_address
+
+        if not instructions:
+            return None
+        block = BasicBlock(self, instructions, thumb)
+        if self.recognize_loops:
+            block.idiom = recognize_loop(self, block, thumb) or recognize_idle(self, block, thumb)
+        self.memory.blocks[thumb | (instructions[0].address & ~1)] = block
+        return block
+
+    def _cover_block(self, block):
+        self._coverage.mark(block.instructions[0].address, block.last.next_address)
+        block.covered = True
+
+    def run_idiom(self, repeat, breakpoint = None):
+        """If we're at the top of a loop we recognize, run up to 'repeat' steps
+        of it in bulk. Returns the number of steps taken, or zero.
+        Conditional breakpoints at the exit are checked, as in step().
+        Only loops step() has already translated are found here.
+        """
+        self.breakpoint_hit = None
+        block = self.memory.blocks.get(self.thumb | self.regs[15])
+        if not (block and block.idiom):
+            return 0
+        taken = block.idiom.run(self, repeat, breakpoint)
+        if taken and not block.covered:
+            self._cover_block(block)
+        if taken and self.regs[15] in self.breakpoints:
+            self._check_breakpoints()
+        return taken
 
     def get_next_instruction(self):
         return self.memory.fetch(self.regs[15], self.thumb)
 
     def flags_string(self):
+        n, z, c, v = self.nzcv
         return ''.join([
-            '-N'[self.cpsrN],
-            '-Z'[self.cpsrZ],
-            '-C'[self.cpsrC],
-            '-V'[self.cpsrV],
+            '-N'[n],
+            '-Z'[z],
+            '-C'[c],
+            '-V'[v],
             '-T'[self.thumb],
         ])
 
@@ -581,11 +1547,10 @@ class SimARM(object):
         return ' '.join('%s=%08x' % (self.reg_names[i], self.regs[i]) for i in range(count))
 
     def copy_registers_from(self, ns):
-        self.regs = [ns.get(n, 0) for n in self.reg_names]
+        self.regs[:] = [ns.get(n, 0) for n in self.reg_names]
 
     def copy_registers_to(self, ns):
-        for i, name in enumerate(self.reg_names):
-            ns[name] = self.regs[i]
+        ns.update(zip(self.reg_names, self.regs))
 
     def _generate_ldstm(self, memop, mode):
         impl = mode or 'ia'
@@ -609,14 +1574,13 @@ class SimARM(object):
         else             : post =  0
 
         def op_fn(i):
-            left, right = i.args.split(', ', 1)
-            assert right[0] == '{'
-            writeback = left.endswith('!')
-            left = self.reg_numbers[left.strip('!')]
-            regs = right.strip('{}').split(', ')
+            left, right = self._operands(i)
+            regs = self._reglist(right)
+            writeback = left.__class__ is tuple and left[0] == 'wb'
+            left = self._regnum(left[1] if writeback else left)
 
             if memop =='st':
-                src_rn = [self.reg_numbers[n] for n in regs]
+                src_rn = regs
                 def fn():
                     addr = self.regs[left]
                     for rn in src_rn:
@@ -643,106 +1607,228 @@ class SimARM(object):
         self._generate_condition_codes(op_fn, 'op_' + memop + 'm' + mode + '%s')
 
     def _generate_condition_codes(self, fn, name):
-        setattr(self, name % 'eq', lambda i: lambda fn=fn(i): (self.cpsrZ     ) and fn())
-        setattr(self, name % 'ne', lambda i: lambda fn=fn(i): (not self.cpsrZ ) and fn())
-        setattr(self, name % 'cs', lambda i: lambda fn=fn(i): (self.cpsrC     ) and fn())
-        setattr(self, name % 'hs', lambda i: lambda fn=fn(i): (self.cpsrC     ) and fn())
-        setattr(self, name % 'cc', lambda i: lambda fn=fn(i): (not self.cpsrC ) and fn())
-        setattr(self, name % 'lo', lambda i: lambda fn=fn(i): (not self.cpsrC ) and fn())
-        setattr(self, name % 'mi', lambda i: lambda fn=fn(i): (self.cpsrN     ) and fn())
-        setattr(self, name % 'pl', lambda i: lambda fn=fn(i): (not self.cpsrN ) and fn())
-        setattr(self, name % 'vs', lambda i: lambda fn=fn(i): (self.cpsrV     ) and fn())
-        setattr(self, name % 'vc', lambda i: lambda fn=fn(i): (not self.cpsrV ) and fn())
-        setattr(self, name % 'hi', lambda i: lambda fn=fn(i): (self.cpsrC and not self.cpsrZ ) and fn())
-        setattr(self, name % 'ls', lambda i: lambda fn=fn(i): (self.cpsrZ or not self.cpsrC ) and fn())
-        setattr(self, name % 'ge', lambda i: lambda fn=fn(i): (((not self.cpsrN) == (not self.cpsrV)) ) and fn())
-        setattr(self, name % 'lt', lambda i: lambda fn=fn(i): (((not self.cpsrN) != (not self.cpsrV)) ) and fn())
-        setattr(self, name % 'gt', lambda i: lambda fn=fn(i): (((not self.cpsrN) == (not self.cpsrV)) and not self.cpsrZ ) and fn())
-        setattr(self, name % 'le', lambda i: lambda fn=fn(i): (((not self.cpsrN) != (not self.cpsrV)) or self.cpsrZ      ) and fn())
+        setattr(self, name % 'eq', lambda i: self._cond_eq(fn(i)))
+        setattr(self, name % 'ne', lambda i: self._cond_ne(fn(i)))
+        setattr(self, name % 'cs', lambda i: self._cond_cs(fn(i)))
+        setattr(self, name % 'hs', lambda i: self._cond_cs(fn(i)))
+        setattr(self, name % 'cc', lambda i: self._cond_cc(fn(i)))
+        setattr(self, name % 'lo', lambda i: self._cond_cc(fn(i)))
+        setattr(self, name % 'mi', lambda i: self._cond_mi(fn(i)))
+        setattr(self, name % 'pl', lambda i: self._cond_pl(fn(i)))
+        setattr(self, name % 'vs', lambda i: self._cond_flags(fn(i), lambda n, z, c, v: v))
+        setattr(self, name % 'vc', lambda i: self._cond_flags(fn(i), lambda n, z, c, v: not v))
+        setattr(self, name % 'hi', lambda i: self._cond_flags(fn(i), lambda n, z, c, v: c and not z))
+        setattr(self, name % 'ls', lambda i: self._cond_flags(fn(i), lambda n, z, c, v: z or not c))
+        setattr(self, name % 'ge', lambda i: self._cond_ge(fn(i)))
+        setattr(self, name % 'lt', lambda i: self._cond_lt(fn(i)))
+        setattr(self, name % 'gt', lambda i: self._cond_gt(fn(i)))
+        setattr(self, name % 'le', lambda i: self._cond_le(fn(i)))
         setattr(self, name % 'al', fn)
 
-    def _reg_or_literal(self, s):
-        if s[0] == '#':
-            n = int(s[1:], 0) & 0xffffffff
-            return lambda: n
-        rn = self.reg_numbers[s]
-        return lambda: self.regs[rn]
-
-    def _reg_or_target(self, s):
-        if s in self.reg_numbers:
-            rn = self.reg_numbers[s]
-            return lambda: self.regs[rn]
-        n = int(s, 0) & 0xffffffff
-        return lambda: n
+    # Operands come structured from sim_arm_decode; see the top of that file.
+    # These turn them into closures, and raise if they aren't what we expect.
 
-    def _shifter(self, s):
-        # Returns (result, carry)
-        l = s.split(', ', 1)
-        if len(l) == 2:
+    @staticmethod
+    def _operands(i):
+        # Code that didn't come from our decoder only has text
+        operands = getattr(i, 'operands', None)
+        if operands is None:
+            operands = parse_operands(i.args)
+        return operands
 
-            t = l[1].split(' ')
+    @staticmethod
+    def _regnum(r):
+        if r.__class__ is not int:
+            raise ValueError("Expected a register, not %r" % (r,))
+        return r
 
-            if len(t) == 1:
-                # Assumed ror, to match the encoding for 32-bit literals
-                a = self._reg_or_literal(l[0])
-                b = int(t[0], 0) & 0xffffffff
-                return lambda: ror(a(), b)
+    @staticmethod
+    def _address(o):
+        if o.__class__ is not tuple or o[0] != 'addr':
+            raise ValueError("Expected an address, not %r" % (o,))
+        return o[1]
 
-            a = self._reg_or_literal(l[0])
-            b = self._reg_or_literal(t[1])
+    @staticmethod
+    def _reglist(o):
+        if o.__class__ is not tuple or o[0] != 'list':
+            raise ValueError("Expected a register list, not %r" % (o,))
+        return o[1]
+
+    def _reg_or_literal(self, o):
+        if o.__class__ is tuple and o[0] == 'imm':
+            n = o[1] & 0xffffffff
+            return lambda: n
+        rn = self._regnum(o)
+        return lambda: self.regs[rn]
 
-            if t[0] == 'lsl': return lambda: lsl(a(), b())
-            if t[0] == 'lsr': return lambda: lsr(a(), b())
-            if t[0] == 'asr': return lambda: asr(a(), b())
-            if t[0] == 'rol': return lambda: rol(a(), b())
-            if t[0] == 'ror': return lambda: ror(a(), b())
+    def _reg_or_target(self, o):
+        if o.__class__ is tuple:
+            n = self._address(o) & 0xffffffff
+            return lambda: n
+        rn = self._regnum(o)
+        return lambda: self.regs[rn]
 
-        a = self._reg_or_literal(s)
+    def _shifter(self, o):
+        # Returns (result, carry)
+        if o.__class__ is tuple and o[0] == 'shift':
+            a = self._reg_or_literal(o[1])
+            kind = o[2]
+            if kind == 'rrx':
+                raise ValueError("Unsupported shift %r" % (o,))
+            b = self._reg_or_literal(o[3])
+
+            if kind == 'lsl': return lambda: lsl(a(), b())
+            if kind == 'lsr': return lambda: lsr(a(), b())
+            if kind == 'asr': return lambda: asr(a(), b())
+            if kind == 'rol': return lambda: rol(a(), b())
+            if kind == 'ror': return lambda: ror(a(), b())
+
+        a = self._reg_or_literal(o)
         return lambda: (a(), 0)
 
-    def _reladdr(self, right):
-        assert right[0] == '['
-        if right[-1] == ']':
-            # [a, b]
-            addrs = right.strip('[]').split(', ', 1)
-            vn = self.reg_numbers[addrs[0]]
-            if len(addrs) > 1:
-                if addrs[1][0] == '-':
-                    sF = self._shifter(addrs[1][1:])
-                    return lambda: (self.regs[vn] - sF()[0]) & 0xffffffff
-                else:
-                    sF = self._shifter(addrs[1])
-                    return lambda: (self.regs[vn] + sF()[0]) & 0xffffffff
-            return lambda: self.regs[vn]
-        else:
+    def _reladdr(self, o):
+        if o.__class__ is not tuple or o[0] != 'mem' or o[4]:
+            raise ValueError("Unsupported addressing mode %r" % (o,))
+        vn = self._regnum(o[1])
+        offset, post = o[2], o[3]
+        if post is not None:
             # [a], b
-            addrs = right.split(', ')
-            vn = self.reg_numbers[addrs[0].strip('[]')]
-            rl = self._reg_or_literal(addrs[1])
+            rl = self._reg_or_literal(post)
             return lambda: (self.regs[vn] + rl()) & 0xffffffff
+        if offset is None:
+            # [a]
+            return lambda: self.regs[vn]
+        # [a, b]
+        if offset.__class__ is tuple and offset[0] == 'neg':
+            sF = self._shifter(offset[1])
+            return lambda: (self.regs[vn] - sF()[0]) & 0xffffffff
+        sF = self._shifter(offset)
+        return lambda: (self.regs[vn] + sF()[0]) & 0xffffffff
+
+    # Conditional execution. N and Z come straight from the result of the
+    # last flag-setting op, and C and N!=V have shortcuts for the common
+    # evaluators. Other conditions need all flags evaluated.
+
+    def _cond_eq(self, fn):
+        def cond():
+            f = self._flags
+            if (f[2] if f[0] is flags_set else not (f[1] & 0xffffffff)):
+                fn()
+        return cond
+
+    def _cond_ne(self, fn):
+        def cond():
+            f = self._flags
+            if not (f[2] if f[0] is flags_set else not (f[1] & 0xffffffff)):
+                fn()
+        return cond
+
+    def _cond_mi(self, fn):
+        def cond():
+            f = self._flags
+            if (f[1] if f[0] is flags_set else (f[1] >> 31) & 1):
+                fn()
+        return cond
+
+    def _cond_pl(self, fn):
+        def cond():
+            f = self._flags
+            if not (f[1] if f[0] is flags_set else (f[1] >> 31) & 1):
+                fn()
+        return cond
 
     @staticmethod
-    def _3arg(i):
-        l = i.args.split(', ', 2)
-        if len(l) == 3:
-            return l
-        else:
-            return [l[0]] + l
+    def _carry(f):
+        e = f[0]
+        if e is flags_sub:
+            return (f[2] & 0xffffffff) >= (f[3] & 0xffffffff)
+        if e is flags_add:
+            return f[1] > 0xffffffff
+        if e is flags_logic:
+            return f[2]
+        return f[3]
+
+    def _cond_cs(self, fn):
+        carry = self._carry
+        def cond():
+            if carry(self._flags):
+                fn()
+        return cond
+
+    def _cond_cc(self, fn):
+        carry = self._carry
+        def cond():
+            if not carry(self._flags):
+                fn()
+        return cond
+
+    @staticmethod
+    def _signed_less(f):
+        # N != V
+        if f[0] is flags_sub:
+            r, a, b = f[1], f[2], f[3]
+            n = (r >> 31) & 1
+            return n != (((a >> 31) & 1) != ((b >> 31) & 1) and ((a >> 31) & 1) != n)
+        n, z, c, v = f[0](f[1], f[2], f[3], f[4])
+        return (not n) != (not v)
+
+    def _cond_lt(self, fn):
+        less = self._signed_less
+        def cond():
+            if less(self._flags):
+                fn()
+        return cond
+
+    def _cond_ge(self, fn):
+        less = self._signed_less
+        def cond():
+            if not less(self._flags):
+                fn()
+        return cond
+
+    def _cond_gt(self, fn):
+        less = self._signed_less
+        def cond():
+            f = self._flags
+            if not (less(f) or (f[2] if f[0] is flags_set else not (f[1] & 0xffffffff))):
+                fn()
+        return cond
+
+    def _cond_le(self, fn):
+        less = self._signed_less
+        def cond():
+            f = self._flags
+            if less(f) or (f[2] if f[0] is flags_set else not (f[1] & 0xffffffff)):
+                fn()
+        return cond
+
+    def _cond_flags(self, fn, test):
+        def cond():
+            f = self._flags
+            if test(*f[0](f[1], f[2], f[3], f[4])):
+                fn()
+        return cond
+
+    def _3arg(self, i):
+        o = self._operands(i)
+        if len(o) == 2:
+            return (o[0],) + o
+        return o
 
     def _dstpc(self, dst):
-        if dst == 'pc':
+        rn = self._regnum(dst)
+        if rn == 15:
             def fn(r):
                 self._branch = r & 0xfffffffe
                 self.thumb = r & 1
             return fn
         else:
-            rn = self.reg_numbers[dst]
             def fn(r):
                 self.regs[rn] = r & 0xffffffff
             return fn
 
     def op_ldr(self, i):
-        left, right = i.args.split(', ', 1)
+        left, right = self._operands(i)
         dF = self._dstpc(left)
         aF = self._reladdr(right)
         def fn():
@@ -750,7 +1836,7 @@ class SimARM(object):
         return fn
 
     def op_ldrh(self, i):
-        left, right = i.args.split(', ', 1)
+        left, right = self._operands(i)
         dF = self._dstpc(left)
         aF = self._reladdr(right)
         def fn():
@@ -758,7 +1844,7 @@ class SimARM(object):
         return fn
 
     def op_ldrsh(self, i):
-        left, right = i.args.split(', ', 1)
+        left, right = self._operands(i)
         dF = self._dstpc(left)
         aF = self._reladdr(right)
         def fn():
@@ -769,7 +1855,7 @@ class SimARM(object):
         return fn
 
     def op_ldrb(self, i):
-        left, right = i.args.split(', ', 1)
+        left, right = self._operands(i)
         dF = self._dstpc(left)
         aF = self._reladdr(right)
         def fn():
@@ -777,31 +1863,32 @@ class SimARM(object):
         return fn
 
     def op_str(self, i):
-        left, right = i.args.split(', ', 1)
-        rn = self.reg_numbers[left]
+        left, right = self._operands(i)
+        rn = self._regnum(left)
         rel = self._reladdr(right)
         def fn():
             self.memory.store(rel(), self.regs[rn])
         return fn
 
     def op_strh(self, i):
-        left, right = i.args.split(', ', 1)
-        rn = self.reg_numbers[left]
+        left, right = self._operands(i)
+        rn = self._regnum(left)
         rel = self._reladdr(right)
         def fn():
             self.memory.store_half(rel(), 0xffff & self.regs[rn])
         return fn
 
     def op_strb(self, i):
-        left, right = i.args.split(', ', 1)
-        rn = self.reg_numbers[left]
+        left, right = self._operands(i)
+        rn = self._regnum(left)
         rel = self._reladdr(right)
         def fn():
             self.memory.store_byte(rel(), 0xff & self.regs[rn])
         return fn
 
     def op_push(self, i):
-        reglist = [self.reg_numbers[r] for r in i.args.strip('{}').split(', ')]
+        (reglist,) = self._operands(i)
+        reglist = self._reglist(reglist)
         def fn():
             sp = self.regs[13] - 4 * len(reglist)
             self.regs[13] = sp
@@ -810,7 +1897,8 @@ class SimARM(object):
         return fn
 
     def op_pop(self, i):
-        reglist = [self._dstpc(r) for r in i.args.strip('{}').split(', ')]
+        (reglist,) = self._operands(i)
+        reglist = [self._dstpc(r) for r in self._reglist(reglist)]
         def fn():
             sp = self.regs[13]
             for i in range(len(reglist)):
@@ -819,29 +1907,32 @@ class SimARM(object):
         return fn
 
     def op_bx(self, i):
-        if i.args in self.reg_numbers:
+        (target,) = self._operands(i)
+        if target.__class__ is int:
             def fn():
-                r = self.regs[self.reg_numbers[i.args]]
+                r = self.regs[target]
                 self._branch = r & ~1
                 self.thumb = r & 1
             return fn
         else:
+            r = self._address(target)
             def fn():
-                r = int(i.args, 0)
                 self._branch = r & ~1
                 self.thumb = not self.thumb
             return fn
 
     def op_bl(self, i):
-        t = self._reg_or_target(i.args)
+        (target,) = self._operands(i)
+        t = self._reg_or_target(target)
         def fn():
             self.regs[14] = i.next_address | self.thumb
             self._branch = t()
         return fn
 
     def op_blx(self, i):
-        if i.args in self.reg_numbers:
-            rn = self.reg_numbers[i.args]
+        (target,) = self._operands(i)
+        if target.__class__ is int:
+            rn = target
             def fn():
                 self.regs[14] = i.next_address | self.thumb
                 r = self.regs[rn]
@@ -849,7 +1940,7 @@ class SimARM(object):
                 self.thumb = r & 1
             return fn
         else:
-            r = int(i.args, 0)
+            r = self._address(target)
             def fn():
                 self.regs[14] = i.next_address | self.thumb
                 self._branch = r & 0xfffffffe
@@ -857,7 +1948,8 @@ class SimARM(object):
             return fn
 
     def op_b(self, i):
-        dest = int(i.args, 0)
+        (dest,) = self._operands(i)
+        dest = self._address(dest)
         def fn():
             self._branch = dest
         return fn
@@ -866,7 +1958,7 @@ class SimARM(object):
         return lambda: None
 
     def op_mov(self, i):
-        dst, src = i.args.split(', ', 1)
+        dst, src = self._operands(i)
         sF = self._shifter(src)
         dF = self._dstpc(dst)
         def fn():
@@ -874,18 +1966,18 @@ class SimARM(object):
         return fn
 
     def op_movs(self, i):
-        dst, src = i.args.split(', ', 1)
+        dst, src = self._operands(i)
         sF = self._shifter(src)
         dF = self._dstpc(dst)
         def fn():
-            r, self.cpsrC = sF()
-            self.cpsrZ = r == 0
-            self.cpsrN = (r >> 31) & 1
+            r, c = sF()
+            f = self._flags
+            self._flags = (flags_logic, r, c, None, f[4] if f[0] is flags_logic else f)
             dF(r)
         return fn
 
     def op_mvn(self, i):
-        dst, src = i.args.split(', ', 1)
+        dst, src = self._operands(i)
         sF = self._shifter(src)
         dF = self._dstpc(dst)
         def fn():
@@ -893,20 +1985,20 @@ class SimARM(object):
         return fn
 
     def op_mvns(self, i):
-        dst, src = i.args.split(', ', 1)
+        dst, src = self._operands(i)
         sF = self._shifter(src)
         dF = self._dstpc(dst)
         def fn():
-            r, self.csprC = sF()
+            r, c = sF()
             r = r ^ 0xffffffff
-            self.cpsrZ = r == 0
-            self.cpsrN = (r >> 31) & 1
+            f = self._flags
+            self._flags = (flags_logic, r, c, None, f[4] if f[0] is flags_logic else f)
             dF(r)
         return fn
 
     def op_bic(self, i):
         dst, src0, src1 = self._3arg(i)
-        rn = self.reg_numbers[src0]
+        rn = self._regnum(src0)
         sF = self._shifter(src1)
         dF = self._dstpc(dst)
         def fn():
@@ -917,20 +2009,20 @@ class SimARM(object):
 
     def op_bics(self, i):
         dst, src0, src1 = self._3arg(i)
-        rn = self.reg_numbers[src0]
+        rn = self._regnum(src0)
         sF = self._shifter(src1)
         dF = self._dstpc(dst)
         def fn():
-            s, _ = sF()
+            s, c = sF()
             r = self.regs[rn] & ~s
-            self.cpsrZ = r == 0
-            self.cpsrN = (r >> 31) & 1
+            f = self._flags
+            self._flags = (flags_logic, r, c, None, f[4] if f[0] is flags_logic else f)
             dF(r)
         return fn
 
     def op_orr(self, i):
         dst, src0, src1 = self._3arg(i)
-        rn = self.reg_numbers[src0]
+        rn = self._regnum(src0)
         sF = self._shifter(src1)
         dF = self._dstpc(dst)
         def fn():
@@ -941,20 +2033,20 @@ class SimARM(object):
 
     def op_orrs(self, i):
         dst, src0, src1 = self._3arg(i)
-        rn = self.reg_numbers[src0]
+        rn = self._regnum(src0)
         sF = self._shifter(src1)
         dF = self._dstpc(dst)
         def fn():
-            s, self.cpsrC = sF()
+            s, c = sF()
             r = self.regs[rn] | s
-            self.cpsrZ = r == 0
-            self.cpsrN = (r >> 31) & 1
+            f = self._flags
+            self._flags = (flags_logic, r, c, None, f[4] if f[0] is flags_logic else f)
             dF(r)
         return fn
 
     def op_and(self, i):
         dst, src0, src1 = self._3arg(i)
-        rn = self.reg_numbers[src0]
+        rn = self._regnum(src0)
         sF = self._shifter(src1)
         dF = self._dstpc(dst)
         def fn():
@@ -965,42 +2057,42 @@ class SimARM(object):
 
     def op_ands(self, i):
         dst, src0, src1 = self._3arg(i)
-        rn = self.reg_numbers[src0]
+        rn = self._regnum(src0)
         sF = self._shifter(src1)
         dF = self._dstpc(dst)
         def fn():
-            s, self.cpsrC = sF()
+            s, c = sF()
             r = self.regs[rn] & s
-            self.cpsrZ = r == 0
-            self.cpsrN = (r >> 31) & 1
+            f = self._flags
+            self._flags = (flags_logic, r, c, None, f[4] if f[0] is flags_logic else f)
             dF(r)
         return fn
 
     def op_tst(self, i):
-        src0, src1 = i.args.split(', ', 1)
-        rn = self.reg_numbers[src0]
+        src0, src1 = self._operands(i)
+        rn = self._regnum(src0)
         sF = self._shifter(src1)
         def fn():
-            s, self.cpsrC = sF()
+            s, c = sF()
             r = self.regs[rn] & s
-            self.cpsrZ = r == 0
-            self.cpsrN = (r >> 31) & 1
+            f = self._flags
+            self._flags = (flags_logic, r, c, None, f[4] if f[0] is flags_logic else f)
         return fn
 
     def op_teq(self, i):
-        src0, src1 = i.args.split(', ', 1)
-        rn = self.reg_numbers[src0]
+        src0, src1 = self._operands(i)
+        rn = self._regnum(src0)
         sF = self._shifter(src1)
         def fn():
-            s, self.cpsrC = sF()
+            s, c = sF()
             r = self.regs[rn] ^ s
-            self.cpsrZ = r == 0
-            self.cpsrN = (r >> 31) & 1
+            f = self._flags
+            self._flags = (flags_logic, r, c, None, f[4] if f[0] is flags_logic else f)
         return fn
 
     def op_eor(self, i):
         dst, src0, src1 = self._3arg(i)
-        rn = self.reg_numbers[src0]
+        rn = self._regnum(src0)
         sF = self._shifter(src1)
         dF = self._dstpc(dst)
         def fn():
@@ -1009,20 +2101,20 @@ class SimARM(object):
 
     def op_eors(self, i):
         dst, src0, src1 = self._3arg(i)
-        rn = self.reg_numbers[src0]
+        rn = self._regnum(src0)
         sF = self._shifter(src1)
         dF = self._dstpc(dst)
         def fn():
-            s, self.cpsrC = sF()
+            s, c = sF()
             r = self.regs[rn] ^ s
-            self.cpsrZ = r == 0
-            self.cpsrN = (r >> 31) & 1
+            f = self._flags
+            self._flags = (flags_logic, r, c, None, f[4] if f[0] is flags_logic else f)
             dF(r)
         return fn
 
     def op_add(self, i):
         dst, src0, src1 = self._3arg(i)
-        rn = self.reg_numbers[src0]
+        rn = self._regnum(src0)
         sF = self._shifter(src1)
         dF = self._dstpc(dst)
         def fn():
@@ -1031,23 +2123,20 @@ class SimARM(object):
 
     def op_adds(self, i):
         dst, src0, src1 = self._3arg(i)
-        rn = self.reg_numbers[src0]
+        rn = self._regnum(src0)
         sF = self._shifter(src1)
         dF = self._dstpc(dst)
         def fn():
             a = self.regs[rn]
             b, _ = sF()
             r = a + b
-            self.cpsrN = (r >> 31) & 1
-            self.cpsrZ = not (r & 0xffffffff)
-            self.cpsrC = r > 0xffffffff
-            self.cpsrV = ((a >> 31) & 1) == ((b >> 31) & 1) and ((a >> 31) & 1) != ((r >> 31) & 1) and ((b >> 31) & 1) != ((r >> 31) & 1)
+            self._flags = (flags_add, r, a, b, None)
             dF(r)
         return fn
 
     def op_adc(self, i):
         dst, src0, src1 = self._3arg(i)
-        rn = self.reg_numbers[src0]
+        rn = self._regnum(src0)
         sF = self._shifter(src1)
         dF = self._dstpc(dst)
         def fn():
@@ -1056,23 +2145,20 @@ class SimARM(object):
 
     def op_adcs(self, i):
         dst, src0, src1 = self._3arg(i)
-        rn = self.reg_numbers[src0]
+        rn = self._regnum(src0)
         sF = self._shifter(src1)
         dF = self._dstpc(dst)
         def fn():
             a = self.regs[rn]
             b, _ = sF()
             r = a + b + (self.cpsrC & 1)
-            self.cpsrN = (r >> 31) & 1
-            self.cpsrZ = not (r & 0xffffffff)
-            self.cpsrC = r > 0xffffffff
-            self.cpsrV = ((a >> 31) & 1) == ((b >> 31) & 1) and ((a >> 31) & 1) != ((r >> 31) & 1) and ((b >> 31) & 1) != ((r >> 31) & 1)
+            self._flags = (flags_add, r, a, b, None)
             dF(r)
         return fn
 
     def op_sub(self, i):
         dst, src0, src1 = self._3arg(i)
-        rn = self.reg_numbers[src0]
+        rn = self._regnum(src0)
         sF = self._shifter(src1)
         dF = self._dstpc(dst)
         def fn():
@@ -1081,23 +2167,20 @@ class SimARM(object):
 
     def op_subs(self, i):
         dst, src0, src1 = self._3arg(i)
-        rn = self.reg_numbers[src0]
+        rn = self._regnum(src0)
         sF = self._shifter(src1)
         dF = self._dstpc(dst)
         def fn():
             a = self.regs[rn]
             b, _ = sF()
             r = a - b
-            self.cpsrN = (r >> 31) & 1
-            self.cpsrZ = not (r & 0xffffffff)
-            self.cpsrC = (a & 0xffffffff) >= (b & 0xffffffff)
-            self.cpsrV = ((a >> 31) & 1) != ((b >> 31) & 1) and ((a >> 31) & 1) != ((r >> 31) & 1)
+            self._flags = (flags_sub, r, a, b, None)
             dF(r)
         return fn
 
     def op_sbc(self, i):
         dst, src0, src1 = self._3arg(i)
-        rn = self.reg_numbers[src0]
+        rn = self._regnum(src0)
         sF = self._shifter(src1)
         dF = self._dstpc(dst)
         def fn():
@@ -1106,23 +2189,20 @@ class SimARM(object):
 
     def op_sbcs(self, i):
         dst, src0, src1 = self._3arg(i)
-        rn = self.reg_numbers[src0]
+        rn = self._regnum(src0)
         sF = self._shifter(src1)
         dF = self._dstpc(dst)
         def fn():
             a = self.regs[rn]
             b, _ = sF()
             r = a - b + self.cpsrC - 1
-            self.cpsrN = (r >> 31) & 1
-            self.cpsrZ = not (r & 0xffffffff)
-            self.cpsrC = (a & 0xffffffff) >= (b & 0xffffffff)
-            self.cpsrV = ((a >> 31) & 1) != ((b >> 31) & 1) and ((a >> 31) & 1) != ((r >> 31) & 1)
+            self._flags = (flags_sub, r, a, b, None)
             dF(r)
         return fn
 
     def op_rsb(self, i):
         dst, src0, src1 = self._3arg(i)
-        rn = self.reg_numbers[src0]
+        rn = self._regnum(src0)
         sF = self._shifter(src1)
         dF = self._dstpc(dst)
         def fn():
@@ -1131,52 +2211,43 @@ class SimARM(object):
 
     def op_rsbs(self, i):
         dst, src0, src1 = self._3arg(i)
-        rn = self.reg_numbers[src0]
+        rn = self._regnum(src0)
         sF = self._shifter(src1)
         dF = self._dstpc(dst)
         def fn():
             b = self.regs[rn]
             a, _ = sF()
             r = a - b
-            self.cpsrN = (r >> 31) & 1
-            self.cpsrZ = not (r & 0xffffffff)
-            self.cpsrC = (a & 0xffffffff) >= (b & 0xffffffff)
-            self.cpsrV = ((a >> 31) & 1) != ((b >> 31) & 1) and ((a >> 31) & 1) != ((r >> 31) & 1)
+            self._flags = (flags_sub, r, a, b, None)
             dF(r)
         return fn
 
     def op_cmp(self, i):
-        src0, src1 = i.args.split(', ', 1)
-        rn = self.reg_numbers[src0]
+        src0, src1 = self._operands(i)
+        rn = self._regnum(src0)
         sF = self._shifter(src1)
         def fn():
             a = self.regs[rn]
             b, _ = sF()
             r = a - b
-            self.cpsrN = (r >> 31) & 1
-            self.cpsrZ = not (r & 0xffffffff)
-            self.cpsrC = (a & 0xffffffff) >= (b & 0xffffffff)
-            self.cpsrV = ((a >> 31) & 1) != ((b >> 31) & 1) and ((a >> 31) & 1) != ((r >> 31) & 1)
+            self._flags = (flags_sub, r, a, b, None)
         return fn
 
     def op_cmn(self, i):
-        src0, src1 = i.args.split(', ', 1)
-        rn = self.reg_numbers[src0]
+        src0, src1 = self._operands(i)
+        rn = self._regnum(src0)
         sF = self._shifter(src1)
         def fn():
             a = self.regs[rn]
             b, _ = sF()
             r = a + b
-            self.cpsrN = (r >> 31) & 1
-            self.cpsrZ = not (r & 0xffffffff)
-            self.cpsrC = r > 0xffffffff
-            self.cpsrV = ((a >> 31) & 1) == ((b >> 31) & 1) and ((a >> 31) & 1) != ((r >> 31) & 1) and ((b >> 31) & 1) != ((r >> 31) & 1)
+            self._flags = (flags_add, r, a, b, None)
         return fn
 
     def op_lsl(self, i):
         dst, src0, src1 = self._3arg(i)
         fD = self._dstpc(dst)
-        n0 = self.reg_numbers[src0]
+        n0 = self._regnum(src0)
         f1 = self._reg_or_literal(src1)
         def fn():
             fD(lsl(self.regs[n0], f1())[0])
@@ -1185,19 +2256,19 @@ class SimARM(object):
     def op_lsls(self, i):
         dst, src0, src1 = self._3arg(i)
         fD = self._dstpc(dst)
-        n0 = self.reg_numbers[src0]
+        n0 = self._regnum(src0)
         f1 = self._reg_or_literal(src1)
         def fn():
-            r, self.cpsrC = lsl(self.regs[n0], f1())
-            self.cpsrZ = not (r & 0xffffffff)
-            self.cpsrN = (r >> 31) & 1
+            r, c = lsl(self.regs[n0], f1())
+            f = self._flags
+            self._flags = (flags_logic, r, c, None, f[4] if f[0] is flags_logic else f)
             fD(r)
         return fn
 
     def op_lsr(self, i):
         dst, src0, src1 = self._3arg(i)
         fD = self._dstpc(dst)
-        n0 = self.reg_numbers[src0]
+        n0 = self._regnum(src0)
         f1 = self._reg_or_literal(src1)
         def fn():
             fD(lsr(self.regs[n0], f1())[0])
@@ -1206,19 +2277,19 @@ class SimARM(object):
     def op_lsrs(self, i):
         dst, src0, src1 = self._3arg(i)
         fD = self._dstpc(dst)
-        n0 = self.reg_numbers[src0]
+        n0 = self._regnum(src0)
         f1 = self._reg_or_literal(src1)
         def fn():
-            r, self.cpsrC = lsr(self.regs[n0], f1())
-            self.cpsrZ = not (r & 0xffffffff)
-            self.cpsrN = (r >> 31) & 1
+            r, c = lsr(self.regs[n0], f1())
+            f = self._flags
+            self._flags = (flags_logic, r, c, None, f[4] if f[0] is flags_logic else f)
             fD(r)
         return fn
 
     def op_asr(self, i):
         dst, src0, src1 = self._3arg(i)
         fD = self._dstpc(dst)
-        n0 = self.reg_numbers[src0]
+        n0 = self._regnum(src0)
         f1 = self._reg_or_literal(src1)
         def fn():
             fD(asr(self.regs[n0], f1())[0])
@@ -1227,19 +2298,19 @@ class SimARM(object):
     def op_asrs(self, i):
         dst, src0, src1 = self._3arg(i)
         fD = self._dstpc(dst)
-        n0 = self.reg_numbers[src0]
+        n0 = self._regnum(src0)
         f1 = self._reg_or_literal(src1)
         def fn():
-            r, self.cpsrC = asr(self.regs[n0], f1())
-            self.cpsrZ = not (r & 0xffffffff)
-            self.cpsrN = (r >> 31) & 1
+            r, c = asr(self.regs[n0], f1())
+            f = self._flags
+            self._flags = (flags_logic, r, c, None, f[4] if f[0] is flags_logic else f)
             fD(r)
         return fn
 
     def op_rol(self, i):
         dst, src0, src1 = self._3arg(i)
         fD = self._dstpc(dst)
-        n0 = self.reg_numbers[src0]
+        n0 = self._regnum(src0)
         f1 = self._reg_or_literal(src1)
         def fn():
             fD(rol(self.regs[n0], f1())[0])
@@ -1248,19 +2319,19 @@ class SimARM(object):
     def op_rols(self, i):
         dst, src0, src1 = self._3arg(i)
         fD = self._dstpc(dst)
-        n0 = self.reg_numbers[src0]
+        n0 = self._regnum(src0)
         f1 = self._reg_or_literal(src1)
         def fn():
-            r, self.cpsrC = rol(self.regs[n0], f1())
-            self.cpsrZ = not (r & 0xffffffff)
-            self.cpsrN = (r >> 31) & 1
+            r, c = rol(self.regs[n0], f1())
+            f = self._flags
+            self._flags = (flags_logic, r, c, None, f[4] if f[0] is flags_logic else f)
             fD(r)
         return fn
 
     def op_ror(self, i):
         dst, src0, src1 = self._3arg(i)
         fD = self._dstpc(dst)
-        n0 = self.reg_numbers[src0]
+        n0 = self._regnum(src0)
         f1 = self._reg_or_literal(src1)
         def fn():
             fD(ror(self.regs[n0], f1())[0])
@@ -1269,19 +2340,19 @@ class SimARM(object):
     def op_rors(self, i):
         dst, src0, src1 = self._3arg(i)
         fD = self._dstpc(dst)
-        n0 = self.reg_numbers[src0]
+        n0 = self._regnum(src0)
         f1 = self._reg_or_literal(src1)
         def fn():
-            r, self.cpsrC = ror(self.regs[n0], f1())
-            self.cpsrZ = not (r & 0xffffffff)
-            self.cpsrN = (r >> 31) & 1
+            r, c = ror(self.regs[n0], f1())
+            f = self._flags
+            self._flags = (flags_logic, r, c, None, f[4] if f[0] is flags_logic else f)
             fD(r)
         return fn
 
     def op_rrx(self, i):
         dst, src0, src1 = self._3arg(i)
         fD = self._dstpc(dst)
-        n0 = self.reg_numbers[src0]
+        n0 = self._regnum(src0)
         f1 = self._reg_or_literal(src1)
         def fn():
             fD(rrx(self.regs[n0], f1(), self.cpsrC)[0])
@@ -1290,18 +2361,18 @@ class SimARM(object):
     def op_rrxs(self, i):
         dst, src0, src1 = self._3arg(i)
         fD = self._dstpc(dst)
-        n0 = self.reg_numbers[src0]
+        n0 = self._regnum(src0)
         f1 = self._reg_or_literal(src1)
         def fn():
-            r, self.cpsrC = rrx(self.regs[n0], f1(), self.cpsrC)
-            self.cpsrZ = not (r & 0xffffffff)
-            self.cpsrN = (r >> 31) & 1
+            r, c = rrx(self.regs[n0], f1(), self.cpsrC)
+            f = self._flags
+            self._flags = (flags_logic, r, c, None, f[4] if f[0] is flags_logic else f)
             fD(r)
         return fn
 
     def op_mul(self, i):
         dst, src0, src1 = self._3arg(i)
-        rn = self.reg_numbers[src0]
+        rn = self._regnum(src0)
         sF = self._shifter(src1)
         dF = self._dstpc(dst)
         def fn():
@@ -1310,45 +2381,43 @@ class SimARM(object):
 
     def op_muls(self, i):
         dst, src0, src1 = self._3arg(i)
-        rn = self.reg_numbers[src0]
+        rn = self._regnum(src0)
         sF = self._shifter(src1)
         dF = self._dstpc(dst)
         def fn():
             a = self.regs[rn]
             b, _ = sF()
             r = a * b
-            self.cpsrN = (r >> 31) & 1
-            self.cpsrZ = not (r & 0xffffffff)
+            self._flags = (flags_set, (r >> 31) & 1, not (r & 0xffffffff)) + self.nzcv[2:]
             dF(r)
         return fn
 
     def op_mla(self, i):
-        dst, Rm, Rs, Rn = i.args.split(', ')
-        nRm = self.reg_numbers[Rm]
-        nRs = self.reg_numbers[Rs]
-        nRn = self.reg_numbers[Rn]
+        dst, Rm, Rs, Rn = self._operands(i)
+        nRm = self._regnum(Rm)
+        nRs = self._regnum(Rs)
+        nRn = self._regnum(Rn)
         dF = self._dstpc(dst)
         def fn():
             dF(self.regs[nRm] * self.regs[nRs] + self.regs[nRn])
         return fn
 
     def op_mlas(self, i):
-        dst, Rm, Rs, Rn = i.args.split(', ')
-        nRm = self.reg_numbers[Rm]
-        nRs = self.reg_numbers[Rs]
-        nRn = self.reg_numbers[Rn]
+        dst, Rm, Rs, Rn = self._operands(i)
+        nRm = self._regnum(Rm)
+        nRs = self._regnum(Rs)
+        nRn = self._regnum(Rn)
         dF = self._dstpc(dst)
         def fn():
             r = self.regs[nRm] * self.regs[nRs] + self.regs[nRn]
-            self.cpsrN = (r >> 31) & 1
-            self.cpsrZ = not (r & 0xffffffff)
+            self._flags = (flags_set, (r >> 31) & 1, not (r & 0xffffffff)) + self.nzcv[2:]
             dF(r)
         return fn
 
     def op_umull(self, i):
-        dstLo, dstHi, Rm, Rs = i.args.split(', ')
-        nRm = self.reg_numbers[Rm]
-        nRs = self.reg_numbers[Rs]
+        dstLo, dstHi, Rm, Rs = self._operands(i)
+        nRm = self._regnum(Rm)
+        nRs = self._regnum(Rs)
         dlF = self._dstpc(dstLo)
         dhF = self._dstpc(dstHi)
         def fn():
@@ -1358,36 +2427,36 @@ class SimARM(object):
         return fn
 
     def op_umulls(self, i):
-        dstLo, dstHi, Rm, Rs = i.args.split(', ')
-        nRm = self.reg_numbers[Rm]
-        nRs = self.reg_numbers[Rs]
+        dstLo, dstHi, Rm, Rs = self._operands(i)
+        nRm = self._regnum(Rm)
+        nRs = self._regnum(Rs)
         dlF = self._dstpc(dstLo)
         dhF = self._dstpc(dstHi)
         def fn():
-            r = self.regs[Rm] * self.regs[Rs]
-            self.cpsrN = (r >> 64) & 1
-            self.cpsrZ = not r
+            r = self.regs[nRm] * self.regs[nRs]
+            self._flags = (flags_set, (r >> 63) & 1, not r) + self.nzcv[2:]
             dlF(r)
             dhF(r >> 32)
         return fn
 
     def op_msr(self, i):
         """Stub"""
-        dst, src = i.args.split(', ')
+        dst, src = self._operands(i)
         def fn():
             pass
         return fn
 
     def op_mrs(self, i):
-        """Stub"""
-        dst, src = i.args.split(', ')
+        """Stub, only the condition flags are real"""
+        dst, src = self._operands(i)
         dF = self._dstpc(dst)
         def fn():
-            dF(0x5d5d5d5d)
+            n, z, c, v = self.nzcv
+            dF(0x0d5d5d5d | (bool(n) << 31) | (bool(z) << 30) | (bool(c) << 29) | (bool(v) << 28))
         return fn
 
     def op_clz(self, i):
-        dst, src = i.args.split(', ', 1)
+        dst, src = self._operands(i)
         dF = self._dstpc(dst)
         sF = self._shifter(src)
         def fn():
@@ -1402,7 +2471,7 @@ class SimARM(object):
         return fn
 
     def op_neg(self, i):
-        dst, src = i.args.split(', ', 1)
+        dst, src = self._operands(i)
         sF = self._shifter(src)
         dF = self._dstpc(dst)
         def fn():
@@ -1410,16 +2479,13 @@ class SimARM(object):
         return fn
 
     def op_negs(self, i):
-        dst, src = i.args.split(', ', 1)
+        dst, src = self._operands(i)
         sF = self._shifter(src)
         dF = self._dstpc(dst)
         def fn():
             a = 0
             b, _ = sF()
             r = a - b
-            self.cpsrN = (r >> 31) & 1
-            self.cpsrZ = not (r & 0xffffffff)
-            self.cpsrC = (a & 0xffffffff) >= (b & 0xffffffff)
-            self.cpsrV = ((a >> 31) & 1) != ((b >> 31) & 1) and ((a >> 31) & 1) != ((r >> 31) & 1)
+            self._flags = (flags_sub, r, a, b, None)
             dF(r)
         return fn
@@ -0,0 +1,148 @@
+# Code coverage for the ARM simulator.
+#
+# Every SimARM has a Coverage bitmap in arm.coverage, with one bit per
+# halfword of the 2 MB flash. It's marked a whole translated block at a time,
+# the first time the block runs all the way through, so blocks cost nothing
+# to track after that and it can stay on all the time. Instructions run one
+# at a time, and blocks cut short by a fault or watchpoint, are marked only
+# as far as they actually ran. Assigning a new Coverage to arm.coverage
+# throws the cached blocks away so they get marked again.
+#
+# Coverage from different runs can be merged and diffed, listed as address
+# ranges, saved and loaded, and drawn as a PNG along a Hilbert curve like
+# memsquare.py does for memory.
+
+__all__ = [ 'Coverage' ]
+
+import struct
+from array import array
+import png
+
+# Set bits in each byte value
+popcount = [ bin(b).count('1') for b in range(256) ]
+
+
+class Coverage(object):
+    """Bitmap of halfwords we've run code from, covering 'size' bytes at 'base'"""
+
+    magic = 'SimARM coverage v1\n'
+
+    def __init__(self, base = 0, size = 0x200000):
+        self.base = base
+        self.size = size
+        self.bits = array('B', [0]) * (size // 16)
+
+    def __repr__(self):
+        return '<Coverage %08x-%08x, %d bytes of code in %d ranges>' % (
+            self.base, self.base + self.size - 1, self.count() * 2, len(self.ranges()))
+
+    def __contains__(self, address):
+        n = (address - self.base) >> 1
+        return 0 <= n < self.size // 2 and bool(self.bits[n >> 3] & (1 << (n & 7)))
+
+    def _check(self, other):
+        if (other.base, other.size) != (self.base, self.size):
+            raise ValueError("Coverage maps for different address ranges")
+
+    def mark(self, begin, end):
+        """Mark the addresses from 'begin' up to but not including 'end'"""
+        bits = self.bits
+        first = max(0, (begin - self.base) >> 1)
+        last = min(self.size // 2, (end - self.base + 1) >> 1)
+        for n in xrange(first, last):
+            bits[n >> 3] |= 1 << (n & 7)
+
+    def count(self):
+        """Number of halfwords covered"""
+        return sum(popcount[b] for b in self.bits)
+
+    def copy(self):
+        c = Coverage(self.base, self.size)
+        c.bits = array('B', self.bits)
+        return c
+
+    def merge(self, other):
+        """Add everything 'other' covers to this map"""
+        self._check(other)
+        bits = self.bits
+        for i, b in enumerate(other.bits):
+            if b:
+                bits[i] |= b
+        return self
+
+    def diff(self, other):
+        """A new Coverage, with what we cover and 'other' doesn't"""
+        self._check(other)
+        c = self.copy()
+        bits = c.bits
+        for i, b in enumerate(other.bits):
+            if b:
+                bits[i] &= ~b
+        return c
+
+    def ranges(self):
+        """Covered code as a list of inclusive (begin, end) address ranges"""
+        ranges = []
+        start = None
+        for i, b in enumerate(self.bits):
+            if b == (0xff if start is not None else 0):
+                continue
+            for j in range(8):
+                covered = b & (1 << j)
+                if covered and start is None:
+                    start = (i << 3) | j
+                elif start is not None and not covered:
+                    ranges.append((self.base + 2 * start, self.base + 2 * ((i << 3) | j) - 1))
+                    start = None
+        if start is not None:
+            ranges.append((self.base + 2 * start, self.base + self.size - 1))
+        return ranges
+
+    def write_ranges(self, filename):
+        """Save the covered ranges as text, one per line"""
+        with open(filename, 'w') as f:
+            for begin, end in self.ranges():
+                f.write('%08x-%08x %d\n' % (begin, end, end + 1 - begin))
+
+    def save(self, filename):
+        with open(filename, 'wb') as f:
+            f.write(self.magic + struct.pack('<II', self.base, self.size) + self.bits.tostring())
+
+    @classmethod
+    def load(cls, filename):
+        with open(filename, 'rb') as f:
+            data = f.read()
+        if not data.startswith(cls.magic):
+            raise ValueError("%s isn't a coverage file" % filename)
+        base, size = struct.unpack_from('<II', data, len(cls.magic))
+        c = cls(base, size)
+        c.bits = array('B', data[len(cls.magic) + 8:])
+        if len(c.bits) != size // 16:
+            raise ValueError("%s is truncated" % filename)
+        return c
+
+    def write_png(self, filename, pixelsize = 1024):
+        """Draw coverage as a square greyscale image, following a 2D Hilbert curve.
+        Each pixel is an equal share of the halfwords, brighter for more coverage.
+        """
+        # Compiled extension, only needed here
+        from hilbert import hilbert
+
+        per_pixel = max(1, self.size // 2 // (pixelsize * pixelsize))
+        scale = 255.0 / per_pixel
+        bits = self.bits
+        rows = []
+        for y in xrange(pixelsize):
+            row = []
+            for x in xrange(pixelsize):
+                n = hilbert(x, y, pixelsize) * per_pixel
+                covered = 0
+                for k in xrange(n, min(n + per_pixel, self.size // 2)):
+                    if bits[k >> 3] & (1 << (k & 7)):
+                        covered += 1
+                row.append(int(covered * scale + 0.5))
+            rows.append(row)
+
+        w = png.Writer(pixelsize, pixelsize, greyscale=True)
+        with open(filename, 'wb') as f:
+            w.write(f, rows)
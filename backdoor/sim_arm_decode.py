@@ -0,0 +1,697 @@
+# In-process instruction decoder for the ARM simulator.
+#
+# This covers the armv5t ARM and Thumb instruction sets. Each instruction
+# comes out with its operands two ways: as text in the same syntax objdump
+# gives us (unified syntax, standard register names), for trace logs and
+# anything else that reads disassembly, and as a tuple of structured operands
+# that SimARM's op_ handlers use directly, without parsing anything.
+#
+# Operands in the tuple are:
+#
+#   r0-pc                 register number, an int
+#   rN!                   ('wb', n)
+#   #imm                  ('imm', value)
+#   -rN                   ('neg', operand), in memory offsets
+#   rN, lsl #2            ('shift', operand, 'lsl', amount); amount is None for rrx
+#   [rN, ...]             ('mem', base, offset, post-index offset, writeback)
+#   {r0, r1}              ('list', (0, 1), '^' or '')
+#   0x1234, 12            ('addr', value), for branch targets and other numbers
+#
+# Anything else, like 'CPSR_fc' or 'p15', stays a string. Code that went
+# through the assembler comes back from objdump as text only, and
+# parse_operands() turns that into the same tuple.
+#
+# The difference from objdump is speed: no temp files, no subprocesses, and
+# no parsing. Decoding a fresh block of flash costs microseconds.
+
+__all__ = [ 'decode_lines', 'decode_string', 'parse_operands' ]
+
+import struct
+
+
+reg_names = ('r0', 'r1', 'r2', 'r3', 'r4', 'r5', 'r6', 'r7',
+             'r8', 'r9', 'sl', 'fp', 'ip', 'sp', 'lr', 'pc')
+
+# Every name SimARM accepts for a register
+reg_numbers = dict(('r%d' % i, i) for i in range(16))
+reg_numbers.update((name, i) for i, name in enumerate(reg_names))
+reg_numbers.update((name, i) for i, name in enumerate(('a1', 'a2', 'a3', 'a4', 'v1', 'v2', 'v3', 'v4', 'v5', 'sb')))
+
+cond_names = ('eq', 'ne', 'cs', 'cc', 'mi', 'pl', 'vs', 'vc',
+              'hi', 'ls', 'ge', 'lt', 'gt', 'le', '', 'nv')
+
+shift_names = ('lsl', 'lsr', 'asr', 'ror')
+
+dp_names = ('and', 'eor', 'sub', 'rsb', 'add', 'adc', 'sbc', 'rsc',
+            'tst', 'teq', 'cmp', 'cmn', 'orr', 'mov', 'bic', 'mvn')
+
+thumb_alu_names = ('ands', 'eors', 'lsls', 'lsrs', 'asrs', 'adcs', 'sbcs', 'rors',
+                   'tst', 'negs', 'cmp', 'cmn', 'orrs', 'muls', 'bics', 'mvns')
+
+thumb_ldst_names = ('str', 'strh', 'strb', 'ldrsb', 'ldr', 'ldrh', 'ldrb', 'ldrsh')
+
+
+class decoded_instruction:
+    """One decoded instruction, with the same attributes as the objects
+    returned by code.disassembly_lines(), plus 'next_address' and 'operands'.
+    Instructions from an older DecodeCache have None for 'operands'.
+    """
+    # SimARMMemory copies an instruction before giving it an HLE marker
+    hle = None
+
+    def __init__(self, address, size, op, args = '', comment = '', operands = None):
+        self.address = address
+        self.next_address = address + size
+        self.op = op
+        self.args = args
+        self.comment = comment
+        self.operands = operands
+
+    def __str__(self):
+        return '\t%s\t%s' % (self.op, self.args)
+
+    def __repr__(self):
+        return 'decoded_instruction(address=%08x, op=%r, args=%r, comment=%r)' % (
+            self.address, self.op, self.args, self.comment)
+
+
+def decode_lines(data, address = 0, thumb = True):
+    """Decode a string of machine code into a list of instruction objects.
+
+    Compatible with disassembly_lines(disassemble_string(data, address, thumb)).
+    Any trailing partial instruction is ignored.
+    """
+    if thumb:
+        return decode_thumb(data, address)
+    else:
+        return decode_arm(data, address)
+
+
+def decode_string(data, address = 0, thumb = True):
+    """Decode machine code into text, in the same format as disassemble_string()"""
+    lines = []
+    for instr in decode_lines(data, address, thumb):
+        line = '%08x\t%s\t%s' % (instr.address, instr.op, instr.args)
+        if instr.comment:
+            line += '\t; ' + instr.comment
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+def parse_operands(args):
+    """Structured operands for text in objdump's syntax, as the decoder would give them"""
+    items = [ parse_operand(t) for t in split_operands(args) ]
+
+    # Shifts and rotations go with the operand before them
+    folded = []
+    for t, item in items:
+        prev = folded[-1] if folded else None
+        if isinstance(item, tuple) and item[0] == 'shiftop' and folded and prev_shiftable(prev):
+            folded[-1] = shifted(prev, item[1], item[2])
+        elif isinstance(item, tuple) and item[0] == 'addr' and isinstance(prev, tuple) and prev[0] == 'imm':
+            folded[-1] = ('shift', prev, 'ror', ('imm', item[1]))
+        elif isinstance(item, tuple) and item[0] == 'shiftop':
+            folded.append(t)
+        else:
+            folded.append(item)
+
+    # And so do post-index offsets, after a memory operand
+    operands = []
+    for item in folded:
+        prev = operands[-1] if operands else None
+        if (isinstance(prev, tuple) and prev[0] == 'mem' and prev[2] is None and prev[3] is None
+                and not prev[4] and is_offset(item)):
+            operands[-1] = prev[:3] + (item, False)
+        else:
+            operands.append(item)
+    return tuple(operands)
+
+
+def split_operands(args):
+    # Split on the commas that aren't inside brackets or braces
+    parts = []
+    depth = 0
+    start = 0
+    for i, ch in enumerate(args):
+        if ch in '[{':
+            depth += 1
+        elif ch in ']}':
+            depth -= 1
+        elif ch == ',' and depth == 0:
+            parts.append(args[start:i].strip())
+            start = i + 1
+    if args.strip():
+        parts.append(args[start:].strip())
+    return parts
+
+
+def parse_operand(t):
+    # Returns (text, operand). Shifts come back as ('shiftop', kind, amount)
+    # until they're folded into the operand they belong to.
+    if t in reg_numbers:
+        return t, reg_numbers[t]
+    if t[:1] == '#':
+        n = parse_number(t[1:])
+        return t, (t if n is None else ('imm', n))
+    if t[-1:] == '!' and t[:-1] in reg_numbers:
+        return t, ('wb', reg_numbers[t[:-1]])
+    if t[:1] == '-' and t[1:] in reg_numbers:
+        return t, ('neg', reg_numbers[t[1:]])
+    if t[:1] == '[':
+        return t, parse_memory(t)
+    if t[:1] == '{':
+        return t, parse_reglist(t)
+    if t == 'rrx':
+        return t, ('shiftop', 'rrx', None)
+    words = t.split(' ')
+    if len(words) == 2 and words[0] in shift_names + ('rol',):
+        amount = parse_operand(words[1])[1]
+        if amount in reg_numbers.values() or (isinstance(amount, tuple) and amount[0] == 'imm'):
+            return t, ('shiftop', words[0], amount)
+        return t, t
+    n = parse_number(t)
+    return t, (t if n is None else ('addr', n))
+
+
+def parse_number(t):
+    try:
+        return int(t, 0)
+    except ValueError:
+        return None
+
+
+def parse_memory(t):
+    writeback = t.endswith('!')
+    inner = t.rstrip('!')
+    if not inner.endswith(']'):
+        return t
+    parts = parse_operands(inner[1:-1])
+    if not parts or not (isinstance(parts[0], int) and not isinstance(parts[0], bool)):
+        return t
+    if len(parts) == 1:
+        return ('mem', parts[0], None, None, writeback)
+    if len(parts) == 2 and is_offset(parts[1]):
+        return ('mem', parts[0], parts[1], None, writeback)
+    return t
+
+
+def parse_reglist(t):
+    user = t.endswith('^')
+    inner = t.rstrip('^')
+    if not inner.endswith('}'):
+        return t
+    regs = split_operands(inner[1:-1])
+    if not all(r in reg_numbers for r in regs):
+        return t
+    return ('list', tuple(reg_numbers[r] for r in regs), ('', '^')[user])
+
+
+def is_offset(item):
+    # Can this be an offset in a memory operand?
+    if isinstance(item, tuple):
+        return item[0] in ('imm', 'neg', 'shift')
+    return isinstance(item, int)
+
+
+def prev_shiftable(item):
+    if isinstance(item, tuple):
+        return item[0] in ('imm', 'neg') and (item[0] != 'neg' or isinstance(item[1], int))
+    return isinstance(item, int)
+
+
+def shifted(item, kind, amount):
+    if isinstance(item, tuple) and item[0] == 'neg':
+        return ('neg', ('shift', item[1], kind, amount))
+    return ('shift', item, kind, amount)
+
+
+def reglist(mask):
+    regs = tuple(i for i in range(16) if mask & (1 << i))
+    return '{%s}' % ', '.join(reg_names[i] for i in regs), ('list', regs, '')
+
+
+def imm(value):
+    return '#%d' % value, ('imm', value)
+
+
+def addr(value, format = '0x%08x'):
+    return format % value, ('addr', value)
+
+
+def reg(n):
+    return reg_names[n], n
+
+
+def instruction(address, size, op, parts = (), comment = ''):
+    # Instruction with (text, operand) pairs for its operands
+    return decoded_instruction(address, size, op, ', '.join(t for t, o in parts), comment,
+                               tuple(o for t, o in parts))
+
+
+def sign_extend(value, bits):
+    sign = 1 << (bits - 1)
+    return (value & (sign - 1)) - (value & sign)
+
+
+def arm_shifter_reg(word):
+    # Register operand with optional shift, from bits [11:0]
+    m = word & 15
+    rm = reg_names[m]
+    stype = (word >> 5) & 3
+    shift = shift_names[stype]
+    if word & 0x10:
+        s = (word >> 8) & 15
+        return '%s, %s %s' % (rm, shift, reg_names[s]), ('shift', m, shift, s)
+    amount = (word >> 7) & 31
+    if amount == 0:
+        if stype == 0:
+            return rm, m
+        if stype == 3:
+            return '%s, rrx' % rm, ('shift', m, 'rrx', None)
+        amount = 32
+    return '%s, %s #%d' % (rm, shift, amount), ('shift', m, shift, ('imm', amount))
+
+
+def arm_address(word, address, offset, writeback_ok = True):
+    # The addressing mode for a load or store, as (text, operand, comment).
+    # 'offset' is the (text, operand) offset, without a sign.
+    rn = (word >> 16) & 15
+    pre = word & (1 << 24)
+    up = word & (1 << 23)
+    writeback = word & (1 << 21)
+    offset = signed_offset(offset, up)
+
+    if not pre:
+        return '[%s], %s' % (reg_names[rn], offset[0]), ('mem', rn, None, offset[1], False), ''
+
+    comment = ''
+    text, operand = offset
+    if text == '#0':
+        text = '[%s]' % reg_names[rn]
+        offset = None
+    else:
+        text = '[%s, %s]' % (reg_names[rn], text)
+        offset = operand
+    wb = bool(writeback and writeback_ok)
+    if wb:
+        text += '!'
+    elif rn == 15 and isinstance(operand, tuple) and operand[0] == 'imm':
+        comment = '(0x%08x)' % ((address + 8 + operand[1]) & 0xffffffff)
+    return text, ('mem', rn, offset, None, wb), comment
+
+
+def signed_offset(offset, up):
+    text, operand = offset
+    if up:
+        return offset
+    if text.startswith('#'):
+        return '#-' + text[1:], ('imm', -operand[1])
+    return '-' + text, ('neg', operand)
+
+
+def decode_arm(data, address):
+    lines = []
+    count = len(data) // 4
+    for i, word in enumerate(struct.unpack('<%dI' % count, data[:count * 4])):
+        lines.append(decode_arm_word(word, address + i * 4))
+    return lines
+
+
+def decode_arm_word(word, address):
+    cond = word >> 28
+    c = cond_names[cond]
+    rn = reg((word >> 16) & 15)
+    rd = reg((word >> 12) & 15)
+    rm = reg(word & 15)
+    rs = reg((word >> 8) & 15)
+    op = (word >> 25) & 7
+
+    if cond == 15:
+        if (word & 0x0e000000) == 0x0a000000:
+            # BLX immediate, always switches to Thumb
+            offset = (sign_extend(word & 0xffffff, 24) << 2) | ((word >> 23) & 2)
+            return instruction(address, 4, 'blx', [ addr((address + 8 + offset) & 0xffffffff) ])
+        if (word & 0x0d70f000) == 0x0550f000:
+            text, operand, comment = arm_load_store_address(word, address)
+            return instruction(address, 4, 'pld', [ (text, operand) ])
+        return undefined(address, 4, word)
+
+    if op == 0:
+        if (word & 0x0fc000f0) == 0x00000090:
+            # Multiply, multiply-accumulate
+            s = ('', 's')[bool(word & 0x00100000)]
+            if word & 0x00200000:
+                return instruction(address, 4, 'mla' + s + c, [ rn, rm, rs, rd ])
+            return instruction(address, 4, 'mul' + s + c, [ rn, rm, rs ])
+
+        if (word & 0x0f8000f0) == 0x00800090:
+            # Long multiply
+            s = ('', 's')[bool(word & 0x00100000)]
+            name = ('umull', 'umlal', 'smull', 'smlal')[(word >> 21) & 3]
+            return instruction(address, 4, name + s + c, [ rd, rn, rm, rs ])
+
+        if (word & 0x0fb00ff0) == 0x01000090:
+            # Swap
+            b = ('', 'b')[bool(word & 0x00400000)]
+            memory = ('[%s]' % rn[0], ('mem', rn[1], None, None, False))
+            return instruction(address, 4, 'swp' + b + c, [ rd, rm, memory ])
+
+        if (word & 0x90) == 0x90:
+            return decode_arm_extra_load_store(word, address, c, rd)
+
+        if (word & 0x01900000) == 0x01000000:
+            return decode_arm_misc(word, address, c, rd, rm)
+
+        return decode_arm_data_processing(word, address, c, rn, rd, arm_shifter_reg(word))
+
+    if op == 1:
+        if (word & 0x01900000) == 0x01000000:
+            if word & 0x00200000:
+                # MSR immediate
+                value = arm_rotated_immediate(word)
+                psr = psr_fields(word)
+                return instruction(address, 4, 'msr' + c, [ (psr, psr), imm(value) ])
+            return undefined(address, 4, word)
+        value = arm_rotated_immediate(word)
+        return decode_arm_data_processing(word, address, c, rn, rd, imm(value))
+
+    if op == 2 or op == 3:
+        if op == 3 and (word & 0x10):
+            return undefined(address, 4, word)
+        load = word & 0x00100000
+        byte = word & 0x00400000
+        name = ('str', 'ldr')[bool(load)] + ('', 'b')[bool(byte)]
+        if not (word & (1 << 24)) and (word & (1 << 21)):
+            name += 't'
+
+        # Single register push and pop
+        if (word & 0x0fff0fff) == 0x052d0004:
+            return instruction(address, 4, 'push' + c, [ reglist(1 << rd[1]) ],
+                '(str %s, [sp, #-4]!)' % rd[0])
+        if (word & 0x0fff0fff) == 0x049d0004:
+            return instruction(address, 4, 'pop' + c, [ reglist(1 << rd[1]) ],
+                '(ldr %s, [sp], #4)' % rd[0])
+
+        text, operand, comment = arm_load_store_address(word, address)
+        return instruction(address, 4, name + c, [ rd, (text, operand) ], comment)
+
+    if op == 4:
+        return decode_arm_block_transfer(word, address, c, rn)
+
+    if op == 5:
+        offset = sign_extend(word & 0xffffff, 24) << 2
+        name = ('b', 'bl')[bool(word & 0x01000000)]
+        return instruction(address, 4, name + c, [ addr((address + 8 + offset) & 0xffffffff) ])
+
+    if op == 6:
+        name = ('stc', 'ldc')[bool(word & 0x00100000)]
+        memory = ('[%s], #%d' % (rn[0], (word & 0xff) * 4),
+                  ('mem', rn[1], None, ('imm', (word & 0xff) * 4), False))
+        return instruction(address, 4, name + c, [ coprocessor(word), coprocessor_reg((word >> 12) & 15), memory ])
+
+    # op == 7
+    if word & 0x01000000:
+        return instruction(address, 4, 'svc' + c, [ addr(word & 0xffffff) ])
+    if word & 0x10:
+        name = ('mcr', 'mrc')[bool(word & 0x00100000)]
+        return instruction(address, 4, name + c, [
+            coprocessor(word), addr((word >> 21) & 7, '%d'), rd, coprocessor_reg((word >> 16) & 15),
+            coprocessor_reg(word & 15), coprocessor_info(word) ])
+    return instruction(address, 4, 'cdp' + c, [
+        coprocessor(word), addr((word >> 20) & 15, '%d'), coprocessor_reg((word >> 12) & 15),
+        coprocessor_reg((word >> 16) & 15), coprocessor_reg(word & 15), coprocessor_info(word) ])
+
+
+def coprocessor(word):
+    t = 'p%d' % ((word >> 8) & 15)
+    return t, t
+
+
+def coprocessor_reg(n):
+    t = 'cr%d' % n
+    return t, t
+
+
+def coprocessor_info(word):
+    t = '{%d}' % ((word >> 5) & 7)
+    return t, t
+
+
+def arm_rotated_immediate(word):
+    imm = word & 0xff
+    rot = ((word >> 8) & 15) * 2
+    return ((imm >> rot) | (imm << (32 - rot))) & 0xffffffff
+
+
+def arm_load_store_address(word, address):
+    if word & (1 << 25):
+        offset = arm_shifter_reg(word)
+    else:
+        offset = imm(word & 0xfff)
+    return arm_address(word, address, offset)
+
+
+def decode_arm_data_processing(word, address, c, rn, rd, operand):
+    opcode = (word >> 21) & 15
+    name = dp_names[opcode]
+    s = ('', 's')[bool(word & 0x00100000)]
+
+    if 8 <= opcode <= 11:
+        # Comparisons always set flags, there's no destination
+        return instruction(address, 4, name + c, [ rn, operand ])
+
+    if opcode == 13:
+        # In unified syntax, shifted moves are written as shift instructions
+        shift = operand[1]
+        if isinstance(shift, tuple) and shift[0] == 'shift':
+            rm = reg(shift[1])
+            if shift[2] == 'rrx':
+                return instruction(address, 4, 'rrx' + s + c, [ rd, rm ])
+            amount = shift[3]
+            if isinstance(amount, tuple):
+                amount = imm(amount[1])
+            else:
+                amount = reg(amount)
+            return instruction(address, 4, shift[2] + s + c, [ rd, rm, amount ])
+        return instruction(address, 4, name + s + c, [ rd, operand ])
+
+    if opcode == 15:
+        return instruction(address, 4, name + s + c, [ rd, operand ])
+
+    return instruction(address, 4, name + s + c, [ rd, rn, operand ])
+
+
+def decode_arm_extra_load_store(word, address, c, rd):
+    sh = (word >> 5) & 3
+    load = word & 0x00100000
+    if load:
+        name = (None, 'ldrh', 'ldrsb', 'ldrsh')[sh]
+    else:
+        name = (None, 'strh', 'ldrd', 'strd')[sh]
+    if not name:
+        return undefined(address, 4, word)
+
+    if word & 0x00400000:
+        offset = imm(((word >> 4) & 0xf0) | (word & 15))
+    else:
+        offset = reg(word & 15)
+    text, operand, comment = arm_address(word, address, offset)
+    return instruction(address, 4, name + c, [ rd, (text, operand) ], comment)
+
+
+def decode_arm_misc(word, address, c, rd, rm):
+    if (word & 0x0ffffff0) == 0x012fff10:
+        return instruction(address, 4, 'bx' + c, [ rm ])
+    if (word & 0x0ffffff0) == 0x012fff30:
+        return instruction(address, 4, 'blx' + c, [ rm ])
+    if (word & 0x0fff0ff0) == 0x016f0f10:
+        return instruction(address, 4, 'clz' + c, [ rd, rm ])
+    if (word & 0x0fbf0fff) == 0x010f0000:
+        psr = ('CPSR', 'SPSR')[bool(word & 0x00400000)]
+        return instruction(address, 4, 'mrs' + c, [ rd, (psr, psr) ])
+    if (word & 0x0fb0fff0) == 0x0120f000:
+        psr = psr_fields(word)
+        return instruction(address, 4, 'msr' + c, [ (psr, psr), rm ])
+    if (word & 0xfff000f0) == 0xe1200070:
+        return instruction(address, 4, 'bkpt', [ addr(((word >> 4) & 0xfff0) | (word & 15), '0x%04x') ])
+    return undefined(address, 4, word)
+
+
+def psr_fields(word):
+    psr = ('CPSR', 'SPSR')[bool(word & 0x00400000)]
+    fields = ''.join(f for bit, f in ((19, 'f'), (18, 's'), (17, 'x'), (16, 'c')) if word & (1 << bit))
+    return '%s_%s' % (psr, fields)
+
+
+def decode_arm_block_transfer(word, address, c, rn):
+    load = word & 0x00100000
+    writeback = word & 0x00200000
+    mode = ('da', 'ia', 'db', 'ib')[(word >> 23) & 3]
+    text, regs = reglist(word & 0xffff)
+    if word & 0x00400000:
+        text += '^'
+        regs = regs[:2] + ('^',)
+    regs = (text, regs)
+
+    if rn[1] == 13 and writeback and not (word & 0x00400000):
+        if load and mode == 'ia':
+            return instruction(address, 4, 'pop' + c, [ regs ])
+        if not load and mode == 'db':
+            return instruction(address, 4, 'push' + c, [ regs ])
+
+    name = ('stm', 'ldm')[bool(load)] + ('', mode)[mode != 'ia']
+    if writeback:
+        rn = (rn[0] + '!', ('wb', rn[1]))
+    return instruction(address, 4, name + c, [ rn, regs ])
+
+
+def decode_thumb(data, address):
+    lines = []
+    count = len(data) // 2
+    halfwords = struct.unpack('<%dH' % count, data[:count * 2])
+    i = 0
+    while i < count:
+        hw = halfwords[i]
+        if (hw & 0xf800) == 0xf000 and i + 1 < count and (halfwords[i+1] & 0xe800) == 0xe800:
+            # BL or BLX, as a pair of halfwords
+            lines.append(decode_thumb_bl(hw, halfwords[i+1], address + i * 2))
+            i += 2
+        else:
+            lines.append(decode_thumb_halfword(hw, address + i * 2))
+            i += 1
+    return lines
+
+
+def decode_thumb_bl(hi, lo, address):
+    offset = (sign_extend(hi & 0x7ff, 11) << 12) | ((lo & 0x7ff) << 1)
+    target = (address + 4 + offset) & 0xffffffff
+    if lo & 0x1000:
+        return instruction(address, 4, 'bl', [ addr(target) ])
+    return instruction(address, 4, 'blx', [ addr(target & ~3) ])
+
+
+def decode_thumb_halfword(hw, address):
+    rd = reg(hw & 7)
+    rs = reg((hw >> 3) & 7)
+    top = hw >> 13
+
+    if top == 0:
+        op = (hw >> 11) & 3
+        if op == 3:
+            # Add/subtract, register or 3-bit immediate
+            name = ('adds', 'subs')[bool(hw & 0x200)]
+            if hw & 0x400:
+                operand = imm((hw >> 6) & 7)
+            else:
+                operand = reg((hw >> 6) & 7)
+            return instruction(address, 2, name, [ rd, rs, operand ])
+        amount = (hw >> 6) & 31
+        if op == 0 and amount == 0:
+            return instruction(address, 2, 'movs', [ rd, rs ])
+        return instruction(address, 2, ('lsls', 'lsrs', 'asrs')[op], [ rd, rs, imm(amount or 32) ])
+
+    if top == 1:
+        # Move, compare, add, subtract with 8-bit immediate
+        name = ('movs', 'cmp', 'adds', 'subs')[(hw >> 11) & 3]
+        return instruction(address, 2, name, [ reg((hw >> 8) & 7), imm(hw & 0xff) ])
+
+    if (hw & 0xfc00) == 0x4000:
+        # ALU operations
+        op = (hw >> 6) & 15
+        name = thumb_alu_names[op]
+        if name == 'muls':
+            return instruction(address, 2, name, [ rd, rs, rd ])
+        return instruction(address, 2, name, [ rd, rs ])
+
+    if (hw & 0xfc00) == 0x4400:
+        # High register operations and branch/exchange
+        op = (hw >> 8) & 3
+        rm = reg((hw >> 3) & 15)
+        rdn = reg((hw & 7) | ((hw >> 4) & 8))
+        if op == 3:
+            return instruction(address, 2, ('bx', 'blx')[bool(hw & 0x80)], [ rm ])
+        if hw == 0x46c0:
+            return instruction(address, 2, 'nop', [], '(mov r8, r8)')
+        return instruction(address, 2, ('add', 'cmp', 'mov')[op], [ rdn, rm ])
+
+    if (hw & 0xf800) == 0x4800:
+        # PC-relative load
+        offset = (hw & 0xff) * 4
+        return instruction(address, 2, 'ldr', [ reg((hw >> 8) & 7), memory(15, offset) ],
+            '(0x%08x)' % (((address + 4) & ~3) + offset))
+
+    if (hw & 0xf000) == 0x5000:
+        # Load/store with register offset
+        m = (hw >> 6) & 7
+        return instruction(address, 2, thumb_ldst_names[(hw >> 9) & 7], [ rd,
+            ('[%s, %s]' % (rs[0], reg_names[m]), ('mem', rs[1], m, None, False)) ])
+
+    if top == 3:
+        # Load/store with immediate offset, words or bytes
+        byte = hw & 0x1000
+        name = ('str', 'ldr')[bool(hw & 0x800)] + ('', 'b')[bool(byte)]
+        offset = ((hw >> 6) & 31) * (4, 1)[bool(byte)]
+        return instruction(address, 2, name, [ rd, memory(rs[1], offset) ])
+
+    if (hw & 0xf000) == 0x8000:
+        # Load/store halfword
+        name = ('strh', 'ldrh')[bool(hw & 0x800)]
+        return instruction(address, 2, name, [ rd, memory(rs[1], ((hw >> 6) & 31) * 2) ])
+
+    if (hw & 0xf000) == 0x9000:
+        # SP-relative load/store
+        name = ('str', 'ldr')[bool(hw & 0x800)]
+        return instruction(address, 2, name, [ reg((hw >> 8) & 7), memory(13, (hw & 0xff) * 4) ])
+
+    if (hw & 0xf000) == 0xa000:
+        # Address generation
+        base = (15, 13)[bool(hw & 0x800)]
+        return instruction(address, 2, 'add', [ reg((hw >> 8) & 7), reg(base), imm((hw & 0xff) * 4) ])
+
+    if (hw & 0xff00) == 0xb000:
+        name = ('add', 'sub')[bool(hw & 0x80)]
+        return instruction(address, 2, name, [ reg(13), imm((hw & 0x7f) * 4) ])
+
+    if (hw & 0xf600) == 0xb400:
+        # Push/pop, optionally with LR/PC
+        mask = hw & 0xff
+        if hw & 0x800:
+            return instruction(address, 2, 'pop', [ reglist(mask | ((hw & 0x100) << 7)) ])
+        return instruction(address, 2, 'push', [ reglist(mask | ((hw & 0x100) << 6)) ])
+
+    if (hw & 0xff00) == 0xbe00:
+        return instruction(address, 2, 'bkpt', [ addr(hw & 0xff, '0x%04x') ])
+
+    if (hw & 0xf000) == 0xc000:
+        # Multiple load/store
+        rn = (hw >> 8) & 7
+        mask = hw & 0xff
+        if hw & 0x800 and mask & (1 << rn):
+            return instruction(address, 2, 'ldmia', [ reg(rn), reglist(mask) ])
+        base = (reg_names[rn] + '!', ('wb', rn))
+        return instruction(address, 2, ('stmia', 'ldmia')[bool(hw & 0x800)], [ base, reglist(mask) ])
+
+    if (hw & 0xf000) == 0xd000:
+        cond = (hw >> 8) & 15
+        if cond == 15:
+            return instruction(address, 2, 'svc', [ addr(hw & 0xff, '%d') ])
+        if cond == 14:
+            return undefined(address, 2, hw)
+        target = (address + 4 + (sign_extend(hw & 0xff, 8) << 1)) & 0xffffffff
+        return instruction(address, 2, 'b%s.n' % cond_names[cond], [ addr(target) ])
+
+    if (hw & 0xf800) == 0xe000:
+        target = (address + 4 + (sign_extend(hw & 0x7ff, 11) << 1)) & 0xffffffff
+        return instruction(address, 2, 'b.n', [ addr(target) ])
+
+    # Unpaired BL/BLX halves, and anything else
+    return undefined(address, 2, hw)
+
+
+def memory(base, offset):
+    # Thumb's [rN, #offset], where the offset is always written out
+    return '[%s, #%d]' % (reg_names[base], offset), ('mem', base, ('imm', offset), None, False)
+
+
+def undefined(address, size, value):
+    return instruction(address, size, 'undefined', [ ('0x%0*x' % (size * 2, value), ('addr', value)) ])
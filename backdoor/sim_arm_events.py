@@ -0,0 +1,136 @@
+# Discrete-event scheduling for the ARM simulator.
+#
+# Each SimARM has an EventScheduler in arm.events. Events sit in a heap keyed
+# on the step count they're due at, and SimARM.step() runs straight up to the
+# next one before letting it happen, so there's no cost at all in between.
+# Virtual time is just the step count divided by 'hz'.
+#
+# An Interrupt event takes a real IRQ exception with SimARM.interrupt(): sp
+# and lr are banked, the flags and Thumb state are saved in arm.irq_saved,
+# and the ISR runs in ARM state until it returns with 'subs pc, lr, #4' or an
+# 'ldm {..., pc}^'. IRQs are masked while an ISR runs, so an interrupt that
+# comes due then waits until it returns.
+
+__all__ = [ 'EventScheduler', 'Event', 'Interrupt' ]
+
+import heapq
+
+
+class Event(object):
+    """Call fn(arm) when the event is due, and every 'period' steps after that if it's set"""
+
+    def __init__(self, fn, period = None, name = None):
+        self.fn = fn
+        self.period = period
+        self.name = name or getattr(fn, '__name__', 'event')
+
+    def __repr__(self):
+        if self.period:
+            return '<Event %s, every %d steps>' % (self.name, self.period)
+        return '<Event %s>' % self.name
+
+    def fire(self, arm):
+        self.fn(arm)
+
+
+class Interrupt(Event):
+    """Raise an IRQ that enters 'vector' in ARM state.
+    With 'sp', that's the IRQ mode stack pointer to use.
+    """
+
+    def __init__(self, vector = 0x18, sp = None, period = None, name = None):
+        Event.__init__(self, None, period, name or 'irq_%x' % vector)
+        self.vector = vector
+        self.sp = sp
+
+    def __repr__(self):
+        if self.period:
+            return '<Interrupt %08x, every %d steps>' % (self.vector, self.period)
+        return '<Interrupt %08x>' % self.vector
+
+    def fire(self, arm):
+        if not arm.interrupt(self.vector, self.sp):
+            # Masked, try again when the ISR returns
+            if self not in arm.events.pending:
+                arm.events.pending.append(self)
+
+
+class EventScheduler(object):
+    """Priority queue of Events for one SimARM, keyed on step count"""
+
+    # Simulated instructions per second of virtual time
+    hz = 100 * 1000 * 1000
+
+    def __init__(self, arm):
+        self.arm = arm
+        self.queue = []
+        self.pending = []
+        self.sequence = 0
+
+    def __len__(self):
+        return len(self.queue)
+
+    def __repr__(self):
+        return '<EventScheduler at step %d, %d queued, %d pending>' % (
+            self.arm.step_count, len(self.queue), len(self.pending))
+
+    @property
+    def next_step(self):
+        """Step count the next event is due at, or None"""
+        if self.queue:
+            return self.queue[0][0]
+
+    @property
+    def time(self):
+        """Virtual time in seconds"""
+        return self.arm.step_count / float(self.hz)
+
+    def schedule(self, step, event):
+        """Make 'event' happen before the instruction at step count 'step'"""
+        self.sequence += 1
+        heapq.heappush(self.queue, (max(step, self.arm.step_count), self.sequence, event))
+        return event
+
+    def after(self, steps, event):
+        return self.schedule(self.arm.step_count + steps, event)
+
+    def at_time(self, seconds, event):
+        return self.schedule(int(seconds * self.hz), event)
+
+    def every(self, period, event):
+        """Make 'event' happen every 'period' steps, starting one period from now"""
+        event.period = period
+        return self.after(period, event)
+
+    def cancel(self, event):
+        self.queue = [ e for e in self.queue if e[2] is not event ]
+        heapq.heapify(self.queue)
+        if event in self.pending:
+            self.pending.remove(event)
+
+    def clear(self):
+        del self.queue[:]
+        del self.pending[:]
+
+    def run_due(self):
+        """Fire every event that's due by now"""
+        queue = self.queue
+        arm = self.arm
+        while queue and queue[0][0] <= arm.step_count:
+            step, sequence, event = heapq.heappop(queue)
+            if event.period:
+                self.schedule(step + event.period, event)
+            event.fire(arm)
+
+    def interrupt_returned(self):
+        """The ISR returned; take the next interrupt that was waiting"""
+        if self.pending:
+            self.pending.pop(0).fire(self.arm)
+
+    def copy(self, arm = None):
+        """A copy of the queue, for checkpoints. Events themselves are shared."""
+        c = EventScheduler(arm or self.arm)
+        c.queue = self.queue[:]
+        c.pending = self.pending[:]
+        c.sequence = self.sequence
+        return c
@@ -0,0 +1,497 @@
+# Loop idiom recognition for the ARM simulator.
+#
+# Firmware spends a lot of simulated time in tiny loops that fill memory,
+# copy it, or just count down. When SimARM translates a block that branches
+# back to its own start, we look at its shape. If every instruction is one
+# we can reason about, the block gets a LoopIdiom, and step() can run many
+# iterations at once with the same architectural result:
+#
+#   fill    stores of loop-invariant registers, tiling a region as the
+#           pointers move. Local memory is written directly, and device
+#           memory gets fill_words() or fill_bytes(), or write_block().
+#   copy    loads whose values are stored, unchanged, at the same offset in
+#           a second region moving in step with the first. The source is read
+#           with read_block() if it isn't local.
+#   delay   no memory access at all, just counting.
+#
+# The loop body can contain:
+#
+#   add/adds/sub/subs rX, #imm    (or an invariant register, or rX, rX, ...)
+#   cmp rX, #imm or rX, rY
+#   ldr/ldrh/ldrb and str/strh/strb with [rA], [rA, #imm], or [rA, rB]
+#   ldmia/stmia rA!, {...}
+#   nop
+#
+# ending in a conditional branch back to the top. Every register is either
+# invariant, an induction variable that moves a fixed amount per iteration,
+# or a data register written by loads. The iteration count comes from the
+# last flag-setting instruction. We solve for it directly, and only as far
+# as we can be sure nothing wraps around.
+#
+# Anything else, including memory that's partly local, peripherals, skipped
+# stores, and active watchpoints, falls back on normal execution.
+
+__all__ = [ 'LoopIdiom', 'recognize_loop' ]
+
+import re
+from dump import read_block
+
+# Branch conditions we can solve for: name -> fn(n, z, c, v), True to keep looping
+conditions = {
+    'ne': lambda n, z, c, v: not z,
+    'cs': lambda n, z, c, v: c,
+    'hs': lambda n, z, c, v: c,
+    'cc': lambda n, z, c, v: not c,
+    'lo': lambda n, z, c, v: not c,
+    'hi': lambda n, z, c, v: c and not z,
+    'ls': lambda n, z, c, v: z or not c,
+    'mi': lambda n, z, c, v: n,
+    'pl': lambda n, z, c, v: not n,
+    'ge': lambda n, z, c, v: n == v,
+    'lt': lambda n, z, c, v: n != v,
+    'gt': lambda n, z, c, v: not z and n == v,
+    'le': lambda n, z, c, v: z or n != v,
+}
+
+# Conditions that depend on signed values, and those that look at the sign of the result
+signed_conditions = set(['mi', 'pl', 'ge', 'lt', 'gt', 'le'])
+result_conditions = set(['mi', 'pl'])
+
+branch_re = re.compile(r'^b(%s)$' % '|'.join(conditions))
+mem_sizes = { 'ldr': 4, 'ldrh': 2, 'ldrb': 1, 'str': 4, 'strh': 2, 'strb': 1 }
+
+# Don't bother with loops that are about to end anyway
+min_iterations = 4
+
+mask = 0xffffffff
+
+
+def signed(x):
+    x &= mask
+    return x - 0x100000000 if x & 0x80000000 else x
+
+
+def parse_operand(arm, s):
+    """A '#literal' or register name as ('imm', value) or ('reg', number)"""
+    if s.startswith('#'):
+        return ('imm', int(s[1:], 0) & mask)
+    return ('reg', arm.reg_numbers[s])
+
+
+def parse_address(arm, s):
+    """[rA], [rA, #imm], or [rA, rB] as (registers, offset)"""
+    if not (s.startswith('[') and s.endswith(']')):
+        raise ValueError(s)
+    parts = s[1:-1].split(', ')
+    regs = [ arm.reg_numbers[parts[0]] ]
+    offset = 0
+    if len(parts) == 2:
+        if parts[1].startswith('#'):
+            offset = int(parts[1][1:], 0)
+        else:
+            regs.append(arm.reg_numbers[parts[1]])
+    elif len(parts) != 1:
+        raise ValueError(s)
+    return regs, offset
+
+
+def parse_instruction(arm, instr):
+    """One loop body instruction as a tuple, None for a nop. Raises ValueError or KeyError.
+
+    ('add', reg, operand, sign, sets_flags)
+    ('cmp', reg, operand)
+    ('load' or 'store', size, reg, address registers, offset)
+    ('ldm' or 'stm', base, registers)
+    """
+    op = instr.op.split('.', 1)[0]
+    args = instr.args
+
+    if op == 'nop':
+        return None
+
+    if op in ('add', 'adds', 'sub', 'subs'):
+        dst, src0, src1 = arm._3arg(instr)
+        if dst != src0:
+            raise ValueError(args)
+        return ('add', arm.reg_numbers[dst], parse_operand(arm, src1),
+                -1 if op.startswith('sub') else 1, op.endswith('s'))
+
+    if op == 'cmp':
+        a, b = args.split(', ')
+        return ('cmp', arm.reg_numbers[a], parse_operand(arm, b))
+
+    if op in mem_sizes:
+        reg, address = args.split(', ', 1)
+        regs, offset = parse_address(arm, address)
+        return ('load' if op.startswith('ld') else 'store', mem_sizes[op],
+                arm.reg_numbers[reg], regs, offset)
+
+    if op in ('ldmia', 'ldm', 'stmia', 'stm'):
+        base, reglist = args.split(', ', 1)
+        if not (base.endswith('!') and reglist.startswith('{')):
+            raise ValueError(args)
+        return ('ldm' if op.startswith('ld') else 'stm', arm.reg_numbers[base[:-1]],
+                [ arm.reg_numbers[r] for r in reglist.strip('{}').split(', ') ])
+
+    raise ValueError(op)
+
+
+def recognize_loop(arm, block, thumb):
+    """A LoopIdiom for a translated BasicBlock, or None if it isn't one"""
+    first, last = block.instructions[0], block.last
+    m = branch_re.match(last.op.split('.', 1)[0])
+    if not m or last.hle or last.address in arm.memory.hooks:
+        return None
+    try:
+        if int(last.args, 0) != first.address:
+            return None
+        body = [ parse_instruction(arm, i) for i in block.instructions[:-1] ]
+    except (ValueError, KeyError):
+        return None
+    body = [ b for b in body if b ]
+
+    induction = set()
+    data = set()
+    for b in body:
+        if b[0] == 'add':
+            induction.add(b[1])
+        elif b[0] == 'load':
+            data.add(b[2])
+        elif b[0] in ('ldm', 'stm'):
+            induction.add(b[1])
+            if b[0] == 'ldm':
+                data.update(b[2])
+    written = induction | data
+    if induction & data or 15 in written:
+        return None
+
+    # Check how each register is used
+    loads = stores = False
+    flag_op = None
+    for b in body:
+        if b[0] in ('add', 'cmp'):
+            if b[2][0] == 'reg' and b[2][1] in (written if b[0] == 'add' else data):
+                return None
+            if b[0] == 'cmp' and b[1] in data:
+                return None
+            if b[0] == 'cmp' or b[4]:
+                flag_op = b
+        elif b[0] in ('load', 'store'):
+            if set(b[3]) & data or 15 in b[3]:
+                return None
+            if b[0] == 'load':
+                loads = True
+            elif b[2] in induction or b[2] == 15:
+                return None
+            else:
+                stores = True
+        else:
+            if b[1] in data:
+                return None
+            if b[0] == 'ldm':
+                loads = True
+            elif set(b[2]) & induction or 15 in b[2]:
+                return None
+            else:
+                stores = True
+
+    if flag_op is None or (loads and not stores):
+        return None
+    if flag_op[0] == 'add' and flag_op[3] > 0 and m.group(1) != 'ne':
+        # Only solve 'adds' loops that count up to zero
+        return None
+    if loads:
+        kind = 'copy'
+    elif stores:
+        kind = 'fill'
+        if [ b for b in body if b[0] == 'store' and b[2] in data ]:
+            return None
+    else:
+        kind = 'delay'
+
+    return LoopIdiom(kind, block, thumb, body, m.group(1), flag_op, induction)
+
+
+def horizon(x, d, lo, hi):
+    """How many more steps of 'd' can x take and stay in [lo, hi)? None if unlimited."""
+    if d > 0:
+        return (hi - 1 - x) // d
+    if d < 0:
+        return (x - lo) // -d
+
+
+class LoopIdiom(object):
+    """A recognized loop. run() executes iterations of it in bulk."""
+
+    def __init__(self, kind, block, thumb, body, condition, flag_op, induction):
+        self.kind = kind
+        self.start = block.instructions[0].address
+        self.exit = block.last.next_address
+        self.thumb = thumb
+        self.length = block.length
+        self.body = body
+        self.condition = condition
+        self.flag_op = flag_op
+        self.induction = induction
+        self.runs = 0
+        self.iterations = 0
+
+    def __repr__(self):
+        return '<LoopIdiom %s at %08x, %d instructions, b%s, %d runs, %d iterations>' % (
+            self.kind, self.start, self.length, self.condition, self.runs, self.iterations)
+
+    def _walk(self, regs):
+        """Go through the body once, starting from 'regs'.
+
+        Returns (deltas, operands, accesses). Deltas say how far each
+        induction register moves per iteration. Operands are the (a, b) of the
+        flag-setting instruction, and accesses are (kind, size, address, reg,
+        address registers). Both are as of the first iteration.
+        """
+        partial = dict((r, 0) for r in self.induction)
+        value = lambda r: (regs[r] + partial.get(r, 0)) & mask
+        operand = lambda o: o[1] if o[0] == 'imm' else value(o[1])
+        operands = None
+        accesses = []
+
+        for b in self.body:
+            if b[0] == 'add':
+                amount = operand(b[2])
+                if b is self.flag_op:
+                    operands = (value(b[1]), amount)
+                partial[b[1]] += amount * b[3]
+            elif b[0] == 'cmp':
+                if b is self.flag_op:
+                    operands = (value(b[1]), operand(b[2]))
+            elif b[0] in ('load', 'store'):
+                address = (sum(value(r) for r in b[3]) + b[4]) & mask
+                accesses.append((b[0], b[1], address, b[2], b[3]))
+            else:
+                kind = 'load' if b[0] == 'ldm' else 'store'
+                for i, r in enumerate(b[2]):
+                    accesses.append((kind, 4, value(b[1]) + 4 * i, r, [b[1]]))
+                partial[b[1]] += 4 * len(b[2])
+
+        deltas = dict((r, signed(partial[r])) for r in partial)
+        return deltas, operands, accesses
+
+    def _operand_deltas(self, deltas):
+        fop = self.flag_op
+        da = deltas.get(fop[1], 0)
+        db = deltas.get(fop[2][1], 0) if fop[0] == 'cmp' and fop[2][0] == 'reg' else 0
+        return da, db
+
+    def _flags(self, a, b):
+        """(N, Z, C, V) for the flag-setting instruction, with masked operands a and b"""
+        if self.flag_op[0] == 'add' and self.flag_op[3] > 0:
+            r = a + b
+            return ((r >> 31) & 1, not (r & mask), r > mask,
+                    (a >> 31) == (b >> 31) and (a >> 31) != ((r >> 31) & 1))
+        r = a - b
+        return ((r >> 31) & 1, not (r & mask), a >= b,
+                (a >> 31) != (b >> 31) and (a >> 31) != ((r >> 31) & 1))
+
+    def _iterations(self, operands, deltas, limit):
+        """How many iterations to run, at most 'limit'. Returns (count, finished)."""
+        a0, b0 = operands
+        da, db = self._operand_deltas(deltas)
+        keep_looping = conditions[self.condition]
+
+        def holds(i):
+            return keep_looping(*self._flags((a0 + i * da) & mask, (b0 + i * db) & mask))
+
+        if self.condition == 'ne':
+            # Exits when the result hits zero, which we can solve for
+            sign = 1 if self.flag_op[0] == 'add' and self.flag_op[3] > 0 else -1
+            r0 = (a0 + sign * b0) & mask
+            step = da + sign * db
+            exit = None
+            if not step:
+                exit = None if r0 else 0
+            elif step > 0 and not ((-r0) & mask) % step:
+                exit = ((-r0) & mask) // step
+            elif step < 0 and not r0 % -step:
+                exit = r0 // -step
+            elif step and abs(step) * limit >= 1 << 32:
+                # No exit this time around zero, but maybe the next
+                limit = (1 << 32) // abs(step)
+
+        else:
+            # The rest are monotonic, until something wraps around
+            if self.condition in signed_conditions:
+                a0, b0 = signed(a0), signed(b0)
+                lo, hi = -1 << 31, 1 << 31
+            else:
+                lo, hi = 0, 1 << 32
+            values = [ (a0, da), (b0, db) ]
+            if self.condition in result_conditions:
+                values.append((a0 - b0, da - db))
+            for x, d in values:
+                h = horizon(x, d, lo, hi)
+                if h is not None:
+                    limit = min(limit, h + 1)
+
+            # Falling through on the first pass doesn't mean the condition
+            # stays false, so don't search if it never held at all.
+            exit = None
+            if limit > 0 and not holds(0):
+                exit = 0
+            elif limit > 0 and not holds(limit - 1):
+                lo, hi = -1, limit - 1
+                while hi - lo > 1:
+                    mid = (lo + hi) // 2
+                    if holds(mid):
+                        lo = mid
+                    else:
+                        hi = mid
+                exit = hi
+
+        if exit is not None and exit < limit:
+            return exit + 1, True
+        return limit, False
+
+    def run(self, arm, repeat, breakpoint = None):
+        """Run as many iterations as we can, up to 'repeat' steps.
+        Returns the number of steps taken, zero if we didn't do anything.
+        """
+        regs = arm.regs
+        memory = arm.memory
+        limit = repeat // self.length
+        if (regs[15] != self.start or arm.thumb != self.thumb or limit < min_iterations
+                or breakpoint == self.start or self.start in arm.breakpoints
+                or memory.watchpoints):
+            return 0
+
+        deltas, operands, accesses = self._walk(regs)
+        count, finished = self._iterations(operands, deltas, limit)
+        if count < min_iterations:
+            return 0
+
+        if accesses:
+            stride = set(sum(deltas.get(r, 0) for r in a[4]) for a in accesses)
+            if len(stride) != 1 or not self._memory(arm, accesses, stride.pop(), count):
+                return 0
+
+        for r in self.induction:
+            regs[r] = (regs[r] + count * deltas[r]) & mask
+        da, db = self._operand_deltas(deltas)
+        a, b = operands
+        arm.cpsrN, arm.cpsrZ, arm.cpsrC, arm.cpsrV = self._flags(
+            (a + (count - 1) * da) & mask, (b + (count - 1) * db) & mask)
+        arm.step_count += count * self.length
+        regs[15] = self.exit if finished else self.start
+
+        self.runs += 1
+        self.iterations += count
+        return count * self.length
+
+    def _memory(self, arm, accesses, stride, count):
+        """The memory side of 'count' iterations, and the final data registers.
+        Returns False, having done nothing, if we can't.
+        """
+        memory = arm.memory
+        loads = [ a for a in accesses if a[0] == 'load' ]
+        stores = [ a for a in accesses if a[0] == 'store' ]
+        size = count * abs(stride)
+
+        dst = window(stores, stride)
+        if dst is None:
+            return False
+        dst_start = dst + min(0, (count - 1) * stride)
+        dst_kind = region_kind(memory, dst_start, size, True)
+        if not dst_kind:
+            return False
+
+        if self.kind == 'fill':
+            pattern = bytearray(abs(stride))
+            for kind, width, address, reg, _ in stores:
+                value = arm.regs[reg]
+                for i in range(width):
+                    pattern[address - dst + i] = (value >> (8 * i)) & 0xff
+            write_region(memory, dst_kind, dst_start, str(pattern) * count)
+            return True
+
+        src = window(loads, stride)
+        if src is None:
+            return False
+        src_start = src + min(0, (count - 1) * stride)
+        src_kind = region_kind(memory, src_start, size, False)
+        if not src_kind:
+            return False
+
+        # Every stored byte has to come from the same offset in the source
+        origin = {}
+        for kind, width, address, reg, _ in accesses:
+            if kind == 'load':
+                origin[reg] = (address - src, width)
+            elif reg not in origin or origin[reg][1] < width or origin[reg][0] != address - dst:
+                return False
+
+        if src_start < dst_start + size and dst_start < src_start + size:
+            # Overlapping copies only work if nothing is overwritten before it's read
+            first_store = accesses.index(stores[0])
+            if [ a for a in accesses[first_store:] if a[0] == 'load' ]:
+                return False
+            if (stride > 0) != (dst_start <= src_start):
+                return False
+
+        data = read_region(memory, src_kind, src_start, size)
+        if data is None:
+            return False
+        write_region(memory, dst_kind, dst_start, data)
+
+        # Data registers keep what the last iteration loaded
+        last = src + (count - 1) * stride - src_start
+        for reg, (offset, width) in origin.items():
+            chunk = data[last + offset : last + offset + width]
+            arm.regs[reg] = sum(ord(c) << (8 * i) for i, c in enumerate(chunk))
+        return True
+
+
+def window(accesses, stride):
+    """Start of the range one iteration's accesses cover, if consecutive iterations tile exactly"""
+    covered = set()
+    count = 0
+    for kind, width, address, reg, _ in accesses:
+        covered.update(range(address, address + width))
+        count += width
+    if not covered or count != abs(stride):
+        return None
+    start = min(covered)
+    if covered != set(range(start, start + count)):
+        return None
+    return start
+
+
+def log(memory, text):
+    if memory.trace:
+        memory.trace.write(text)
+    elif memory.logfile:
+        memory.logfile.write(text)
+
+
+def region_kind(memory, address, size, store):
+    """memory.region_kind(), except that device memory is off limits while a
+    store is still buffered. Flushing it could fault, and that should happen
+    on the instruction that would normally flush it, not here.
+    """
+    kind = memory.region_kind(address, size, store)
+    if kind == 'device' and memory.write_buffer:
+        return None
+    return kind
+
+
+def read_region(memory, kind, address, size):
+    if kind == 'local':
+        return memory.read_local(address, size)
+    log(memory, "arm-idiom-READ  [%08x] * %x\n" % (address, size))
+    data = read_block(memory.device, address, size)
+    if len(data) == size:
+        return data
+
+
+def write_region(memory, kind, address, data):
+    if kind == 'local':
+        memory.write_local(address, data)
+    else:
+        memory.post_stores(address, data)
@@ -0,0 +1,204 @@
+# Idle loop fast-forward for the ARM simulator.
+#
+# Polling loops spend their time reading a timer or a hardware register
+# until it changes:
+#
+#   1:  ldr     r3, [r2, #0]
+#       tst     r3, #4
+#       beq     1b
+#
+# When a translated block branches back to its own start, doesn't store
+# anything, and every register it writes is written before it's read, each
+# trip around the loop depends only on the values it loads. If at least one
+# of those loads is uncached (a peripheral model or the device), we call it
+# an idle loop.
+#
+# IdleLoop alternates between running one real iteration, which polls, and
+# skipping ahead as if some more iterations had seen the same values. The
+# skip doubles each time the loop is still going, up to 'max_skip'. Modeled
+# peripherals are told about the reads we skipped, so the SysTimer clock
+# keeps moving, and device registers are only polled on the real iterations.
+#
+# This isn't exact: the loop may have seen a change partway through a skip.
+# The most we can overshoot by is the length of the last skip, which is at
+# most as long as we'd already been waiting.
+
+__all__ = [ 'IdleLoop', 'recognize_idle' ]
+
+import re
+from sim_arm_idiom import log
+
+branch_re = re.compile(r'^b(eq|ne|cs|hs|cc|lo|mi|pl|vs|vc|hi|ls|ge|lt|gt|le)$')
+word_re = re.compile(r'\w+')
+
+load_ops = frozenset(['ldr', 'ldrh', 'ldrb', 'ldrsh', 'ldrsb'])
+compare_ops = frozenset(['cmp', 'cmn', 'tst', 'teq'])
+move_ops = frozenset(['mov', 'mvn', 'uxtb', 'uxth', 'sxtb', 'sxth'])
+alu_ops = frozenset(['and', 'orr', 'eor', 'bic', 'add', 'sub', 'rsb', 'lsl', 'lsr', 'asr'])
+full_flag_ops = frozenset(['cmp', 'cmn', 'add', 'sub', 'rsb'])
+sizes = { 'ldr': 4, 'ldrh': 2, 'ldrb': 1, 'ldrsh': 2, 'ldrsb': 1 }
+
+
+def registers(arm, s):
+    """Register numbers named anywhere in an operand string"""
+    return [ arm.reg_numbers[w] for w in word_re.findall(s) if w in arm.reg_numbers ]
+
+
+def recognize_idle(arm, block, thumb):
+    """An IdleLoop for a translated BasicBlock, or None if it isn't one"""
+    first, last = block.instructions[0], block.last
+    m = branch_re.match(last.op.split('.', 1)[0])
+    if not m or last.hle or last.address in arm.memory.hooks:
+        return None
+    try:
+        if int(last.args, 0) != first.address:
+            return None
+    except ValueError:
+        return None
+
+    # Registers, as (destination, sources), and loads
+    uses = []
+    loads = []
+    setter = None
+    for instr in block.instructions[:-1]:
+        op = instr.op.split('.', 1)[0]
+        base = op.rstrip('s')
+        if op == 'nop':
+            continue
+        args = instr.args.split(', ', 1)
+        if op in load_ops:
+            if len(args) != 2 or '!' in args[1]:
+                return None
+            uses.append((registers(arm, args[0]), registers(arm, args[1])))
+            if thumb:
+                pc = (instr.next_address + 3) & ~3
+            else:
+                pc = instr.address + 8
+            try:
+                loads.append((pc, arm._reladdr(args[1]), sizes[op]))
+            except (KeyError, ValueError, AssertionError):
+                return None
+        elif op in compare_ops:
+            uses.append(([], registers(arm, instr.args)))
+            setter = op
+        elif base in move_ops or base in alu_ops:
+            if len(args) != 2:
+                return None
+            dst, reads = registers(arm, args[0]), registers(arm, args[1])
+            if base in alu_ops and ', ' not in args[1]:
+                # Two operand form, the destination is also a source
+                reads += dst
+            uses.append((dst, reads))
+            if op != base:
+                setter = base
+        else:
+            return None
+
+    # The branch has to depend on flags from this iteration. Only compares,
+    # adds and subtracts are sure to set C and V.
+    if not (loads and setter):
+        return None
+    if m.group(1) not in ('eq', 'ne', 'mi', 'pl') and setter not in full_flag_ops:
+        return None
+
+    # Nothing can carry over from one iteration to the next: every register
+    # the loop writes is written before it's read, and load addresses stay put.
+    written = set()
+    for dst, reads in uses:
+        written.update(dst)
+    if 13 in written or 15 in written:
+        return None
+    so_far = set()
+    for dst, reads in uses:
+        if len(dst) > 1 or set(reads) & (written - so_far):
+            return None
+        so_far.update(dst)
+    for instr in block.instructions[:-1]:
+        if instr.op.split('.', 1)[0] in load_ops and set(registers(arm, instr.args.split(', ', 1)[1])) & written:
+            return None
+
+    return IdleLoop(block, thumb, loads, [ r for r in range(15) if r not in written ])
+
+
+class IdleLoop(object):
+    """A recognized polling loop. run() skips iterations of it."""
+
+    # Most iterations to skip between polls
+    max_skip = 0x1000
+
+    def __init__(self, block, thumb, loads, invariant):
+        self.start = block.instructions[0].address
+        self.thumb = thumb
+        self.length = block.length
+        self.loads = loads
+        self.invariant = invariant
+        self.skip = 1
+        self.polled = False
+        self.state = None
+        self.next_step = None
+        self.runs = 0
+        self.iterations = 0
+
+    def __repr__(self):
+        return '<IdleLoop at %08x, %d instructions, %d loads, %d runs, %d iterations skipped>' % (
+            self.start, self.length, len(self.loads), self.runs, self.iterations)
+
+    def _uncached(self, arm):
+        """Peripheral loads as a list of (peripheral, address, size).
+        None if every load is local, so this isn't an idle loop after all.
+        """
+        regs = arm.regs
+        memory = arm.memory
+        pc = regs[15]
+        peripherals = []
+        device = False
+        try:
+            for load_pc, address_fn, size in self.loads:
+                regs[15] = load_pc
+                address = address_fn()
+                p = memory.peripherals.find(address)
+                if p:
+                    peripherals.append((p, address, size))
+                elif memory.region_kind(address, size) != 'local':
+                    device = True
+        finally:
+            regs[15] = pc
+        if peripherals or device:
+            return peripherals
+
+    def run(self, arm, repeat, breakpoint = None):
+        """Skip ahead if the last iteration left everything but the loaded values
+        alone. Returns the number of steps skipped, or zero to poll for real.
+        """
+        regs = arm.regs
+        limit = repeat // self.length
+        if (regs[15] != self.start or arm.thumb != self.thumb or limit < 2
+                or breakpoint == self.start or self.start in arm.breakpoints
+                or arm.memory.watchpoints):
+            self.next_step = None
+            return 0
+
+        state = [ regs[r] for r in self.invariant ]
+        continuing = arm.step_count == self.next_step and state == self.state
+        if continuing and self.polled:
+            peripherals = self._uncached(arm)
+            if peripherals is not None:
+                count = min(self.skip, limit - 1)
+                for p, address, size in peripherals:
+                    p.skip_reads(address, size, count)
+                arm.step_count += count * self.length
+                log(arm.memory, "arm-idle [%08x] skipped %d iterations\n" % (self.start, count))
+
+                self.skip = min(self.skip * 2, self.max_skip)
+                self.polled = False
+                self.next_step = arm.step_count
+                self.runs += 1
+                self.iterations += count
+                return count * self.length
+
+        if not continuing:
+            self.skip = 1
+        self.state = state
+        self.next_step = arm.step_count + self.length
+        self.polled = True
+        return 0
@@ -0,0 +1,382 @@
+#!/usr/bin/env python
+#
+# Indexed queries over simulator traces.
+#
+# A TraceIndex ingests a text trace.log from %sim, or a binary trace from
+# sim_arm_trace.py, into columnar arrays. Sorted address and PC indexes let
+# us answer questions that would otherwise mean grepping the whole log:
+#
+#   idx = TraceIndex.from_file('trace.log')
+#   idx.stores_to(0x04002088)           # [(step, pc), ...] for every store
+#   idx.first_step_where('r0', 0x1234)  # first step that ends with r0 == 0x1234
+#   idx.memory_at(0x1c00010, 5000)      # last value seen there by step 5000
+#
+# Building the index from a big log is slow, so save() it once and load()
+# it next time; loading is just reading the arrays back.
+#
+# Only memory traffic that appears in the trace is indexed: accesses that
+# stay in local RAM or cached flash never make it to the log.
+#
+#   ./sim_arm_index.py trace.log -S trace.idx
+#   ./sim_arm_index.py trace.idx --stores 4002088 --first r0=1234 --mem 1c00010@5000
+
+__all__ = [ 'TraceIndex' ]
+
+import array, bisect, marshal, re, argparse
+from sim_arm_trace import *
+import sim_arm_trace
+
+reg_names = ('r0', 'r1', 'r2', 'r3', 'r4', 'r5', 'r6', 'r7',
+             'r8', 'r9', 'r10', 'r11', 'r12', 'sp', 'lr', 'pc')
+
+# Kinds of memory access
+LOAD, STORE, FILL = 0, 1, 2
+size_bytes = { 'byte': 1, 'half': 2, 'word': 4 }
+
+index_magic = 'SimARM trace index v2\n'
+
+mem_re = re.compile(r'arm-mem-(LOAD|STORE|FILL) +(\w+)\[([0-9a-f]+)\] (?:->|<-) ([0-9a-f]+)(?: \* ([0-9a-f]+))?')
+
+
+class TraceIndex(object):
+    """Columnar arrays for one trace, with sorted indexes.
+
+    Steps are rows: step_count[row], step_pc[row] (the next instruction,
+    as in the '>' column of the log) and step_flags[row]. Registers are
+    stored as changes: reg_rows[r][i] is the row where register r became
+    reg_values[r][i]. Memory accesses are rows too, with mem_row[i] the
+    step row they happened in.
+    """
+
+    columns = ('step_count', 'step_pc', 'step_flags',
+               'mem_row', 'mem_kind', 'mem_address', 'mem_data', 'mem_size', 'mem_count')
+
+    def __init__(self):
+        self.step_count = array.array('L')
+        self.step_pc = array.array('L')
+        self.step_flags = array.array('B')
+        self.reg_rows = [ array.array('L') for r in reg_names ]
+        self.reg_values = [ array.array('L') for r in reg_names ]
+        self.mem_row = array.array('L')
+        self.mem_kind = array.array('B')
+        self.mem_address = array.array('L')
+        self.mem_data = array.array('L')
+        self.mem_size = array.array('B')
+        self.mem_count = array.array('L')
+        self.regs = [None] * len(reg_names)
+
+    def __repr__(self):
+        return '<TraceIndex %d steps, %d memory accesses>' % (len(self.step_count), len(self.mem_row))
+
+    # Ingest
+
+    def add_step(self, step_count, pc, flags, regs):
+        row = len(self.step_count)
+        self.step_count.append(step_count)
+        self.step_pc.append(pc)
+        self.step_flags.append(flags)
+        last = self.regs
+        for r, value in enumerate(regs):
+            if value != last[r]:
+                self.reg_rows[r].append(row)
+                self.reg_values[r].append(value)
+                last[r] = value
+
+    def add_access(self, kind, address, data, size, count = 1):
+        self.mem_row.append(len(self.step_count))
+        self.mem_kind.append(kind)
+        self.mem_address.append(address)
+        self.mem_data.append(data)
+        self.mem_size.append(size)
+        self.mem_count.append(count)
+
+    def ingest_log(self, f):
+        """Read a text trace.log, as written by %sim"""
+        for line in f:
+            if line.startswith('# '):
+                fields = line[2:].split()
+                if len(fields) < 3 or not fields[2].startswith('>'):
+                    continue
+                flags = fields[1]
+                regs = [ int(field.split('=')[1], 16) for field in fields[-15:] ]
+                self.add_step(int(fields[0].lstrip('.') or '0'), int(fields[2][1:], 16),
+                              (flags[4] == 'T') | (flags[0] == 'N') << 1 | (flags[1] == 'Z') << 2 |
+                              (flags[2] == 'C') << 3 | (flags[3] == 'V') << 4,
+                              regs + [int(fields[2][1:], 16)])
+            elif line.startswith('arm-mem-'):
+                m = mem_re.match(line)
+                if m:
+                    kind = ('LOAD', 'STORE', 'FILL').index(m.group(1))
+                    self.add_access(kind, int(m.group(3), 16), int(m.group(4), 16),
+                                    size_bytes[m.group(2)], int(m.group(5) or '1', 16))
+
+    def ingest_trace(self, reader):
+        """Read a binary trace from a TraceReader"""
+        regs = [0] * len(reg_names)
+        for record in reader:
+            rtype = record[0]
+            if rtype == sim_arm_trace.REGS:
+                regs[record[1]] = record[2]
+            elif rtype == sim_arm_trace.STEP:
+                self.add_step(record[1], record[2], record[3], regs)
+            elif rtype == sim_arm_trace.LOAD:
+                self.add_access(LOAD, record[1], record[2], size_bytes[record[3]])
+            elif rtype == sim_arm_trace.STORE:
+                self.add_access(STORE, record[1], record[2], size_bytes[record[3]])
+            elif rtype == sim_arm_trace.FILL:
+                self.add_access(FILL, record[1], record[2], size_bytes[record[4]], record[3])
+
+    def build(self):
+        """Sort the address and PC indexes. Call after ingesting."""
+        n = len(self.mem_address)
+
+        # Loads and stores, in runs by address and then size. The sort is
+        # stable, so each run is in trace order and we can bisect on its rows.
+        order = sorted((i for i in xrange(n) if self.mem_kind[i] != FILL),
+                       key=lambda i: (self.mem_address[i], self.mem_size[i]))
+        self.addr_order = array.array('L', order)
+        self.addr_sorted = array.array('L', (self.mem_address[i] for i in order))
+        self.addr_sizes = array.array('B', (self.mem_size[i] for i in order))
+        self.addr_rows = array.array('L', (self.mem_row[i] for i in order))
+
+        # Fills cover ranges, so they're sorted by where they start, with the
+        # furthest any fill so far reaches to tell us when to stop looking back
+        fills = [ i for i in xrange(n) if self.mem_kind[i] == FILL ]
+        fills.sort(key=self.mem_address.__getitem__)
+        self.fills = array.array('L', fills)
+        self.fill_start = array.array('L', (self.mem_address[i] for i in fills))
+        self.fill_reach = array.array('L')
+        reach = 0
+        for i in fills:
+            reach = max(reach, self.mem_address[i] + self.mem_size[i] * self.mem_count[i])
+            self.fill_reach.append(reach)
+
+        order = sorted(xrange(len(self.step_pc)), key=self.step_pc.__getitem__)
+        self.pc_order = array.array('L', order)
+        self.pc_sorted = array.array('L', (self.step_pc[i] for i in order))
+        return self
+
+    @classmethod
+    def from_file(cls, filename):
+        """Index a text log, binary trace, or saved index"""
+        with open(filename, 'rb') as f:
+            head = f.read(len(index_magic))
+        if head == index_magic:
+            return cls.load(filename)
+        idx = cls()
+        if head.startswith(sim_arm_trace.trace_magic):
+            idx.ingest_trace(TraceReader(filename))
+        else:
+            with open(filename, 'r') as f:
+                idx.ingest_log(f)
+        return idx.build()
+
+    # Storage
+
+    def _arrays(self):
+        arrays = [ getattr(self, name) for name in self.columns ]
+        arrays += self.reg_rows + self.reg_values
+        arrays += [ self.addr_order, self.addr_sorted, self.addr_sizes, self.addr_rows,
+                    self.fills, self.fill_start, self.fill_reach, self.pc_order, self.pc_sorted ]
+        return arrays
+
+    def save(self, filename):
+        with open(filename, 'wb') as f:
+            f.write(index_magic)
+            arrays = self._arrays()
+            marshal.dump([ (a.typecode, len(a)) for a in arrays ], f)
+            for a in arrays:
+                a.tofile(f)
+
+    @classmethod
+    def load(cls, filename):
+        idx = cls()
+        with open(filename, 'rb') as f:
+            if f.read(len(index_magic)) != index_magic:
+                raise IOError("%s is not a trace index" % filename)
+            arrays = []
+            for typecode, length in marshal.load(f):
+                a = array.array(typecode)
+                a.fromfile(f, length)
+                arrays.append(a)
+        n = len(cls.columns)
+        for name, a in zip(cls.columns, arrays):
+            setattr(idx, name, a)
+        idx.reg_rows = arrays[n:n + 16]
+        idx.reg_values = arrays[n + 16:n + 32]
+        (idx.addr_order, idx.addr_sorted, idx.addr_sizes, idx.addr_rows,
+         idx.fills, idx.fill_start, idx.fill_reach, idx.pc_order, idx.pc_sorted) = arrays[n + 32:]
+        return idx
+
+    # Queries
+
+    def row_for_step(self, step):
+        """Row of the last step at or before 'step', or -1"""
+        return bisect.bisect_right(self.step_count, step) - 1
+
+    def executing_pc(self, row):
+        """PC of the instruction that ran during a step row, if we know it"""
+        if row > 0:
+            return self.step_pc[row - 1]
+
+    def _runs(self, address):
+        # (lo, hi) slices of the address index, one per address and size,
+        # for the loads and stores covering 'address'
+        runs = []
+        addrs = self.addr_sorted
+        sizes = self.addr_sizes
+        lo = bisect.bisect_left(addrs, max(0, address - 3))
+        hi = bisect.bisect_right(addrs, address)
+        while lo < hi:
+            start = addrs[lo]
+            end = bisect.bisect_right(addrs, start, lo, hi)
+            lo = bisect.bisect_right(sizes, address - start, lo, end)
+            while lo < end:
+                stop = bisect.bisect_right(sizes, sizes[lo], lo, end)
+                runs.append((lo, stop))
+                lo = stop
+        return runs
+
+    def _fills_covering(self, address):
+        # Indices of fills covering 'address', in no particular order
+        found = []
+        j = bisect.bisect_right(self.fill_start, address) - 1
+        while j >= 0 and self.fill_reach[j] > address:
+            i = self.fills[j]
+            if address < self.mem_address[i] + self.mem_size[i] * self.mem_count[i]:
+                found.append(i)
+            j -= 1
+        return found
+
+    def accesses(self, address, kinds = (LOAD, STORE, FILL)):
+        """Indices of memory accesses that touch 'address', in trace order"""
+        found = []
+        if LOAD in kinds or STORE in kinds:
+            for lo, hi in self._runs(address):
+                found.extend(self.addr_order[lo:hi])
+        if FILL in kinds:
+            found.extend(self._fills_covering(address))
+        found.sort()
+        return [ i for i in found if self.mem_kind[i] in kinds ]
+
+    def _last_access(self, address, row):
+        # Index of the last access touching 'address' at or before step row 'row'
+        last = None
+        for lo, hi in self._runs(address):
+            j = bisect.bisect_right(self.addr_rows, row, lo, hi) - 1
+            if j >= lo:
+                last = max(last, self.addr_order[j])
+        for i in self._fills_covering(address):
+            if self.mem_row[i] <= row:
+                last = max(last, i)
+        return last
+
+    def _step_and_pc(self, i):
+        row = self.mem_row[i]
+        step = self.step_count[row] if row < len(self.step_count) else None
+        return (step, self.executing_pc(row))
+
+    def stores_to(self, address):
+        """Every store or fill that touched 'address', as (step, pc) pairs"""
+        return [ self._step_and_pc(i) for i in self.accesses(address, (STORE, FILL)) ]
+
+    def loads_from(self, address):
+        """Every load that touched 'address', as (step, pc) pairs"""
+        return [ self._step_and_pc(i) for i in self.accesses(address, (LOAD,)) ]
+
+    def _byte_value(self, i, address):
+        # The byte at 'address' from access i
+        base = self.mem_address[i]
+        size = self.mem_size[i]
+        offset = (address - base) % size
+        return (self.mem_data[i] >> (8 * offset)) & 0xff
+
+    def memory_at(self, address, step, size = 4):
+        """Value at 'address' as of the end of 'step', from the last access to each
+        byte that's in the trace. Returns None if any byte was never seen.
+        """
+        row = self.row_for_step(step)
+        value = 0
+        for b in range(size):
+            found = self._last_access(address + b, row)
+            if found is None:
+                return None
+            value |= self._byte_value(found, address + b) << (8 * b)
+        return value
+
+    def register_at(self, reg, step):
+        """Value of a register at the end of 'step'"""
+        r = reg_names.index(reg) if isinstance(reg, str) else reg
+        row = self.row_for_step(step)
+        i = bisect.bisect_right(self.reg_rows[r], row) - 1
+        if i >= 0:
+            return self.reg_values[r][i]
+
+    def first_step_where(self, reg, value, start = 0):
+        """First step, at or after 'start', that ends with a register equal to 'value'"""
+        r = reg_names.index(reg) if isinstance(reg, str) else reg
+        values = self.reg_values[r]
+        rows = self.reg_rows[r]
+        row = bisect.bisect_left(self.step_count, start)
+        if row >= len(self.step_count):
+            return None
+
+        # Maybe it already had that value going in
+        i = bisect.bisect_right(rows, row) - 1
+        if i >= 0 and values[i] == value:
+            return self.step_count[row]
+
+        try:
+            i = _index_from(values, value, i + 1)
+        except ValueError:
+            return None
+        return self.step_count[rows[i]]
+
+    def steps_at(self, pc):
+        """Steps that finished with 'pc' as the next instruction"""
+        lo = bisect.bisect_left(self.pc_sorted, pc)
+        hi = bisect.bisect_right(self.pc_sorted, pc)
+        return sorted(self.step_count[self.pc_order[j]] for j in xrange(lo, hi))
+
+
+def _index_from(a, value, start):
+    # array.index() with a starting point. Slices of arrays are arrays, so
+    # this stays in C except for the copy.
+    return a[start:].index(value) + start
+
+
+def hexint(s):
+    return int(s, 16)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Index and query SimARM traces')
+    parser.add_argument('trace', help = 'Text trace.log, binary trace, or saved index')
+    parser.add_argument('-S', '--save', metavar = 'FILE', help = 'Save the index for next time')
+    parser.add_argument('--stores', type = hexint, metavar = 'ADDR', action = 'append', default = [], help = 'Steps and PCs that stored to an address')
+    parser.add_argument('--loads', type = hexint, metavar = 'ADDR', action = 'append', default = [], help = 'Steps and PCs that loaded from an address')
+    parser.add_argument('--first', metavar = 'REG=VALUE', action = 'append', default = [], help = 'First step where a register has a value')
+    parser.add_argument('--mem', metavar = 'ADDR@STEP', action = 'append', default = [], help = 'Memory word at a step')
+    parser.add_argument('--pc', type = hexint, action = 'append', default = [], help = 'Steps where the next instruction is at PC')
+    args = parser.parse_args()
+
+    idx = TraceIndex.from_file(args.trace)
+    print idx
+    if args.save:
+        idx.save(args.save)
+
+    for address in args.stores:
+        for step, pc in idx.stores_to(address):
+            print 'store %08x  step %d  pc %s' % (address, step, pc is not None and '%08x' % pc)
+    for address in args.loads:
+        for step, pc in idx.loads_from(address):
+            print 'load  %08x  step %d  pc %s' % (address, step, pc is not None and '%08x' % pc)
+    for q in args.first:
+        reg, value = q.split('=')
+        print 'first %s == %s  step %s' % (reg, value, idx.first_step_where(reg, hexint(value)))
+    for q in args.mem:
+        address, step = q.split('@')
+        value = idx.memory_at(hexint(address), int(step))
+        print 'mem   %s @ %s  %s' % (address, step, value is not None and '%08x' % value)
+    for pc in args.pc:
+        print 'pc    %08x  steps %s' % (pc, idx.steps_at(pc))
@@ -0,0 +1,201 @@
+# Python models of memory-mapped peripherals, for the ARM simulator.
+#
+# SimARMMemory checks its PeripheralRegistry before sending a load or store
+# to the device. Registers that are modeled here never cost a round trip,
+# and with enough of them the simulator can run with no hardware at all.
+#
+# These are models of the interfaces the firmware uses, not of the hardware
+# behind them: the timer advances a little on every read, and the 8051
+# control registers answer the cr_read/cr_write handshake from mt1939_arm.h
+# without running any 8051 code.
+
+__all__ = [
+    'PeripheralRegistry', 'Peripheral', 'SysTimer', 'GPIO',
+    'CPU8051Registers', 'MemoryRegionControl', 'default_peripherals',
+]
+
+import struct, bisect
+
+size_formats = { 1: '<B', 2: '<H', 4: '<I' }
+
+
+class PeripheralRegistry(object):
+    """Address-range lookup for peripheral models"""
+
+    def __init__(self):
+        self.starts = []
+        self.peripherals = []
+
+    def __iter__(self):
+        return iter(self.peripherals)
+
+    def add(self, p):
+        i = bisect.bisect_right(self.starts, p.base)
+        if i > 0 and self.starts[i-1] + self.peripherals[i-1].size > p.base:
+            raise ValueError("%s overlaps %s" % (p.name, self.peripherals[i-1].name))
+        if i < len(self.starts) and p.base + p.size > self.starts[i]:
+            raise ValueError("%s overlaps %s" % (p.name, self.peripherals[i].name))
+        self.starts.insert(i, p.base)
+        self.peripherals.insert(i, p)
+        return p
+
+    def find(self, address):
+        """Return the peripheral covering an address, or None"""
+        i = bisect.bisect_right(self.starts, address) - 1
+        if i >= 0:
+            p = self.peripherals[i]
+            if address < p.base + p.size:
+                return p
+
+    def overlaps(self, address, size):
+        """Is any of the 'size' bytes at 'address' covered by a peripheral?"""
+        i = bisect.bisect_right(self.starts, address + size - 1) - 1
+        if i >= 0:
+            p = self.peripherals[i]
+            return address < p.base + p.size
+        return False
+
+
+class Peripheral(object):
+    """A block of registers that keep whatever is written to them.
+    Subclasses override load() and store() for registers with side effects.
+    """
+    name = 'registers'
+
+    def __init__(self, base, size):
+        self.base = base
+        self.size = size
+        self.data = bytearray(size)
+
+    def __repr__(self):
+        return '<%s %08x-%08x>' % (self.name, self.base, self.base + self.size - 1)
+
+    def load(self, address, size):
+        return struct.unpack_from(size_formats[size], self.data, address - self.base)[0]
+
+    def store(self, address, value, size):
+        struct.pack_into(size_formats[size], self.data, address - self.base, value & ((1 << (size * 8)) - 1))
+
+    def skip_reads(self, address, size, count):
+        """Act as if a register had been read 'count' more times.
+        The simulator uses this when it fast-forwards an idle loop.
+        """
+        pass
+
+
+class SysTimer(Peripheral):
+    """The free-running 512 kHz SysTime counter.
+
+    Simulated time only moves when the firmware looks at it: every read
+    advances the counter by 'ticks_per_read'. This keeps wait loops short
+    and deterministic.
+    """
+    name = 'systime'
+    hz = 512 * 1024
+
+    def __init__(self, base = 0x4002078, ticks_per_read = 64):
+        Peripheral.__init__(self, base, 4)
+        self.ticks = 0
+        self.ticks_per_read = ticks_per_read
+
+    def advance(self, ticks):
+        self.ticks = (self.ticks + ticks) & 0xffffffff
+
+    def load(self, address, size):
+        self.advance(self.ticks_per_read)
+        return (self.ticks >> ((address - self.base) * 8)) & ((1 << (size * 8)) - 1)
+
+    def skip_reads(self, address, size, count):
+        self.advance(self.ticks_per_read * count)
+
+    def store(self, address, value, size):
+        # Read-only on hardware
+        pass
+
+
+class GPIO(Peripheral):
+    """LED, solenoid, and bitbang serial GPIOs. Plain storage."""
+    name = 'gpio'
+
+    def __init__(self, base = 0x04002088):
+        Peripheral.__init__(self, base, 4)
+
+
+class MemoryRegionControl(Peripheral):
+    """Memory region control flags and DRAM/stack region settings. Plain storage."""
+    name = 'memregion'
+
+    def __init__(self, base = 0x04030f00):
+        Peripheral.__init__(self, base, 0x100)
+
+
+class CPU8051Registers(Peripheral):
+    """The ARM side of the 8051 coprocessor control registers.
+
+    Each access to a control register in 0x41f4xxx sets bit 0 of the flags
+    register, and reads latch the register's value into the data register.
+    The firmware upload registers (d50, d51, d52) and the run control (dcc)
+    keep enough state for firmware_install() and status() to work.
+    """
+    name = 'cpu8051'
+
+    flags_address = 0x41f5c0c
+    data_address = 0x41f5c08
+
+    def __init__(self, base = 0x41f4000):
+        Peripheral.__init__(self, base, 0x2000)
+        self.flags = 0
+        self.data_reg = 0
+        self.cr = { 0x41f4dcc: 8 }
+        self.firmware = bytearray(0x2000)
+        self.firmware_address = 0
+
+    def load(self, address, size):
+        if address == self.flags_address:
+            return self.flags
+        if address == self.data_address:
+            return self.data_reg
+        if address < 0x41f5000:
+            value = self.cr_load(address)
+            self.data_reg = value
+            self.flags |= 1
+            return value
+        return Peripheral.load(self, address, size)
+
+    def store(self, address, value, size):
+        if address == self.flags_address:
+            self.flags = value & 0xff
+        elif address == self.data_address:
+            self.data_reg = value & 0xff
+        elif address < 0x41f5000:
+            self.cr_store(address, value & 0xff)
+            self.flags |= 1
+        else:
+            Peripheral.store(self, address, value, size)
+
+    def skip_reads(self, address, size, count):
+        if address == 0x41f4d52:
+            self.firmware_address += count
+
+    def cr_load(self, address):
+        if address == 0x41f4d52:
+            value = self.firmware[self.firmware_address & 0x1fff]
+            self.firmware_address += 1
+            return value
+        return self.cr.get(address, 0)
+
+    def cr_store(self, address, value):
+        self.cr[address] = value
+        if address == 0x41f4d50:
+            self.firmware[self.firmware_address & 0x1fff] = value
+            self.firmware_address += 1
+        elif address == 0x41f4d51 and (value & 1):
+            self.firmware_address = 0
+        elif address == 0x41f4dcc and value == 0:
+            # CPU started; the boot status the real firmware would report
+            self.cr[0x41f4d91] = 1
+
+
+def default_peripherals():
+    """New instances of every peripheral model we have"""
+    return [ SysTimer(), GPIO(), CPU8051Registers(), MemoryRegionControl() ]
@@ -0,0 +1,178 @@
+# Run one firmware routine against many inputs, in parallel.
+#
+# SimPool takes a template SimARM backed by an ImageDevice, already set up
+# with whatever local RAM, patches and hooks the routine needs, and forks
+# worker processes from it. Each worker inherits the template copy-on-write:
+# the flash image is an mmap, and the instruction cache and translated blocks
+# the template has built so far don't need to be made again. Workers don't
+# use the template's DecodeCache file, since they'd share one file offset.
+# Run a job or two with run() in this process before the first map() to
+# warm them up for every worker.
+#
+# A job is an (entry, regs, patches) tuple. 'regs' maps register numbers or
+# names to values, and 'patches' maps RAM addresses to strings of bytes; both
+# can be None. Every job starts from the template's memory, calls 'entry' the
+# way ImageDevice.blx() would, and comes back as a SimResult with the final
+# registers and each page of RAM that ended up different.
+#
+# This needs fork(), so it's for Linux and Mac hosts, and there's no way to
+# share a real device between processes.
+
+__all__ = [ 'SimPool', 'SimResult' ]
+
+import multiprocessing
+from sim_arm_core import PAGE_SIZE, PAGE_SHIFT
+from image_device import ImageDevice
+from target_memory import sim_blx_stack
+
+# The pool whose template the next fork should inherit
+_forking = None
+
+
+def _init_worker():
+    # The template's DecodeCache file is shared with us, offset and all, and
+    # its seek-then-read lookups would trip over the other workers. Anything
+    # new a worker decodes stays in its own memory.
+    _forking.arm.memory.decode_cache = None
+
+
+def _run_job(job):
+    return _forking.run(job)
+
+
+class SimResult(object):
+    """What one job did. 'pages' maps page addresses to PAGE_SIZE strings."""
+
+    def __init__(self, entry):
+        self.entry = entry
+        self.regs = None
+        self.steps = 0
+        self.returned = False
+        self.pages = {}
+        self.error = None
+
+    def __repr__(self):
+        if self.error:
+            status = self.error
+        elif self.returned:
+            status = 'r0=%08x, %d dirty pages' % (self.regs[0], len(self.pages))
+        else:
+            status = "didn't return"
+        return '<SimResult %08x, %d steps, %s>' % (self.entry, self.steps, status)
+
+
+class SimPool(object):
+    """Process pool for running jobs on copies of a template SimARM"""
+
+    # Most instructions one job may take, like ImageDevice.blx_step_limit
+    step_limit = 10000000
+
+    def __init__(self, arm, processes = None):
+        if not isinstance(arm.memory.device, ImageDevice):
+            raise TypeError("SimPool needs a simulator backed by an ImageDevice")
+        self.arm = arm
+        self.processes = processes or multiprocessing.cpu_count()
+        self.pool = None
+        self._base = None
+
+    def __repr__(self):
+        return '<SimPool, %d processes, %s>' % (
+            self.processes, 'running' if self.pool else 'not started')
+
+    def _checkpoint(self):
+        # Everything jobs are allowed to change, as it was before the first one
+        memory = self.arm.memory
+        device = memory.device
+        self._base = (memory.checkpoint(), device.pages)
+        device.pages = dict((k, bytearray(v)) for k, v in device.pages.items())
+
+    def start(self):
+        """Fork the worker processes. map() does this when it's first needed."""
+        global _forking
+        if self.pool is None:
+            if self._base is None:
+                self._checkpoint()
+            _forking = self
+            self.pool = multiprocessing.Pool(self.processes, _init_worker)
+
+    def close(self):
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def map(self, jobs, chunksize = 1):
+        """Run a batch of jobs in the workers, and return a list of SimResults in order"""
+        return list(self.imap(jobs, chunksize))
+
+    def imap(self, jobs, chunksize = 1):
+        """Run jobs in the workers, yielding SimResults in order as they finish"""
+        self.start()
+        return self.pool.imap(_run_job, jobs, chunksize)
+
+    def run(self, job):
+        """Run one job in this process. Returns a SimResult."""
+        if self._base is None:
+            self._checkpoint()
+        arm = self.arm
+        memory = arm.memory
+        device = memory.device
+        entry, regs, patches = job
+        result = SimResult(entry)
+
+        snapshot, device_pages = self._base
+        memory.restore(snapshot)
+        device.pages = dict((k, bytearray(v)) for k, v in device_pages.items())
+
+        arm.reset(entry)
+        arm.regs[13] = sim_blx_stack
+        try:
+            for r, value in (regs or {}).items():
+                arm.regs[arm.reg_numbers.get(r, r)] = value & 0xffffffff
+            for address, data in sorted((patches or {}).items()):
+                if address < device.flash_size:
+                    raise ValueError("Can't patch flash at %08x from a job" % address)
+                if memory.region_kind(address, len(data)) == 'local':
+                    memory.write_local(address, data)
+                else:
+                    device.write(address, data)
+
+            while arm.regs[15] != device.blx_return and arm.step_count < self.step_limit:
+                arm.step(min(self.step_limit - arm.step_count, 10000), breakpoint = device.blx_return)
+            memory.flush()
+            result.returned = arm.regs[15] == device.blx_return
+
+        except Exception as e:
+            # Exceptions don't always survive the trip back from a worker
+            result.error = '%s: %s' % (type(e).__name__, e)
+
+        result.regs = list(arm.regs)
+        result.steps = arm.step_count
+        result.pages = self._dirty_pages(snapshot, device_pages)
+        return result
+
+    def _dirty_pages(self, snapshot, device_pages):
+        memory = self.arm.memory
+        device = memory.device
+        shared, local_pages, partial_pages = snapshot[:3]
+        zero = bytearray(PAGE_SIZE)
+        pages = {}
+
+        # Local RAM. Flash that got cached during the job isn't interesting.
+        for pnum, data in memory.pages.items():
+            if pnum in local_pages and data != shared.get(pnum, zero):
+                pages[pnum << PAGE_SHIFT] = str(data)
+        for pnum, (data, flags) in memory.partial_pages.items():
+            if pnum not in partial_pages or data != partial_pages[pnum][0]:
+                pages[pnum << PAGE_SHIFT] = str(data)
+
+        # RAM on the device, in the same size pages
+        for dnum, data in device.pages.items():
+            before = device_pages.get(dnum)
+            if before == data:
+                continue
+            for offset in range(0, device.page_size, PAGE_SIZE):
+                chunk = data[offset:offset + PAGE_SIZE]
+                if chunk != (zero if before is None else before[offset:offset + PAGE_SIZE]):
+                    pages[dnum * device.page_size + offset] = str(chunk)
+        return pages
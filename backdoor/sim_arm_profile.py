@@ -0,0 +1,258 @@
+# Profiler for code running in the ARM simulator.
+#
+# Attach a SimProfiler to a SimARM and every step() runs one instruction at a
+# time, counting:
+#
+#   - executions of every PC, in one array of counters per 4 KiB page
+#   - host time spent in each opcode, to see what's worth optimizing in
+#     sim_arm_core.py
+#   - per-function instruction counts and host time, both inclusive and
+#     exclusive, using a shadow call stack built from bl/blx and returns
+#
+# Functions are named after their entry point. A 'bl' or 'blx' pushes a frame
+# expecting a return to the next instruction; any time the PC arrives at the
+# return address of a frame on the stack, it and everything above it pop.
+# That covers bx lr, pop {pc}, and ldm with pc, without caring which.
+#
+# Results can be saved in Python's pstats format, for pstats/snakeviz/etc,
+# or as folded stacks for flamegraph.pl.
+
+__all__ = [ 'SimProfiler' ]
+
+import array, marshal, time
+
+
+# Call instructions, with any condition code
+call_ops = set(['bl', 'blx'])
+for cc in ('eq', 'ne', 'cs', 'cc', 'hs', 'lo', 'mi', 'pl', 'vs', 'vc',
+           'hi', 'ls', 'ge', 'lt', 'gt', 'le', 'al'):
+    call_ops.add('bl' + cc)
+    call_ops.add('blx' + cc)
+
+
+class Frame(object):
+    """One level of the shadow call stack"""
+    __slots__ = ('function', 'return_address', 'steps', 'time', 'excl_steps', 'excl_time')
+
+    def __init__(self, function, return_address, steps, time):
+        self.function = function
+        self.return_address = return_address
+        self.steps = steps
+        self.time = time
+        self.excl_steps = 0
+        self.excl_time = 0.0
+
+
+class SimProfiler(object):
+    """Profiler for SimARM. Enable with arm.profiler = SimProfiler()
+
+    'names' optionally maps function addresses to names. Everything else is
+    called sub_XXXXXXXX, and the code running when profiling started is
+    called start_XXXXXXXX.
+    """
+    page_shift = 12
+
+    def __init__(self, names = {}):
+        self.names = names
+        self.pc_pages = {}
+        self.ops = {}
+        self.functions = {}
+        self.edges = {}
+        self.folded = {}
+        self.stack = []
+        self.active = {}
+        self.addresses = {}
+        self.steps = 0
+        self.time = 0.0
+
+    def function_name(self, address):
+        return self.names.get(address) or 'sub_%08x' % address
+
+    def step(self, arm, repeat, breakpoint):
+        """Stand-in for SimARM.step(), which forwards here while we're attached.
+        Hooks that reentrantly step() the simulator aren't profiled.
+        """
+        if not self.stack:
+            self._push('start_%08x' % arm.regs[15], arm.regs[15], None)
+
+        regs = arm.regs
+        fetch = arm.memory.fetch
+        timer = time.time
+        profiler, arm.profiler = arm.profiler, None
+        try:
+            while repeat > 0:
+                repeat -= 1
+                instr = fetch(regs[15], arm.thumb)
+                thumb = arm.thumb
+
+                timestamp = timer()
+                arm.step(1)
+                elapsed = timer() - timestamp
+
+                self._count(instr, elapsed)
+                pc = regs[15]
+
+                op = instr.op.split('.', 1)[0]
+                if op in call_ops and regs[14] == instr.next_address | thumb:
+                    self._push(self.function_name(pc), pc, instr.next_address)
+                else:
+                    self._check_return(pc)
+
+                if pc == breakpoint or arm.memory.watch_hits or arm.breakpoint_hit:
+                    return
+        finally:
+            arm.profiler = profiler
+
+    def _count(self, instr, elapsed):
+        address = instr.address
+        pnum = address >> self.page_shift
+        page = self.pc_pages.get(pnum)
+        if page is None:
+            page = self.pc_pages[pnum] = array.array('I', [0]) * ((1 << self.page_shift) // 2)
+        page[(address >> 1) & ((1 << (self.page_shift - 1)) - 1)] += 1
+
+        op = self.ops.get(instr.op)
+        if op is None:
+            op = self.ops[instr.op] = [0, 0.0]
+        op[0] += 1
+        op[1] += elapsed
+
+        frame = self.stack[-1]
+        frame.excl_steps += 1
+        frame.excl_time += elapsed
+        self.steps += 1
+        self.time += elapsed
+
+    def _push(self, function, address, return_address):
+        self.addresses[function] = address
+        self.stack.append(Frame(function, return_address, self.steps, self.time))
+        self.active[function] = self.active.get(function, 0) + 1
+
+    def _check_return(self, pc):
+        stack = self.stack
+        for i in range(len(stack) - 1, 0, -1):
+            if stack[i].return_address == pc:
+                while len(stack) > i:
+                    self._pop()
+                return
+
+    def _pop(self):
+        stack = self.stack
+        path = ';'.join(f.function for f in stack)
+        frame = stack.pop()
+        name = frame.function
+
+        self.active[name] -= 1
+        outermost = not self.active[name]
+        self._account(name, frame, path, outermost, stack[-1].function if stack else None)
+
+    def _account(self, name, frame, path, outermost, caller):
+        incl_steps = self.steps - frame.steps
+        incl_time = self.time - frame.time
+
+        f = self.functions.get(name)
+        if f is None:
+            f = self.functions[name] = [0, 0, 0, 0.0, 0.0]
+        f[0] += 1
+        f[1] += frame.excl_steps
+        f[3] += frame.excl_time
+        if outermost:
+            f[2] += incl_steps
+            f[4] += incl_time
+
+        if caller:
+            e = self.edges.get((caller, name))
+            if e is None:
+                e = self.edges[(caller, name)] = [0, 0.0, 0.0]
+            e[0] += 1
+            e[1] += frame.excl_time
+            if outermost:
+                e[2] += incl_time
+
+        self.folded[path] = self.folded.get(path, 0) + frame.excl_steps
+
+        # Exclusive counts are per frame instance; start this one over
+        # in case it's still live (see snapshot())
+        frame.excl_steps = 0
+        frame.excl_time = 0.0
+
+    def snapshot(self):
+        """Results so far, as (functions, edges, folded) including the live call stack.
+        functions:  name -> [calls, exclusive steps, inclusive steps, exclusive time, inclusive time]
+        edges:      (caller, callee) -> [calls, exclusive time, inclusive time]
+        folded:     'a;b;c' -> exclusive steps
+        """
+        saved = (self.functions, self.edges, self.folded)
+        self.functions = dict((k, v[:]) for k, v in saved[0].items())
+        self.edges = dict((k, v[:]) for k, v in saved[1].items())
+        self.folded = dict(saved[2])
+        stack = self.stack
+        excl = [ (f.excl_steps, f.excl_time) for f in stack ]
+        active = dict(self.active)
+        try:
+            for i in range(len(stack) - 1, -1, -1):
+                frame = stack[i]
+                path = ';'.join(f.function for f in stack[:i+1])
+                self.active[frame.function] -= 1
+                self._account(frame.function, frame, path, not self.active[frame.function],
+                              stack[i-1].function if i else None)
+            return self.functions, self.edges, self.folded
+        finally:
+            self.functions, self.edges, self.folded = saved
+            self.active = active
+            for f, (s, t) in zip(stack, excl):
+                f.excl_steps, f.excl_time = s, t
+
+    def pc_counts(self):
+        """Iterate over (address, count) for every PC that has run, in order"""
+        for pnum in sorted(self.pc_pages):
+            base = pnum << self.page_shift
+            for i, count in enumerate(self.pc_pages[pnum]):
+                if count:
+                    yield base + i * 2, count
+
+    def hot_spots(self, count = 20):
+        """The most frequently executed PCs, as (address, count)"""
+        return sorted(self.pc_counts(), key=lambda i: -i[1])[:count]
+
+    def report(self, count = 20):
+        """Text summary of the busiest functions, opcodes, and PCs"""
+        functions, edges, folded = self.snapshot()
+        lines = [ '%d instructions, %.3f seconds host time' % (self.steps, self.time), '',
+                  '%-24s %8s %12s %12s %10s' % ('function', 'calls', 'excl steps', 'incl steps', 'excl sec') ]
+        for name, f in sorted(functions.items(), key=lambda i: -i[1][1])[:count]:
+            lines.append('%-24s %8d %12d %12d %10.3f' % (name, f[0], f[1], f[2], f[3]))
+
+        lines += [ '', '%-12s %10s %10s %10s' % ('opcode', 'count', 'seconds', 'us each') ]
+        for op, (n, t) in sorted(self.ops.items(), key=lambda i: -i[1][1])[:count]:
+            lines.append('%-12s %10d %10.3f %10.2f' % (op, n, t, t / n * 1e6))
+
+        lines += [ '', '%-12s %10s' % ('pc', 'count') ]
+        for address, n in self.hot_spots(count):
+            lines.append('%08x     %10d' % (address, n))
+        return '\n'.join(lines) + '\n'
+
+    def _pstats_key(self, name):
+        # Functions are keyed by (filename, line, name). We put the address in 'line'.
+        return ('firmware', self.addresses[name], name)
+
+    def dump_stats(self, filename):
+        """Save in the format pstats.Stats() loads, with host time as the cost"""
+        functions, edges, folded = self.snapshot()
+        callers = dict((name, {}) for name in functions)
+        for (caller, callee), (n, tt, ct) in edges.items():
+            callers[callee][self._pstats_key(caller)] = (n, n, tt, ct)
+
+        stats = {}
+        for name, (calls, excl_steps, incl_steps, tt, ct) in functions.items():
+            stats[self._pstats_key(name)] = (calls, calls, tt, ct, callers[name])
+        with open(filename, 'wb') as f:
+            marshal.dump(stats, f)
+
+    def dump_folded(self, filename):
+        """Save folded stacks for flamegraph.pl, weighted by instruction count"""
+        functions, edges, folded = self.snapshot()
+        with open(filename, 'w') as f:
+            for path, steps in sorted(folded.items()):
+                if steps:
+                    f.write('%s %d\n' % (path, steps))
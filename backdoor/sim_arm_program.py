@@ -0,0 +1,82 @@
+# Decoded code, shared between simulators.
+#
+# A DecodedProgram holds the instructions decoded from each block of code
+# we've fetched, keyed like DecodeCache on (address, thumb, sha1 of the
+# block's bytes). The instructions in it are never modified once they're
+# stored, so any number of SimARMMemory objects can point their icache at
+# the same ones: threads, ImageDevice.simulate_call(), SimPool workers, and
+# memory restored from a checkpoint all share one copy of the decoded code.
+#
+# What belongs to one simulator stays out of here. HLE markers come from one
+# memory's patches, so SimARMMemory gives marked instructions a private copy.
+# The functions that actually run each instruction close over one SimARM,
+# and live in that SimARM's 'opfuncs' dict.
+
+__all__ = [ 'DecodedProgram', 'shared_program' ]
+
+import hashlib
+from sim_arm_decode import decode_lines
+
+
+class DecodedProgram(object):
+    """In-memory store of decoded instruction blocks"""
+
+    def __init__(self):
+        self.blocks = {}
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.blocks)
+
+    def __repr__(self):
+        return '<DecodedProgram, %d blocks, %d hits, %d misses>' % (
+            len(self.blocks), self.hits, self.misses)
+
+    def lookup(self, address, thumb, data, cache = None):
+        """Decoded instructions for a block of code, as a tuple.
+        The last one is only there to size the one before it.
+        On a miss, try the DecodeCache 'cache' before decoding it ourselves.
+        """
+        key = (address, thumb, hashlib.sha1(data).digest())
+        lines = self.blocks.get(key)
+        if lines is not None:
+            self.hits += 1
+            return lines
+
+        self.misses += 1
+        lines = cache is not None and cache.lookup(address, thumb, data)
+        if not lines:
+            lines = decode_lines(data, address, thumb=thumb)
+            if cache is not None:
+                cache.store(address, thumb, data, lines)
+        for i in range(len(lines) - 1):
+            lines[i].next_address = lines[i+1].address
+
+        lines = self.blocks[key] = tuple(lines)
+        return lines
+
+    def lookup_image(self, address, thumb, cache):
+        """Decoded flash code at 'address', from the image DecodeCache 'cache'
+        was opened with, without reading the code itself. None on a miss.
+        """
+        if cache is None or cache.image_key is None:
+            return None
+        key = (address, thumb, cache.image_key)
+        lines = self.blocks.get(key)
+        if lines is None:
+            lines = cache.lookup_image(address, thumb)
+            if not lines:
+                return None
+            for i in range(len(lines) - 1):
+                lines[i].next_address = lines[i+1].address
+            lines = self.blocks[key] = tuple(lines)
+        self.hits += 1
+        return lines
+
+    def clear(self):
+        self.blocks.clear()
+
+
+# Used by every SimARMMemory that isn't given its own
+shared_program = DecodedProgram()
@@ -0,0 +1,182 @@
+# Sparse, compressed snapshots of simulator state.
+#
+# One '.snap' file holds the CPU state and every local memory page that
+# isn't all zeroes. Pages are grouped into chunks, and each chunk is
+# compressed with zlib. A small marshal header up front says which pages are
+# local and where each stored page lives, with a CRC32 of its contents.
+#
+# A snapshot can be saved as a delta against a parent snapshot. Any page with
+# the same contents as the parent's copy isn't written again; the header
+# points at the parent's chunk instead. The CRC32 is only a quick check
+# before comparing the bytes themselves. Parents can have parents of their own, and
+# every file in the chain is listed in the header relative to the child.
+#
+# Loading only reads the header. The files are mapped, and a page is
+# decompressed the first time the simulator touches it.
+
+__all__ = [ 'Snapshot', 'SnapshotPages', 'write_snapshot', 'snapshot_magic' ]
+
+import marshal, mmap, os, zlib
+
+snapshot_magic = 'SimARM snapshot v1\n'
+
+# Pages per compressed chunk
+chunk_pages = 64
+
+
+def page_ranges(pnums):
+    """Sorted page numbers as a list of inclusive (first, last) runs"""
+    ranges = []
+    for pnum in sorted(pnums):
+        if ranges and ranges[-1][1] == pnum - 1:
+            ranges[-1][1] = pnum
+        else:
+            ranges.append([pnum, pnum])
+    return [ tuple(r) for r in ranges ]
+
+
+def write_snapshot(filename, core, page_size, local_pages, get_page, partial_pages, parent = None):
+    """Save a snapshot.
+
+    'core' is the SimARM state dictionary, 'local_pages' the page numbers of
+    entirely local pages, 'get_page' returns the contents of one of those (or
+    None for all zeroes), and 'partial_pages' maps page numbers to (data, flags).
+    With a 'parent' Snapshot, unchanged pages refer back to it.
+    """
+    zero_crc = zlib.crc32('\x00' * page_size)
+    index = {}
+    fresh = []
+
+    if parent:
+        files = [ os.path.relpath(parent.filename, os.path.dirname(os.path.abspath(filename))) ]
+        files += [ os.path.join(os.path.dirname(files[0]), f) for f in parent.files ]
+    else:
+        files = []
+
+    for pnum in sorted(local_pages):
+        data = get_page(pnum)
+        if data is None:
+            continue
+        data = str(data)
+        crc = zlib.crc32(data)
+        if crc == zero_crc and not data.strip('\x00'):
+            continue
+        if parent:
+            entry = parent.index.get(pnum)
+            if entry and entry[4] == crc and parent.page(pnum) == data:
+                # Same as the parent; their file 0 is our file 1, and so on
+                index[pnum] = (entry[0] + 1,) + entry[1:]
+                continue
+        fresh.append((pnum, data, crc))
+
+    chunks = []
+    offset = 0
+    for i in range(0, len(fresh), chunk_pages):
+        group = fresh[i:i + chunk_pages]
+        blob = zlib.compress(''.join(data for pnum, data, crc in group), 1)
+        for j, (pnum, data, crc) in enumerate(group):
+            index[pnum] = (0, offset, len(blob), j, crc)
+        chunks.append(blob)
+        offset += len(blob)
+
+    header = {
+        'core': core,
+        'page_size': page_size,
+        'files': files,
+        'local': page_ranges(local_pages),
+        'partial': dict((pnum, (str(data), str(flags))) for pnum, (data, flags) in partial_pages.items()),
+        'index': index,
+    }
+
+    with open(filename, 'wb') as f:
+        f.write(snapshot_magic)
+        marshal.dump(header, f)
+        for blob in chunks:
+            f.write(blob)
+
+
+class Snapshot(object):
+    """A snapshot file, opened for lazy reading"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        with open(filename, 'rb') as f:
+            if f.read(len(snapshot_magic)) != snapshot_magic:
+                raise IOError("%s is not a SimARM snapshot" % filename)
+            header = marshal.load(f)
+            base = f.tell()
+
+        self.core = header['core']
+        self.page_size = header['page_size']
+        self.files = header['files']
+        self.index = header['index']
+        self.partial = header['partial']
+        self.local = set()
+        for first, last in header['local']:
+            self.local.update(xrange(first, last + 1))
+
+        # (mapping, data offset) per file, opened on first use
+        self.maps = { 0: self._map(filename, base) }
+        self.last_chunk = (None, None)
+
+    def __repr__(self):
+        return '<Snapshot %s, %d local pages, %d stored, %d parents>' % (
+            self.filename, len(self.local), len(self.index), len(self.files))
+
+    def _map(self, filename, base = None):
+        with open(filename, 'rb') as f:
+            if base is None:
+                if f.read(len(snapshot_magic)) != snapshot_magic:
+                    raise IOError("%s is not a SimARM snapshot" % filename)
+                marshal.load(f)
+                base = f.tell()
+            f.seek(0, 2)
+            if f.tell() <= base:
+                return None, base
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ), base
+
+    def _file(self, i):
+        m = self.maps.get(i)
+        if m is None:
+            path = os.path.join(os.path.dirname(self.filename), self.files[i - 1])
+            m = self.maps[i] = self._map(path)
+        return m
+
+    def page(self, pnum):
+        """Contents of a stored page as a string, or None if it's all zeroes"""
+        entry = self.index.get(pnum)
+        if entry is None:
+            return None
+        file, offset, length, i, crc = entry
+        key = (file, offset)
+        if self.last_chunk[0] != key:
+            data, base = self._file(file)
+            self.last_chunk = (key, zlib.decompress(data[base + offset : base + offset + length]))
+        size = self.page_size
+        return self.last_chunk[1][i * size : (i + 1) * size]
+
+    def verify(self):
+        """Check every stored page against its CRC32. Returns a list of bad page numbers."""
+        return [ pnum for pnum in sorted(self.index)
+                 if zlib.crc32(self.page(pnum)) != self.index[pnum][4] ]
+
+
+class SnapshotPages(dict):
+    """Read-only page dictionary that fills itself from a Snapshot as pages
+    are asked for. Suitable for SimARMMemory.shared_pages.
+    """
+    def __init__(self, snapshot, pages = ()):
+        dict.__init__(self, pages)
+        self.snapshot = snapshot
+
+    def get(self, pnum, default = None):
+        data = dict.get(self, pnum)
+        if data is None:
+            data = self.snapshot.page(pnum)
+            if data is None:
+                return default
+            self[pnum] = data
+        return data
+
+    def copy(self):
+        return SnapshotPages(self.snapshot, self)
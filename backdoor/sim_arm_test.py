@@ -0,0 +1,717 @@
+#!/usr/bin/env python
+#
+# Self-test for the ARM simulator. Unlike test.py this needs no hardware:
+# everything runs on an ImageDevice with a blank flash image.
+#
+# Loop idioms are checked differentially. We generate small fill, copy and
+# delay loops with random registers, run each one with recognize_loops on
+# and off, and the results have to match exactly. That includes every call
+# made to the device, so loops over MMIO registers must not be bulked up.
+#
+# ImageDevice.blx() runs calls in a simulator of its own, and has to leave
+# memory as the call left it.
+#
+# Events scheduled from a hook have to fire on time, even in a long step().
+#
+# The rest of the simulator's shortcuts are checked the same way, each
+# against the slow path it stands in for: translated blocks against single
+# steps, lazy flags against flags evaluated after every instruction, the
+# write buffer against sending each store right away, paged local memory
+# against a flat model of it, snapshots against the state they were saved
+# from, and scheduled events against the steps they were due at.
+#
+# The decoder hands SimARM structured operands along with the text, and
+# parse_operands() of that text has to give the same thing back, since it's
+# what code from the assembler gets. If arm-none-eabi-objdump is around, the
+# decoder is also compared against it, over a firmware image if one is given:
+#
+#   ./sim_arm_test.py bin/SE-506CB_TS01.bin
+
+import sys, os, random, struct, shutil, tempfile
+from code import OBJDUMP, disassemble_string, disassembly_lines
+from image_device import ImageDevice
+from sim_arm_core import SimARM, SimARMMemory, flags_tuple
+from sim_arm_events import Event, Interrupt
+from sim_arm_decode import decode_lines, parse_operands
+from sim_arm_bench import thumb_code, arm_code
+
+ram = 0x1c00000
+ram_size = 0x10000
+
+# Hardware registers, on the device rather than in local RAM
+mmio = 0x4010000
+
+# Device RAM that isn't local, so stores to it go through the write buffer
+device_ram = 0x1c20000
+
+# Thumb condition codes we branch back on
+loop_conditions = (0, 1, 2, 3, 4, 5, 8, 9, 10, 11, 12, 13)
+
+
+def random_loop(rng):
+    """Halfwords for a Thumb loop at 0x2000, ending with 'b .'"""
+    body = []
+    kind = rng.choice(('fill', 'copy', 'delay'))
+    if kind == 'copy':
+        body.append(rng.choice((0x680b, 0x780b)))          # ldr/ldrb r3, [r1]
+        body.append(0x3100 | rng.choice((1, 2, 4)))        # adds r1, #k
+    if kind != 'delay':
+        body.append(rng.choice((0x6003, 0x8003, 0x7003)))  # str/strh/strb r3, [r0]
+        body.append(0x3000 | rng.choice((1, 2, 4)))        # adds r0, #k
+    k = rng.choice((1, 2, 3, 4))
+    counter = rng.choice((0x3a00 | k, 0x3200 | k))         # subs/adds r2, #k
+    if rng.random() < 0.3:
+        body += [ 0x3200 | k, 0x42ba ]                     # adds r2, #k; cmp r2, r7
+    else:
+        body.append(counter)
+    offset = -(len(body) + 2) & 0xff
+    body.append(0xd000 | (rng.choice(loop_conditions) << 8) | offset)
+    return body + [ 0xe7fe ]
+
+
+class CallLog(object):
+    """Device proxy that remembers every call made to it"""
+
+    def __init__(self, device):
+        self.device = device
+        self.calls = []
+
+    def __getattr__(self, name):
+        fn = getattr(self.device, name)
+        if not callable(fn):
+            return fn
+        def call(*args):
+            self.calls.append((name,) + args)
+            return fn(*args)
+        return call
+
+
+def random_value(rng):
+    return rng.choice((ram + rng.randrange(0x1000), rng.randrange(0x400),
+                       0x80000000 - rng.randrange(8), 0xffffffff - rng.randrange(8),
+                       rng.randrange(1 << 32)))
+
+
+def run_loop(code, regs, steps, idioms):
+    d = CallLog(ImageDevice())
+    d.device.write_flash(0x2000, thumb_code(*code))
+    m = SimARMMemory(d)
+    m.local_ram(ram, ram + ram_size - 1)
+    arm = SimARM(m)
+    arm.recognize_loops = idioms
+    arm.reset(0x2001)
+    for r, v in regs.items():
+        arm.regs[r] = v
+    error = None
+    try:
+        arm.step(steps)
+        m.flush()
+    except Exception as e:
+        error = type(e).__name__
+    return error, arm.capture(), arm.step_count, m.read_local(ram, ram_size), d.calls
+
+
+def test_loop_idioms(cases = 1200, seed = 1):
+    rng = random.Random(seed)
+    mismatches = 0
+    for case in range(cases):
+        code = random_loop(rng)
+        regs = dict((r, random_value(rng)) for r in (0, 1, 2, 3, 7))
+        regs[0] = ram + rng.randrange(0x4000)
+        regs[1] = ram + 0x8000 + rng.randrange(0x4000)
+        if rng.random() < 0.1:
+            regs[rng.choice((0, 1))] = mmio + rng.randrange(0x100)
+        steps = rng.choice((50, 500, 3000))
+        stepped = run_loop(code, regs, steps, False)
+        bulk = run_loop(code, regs, steps, True)
+        if stepped != bulk:
+            mismatches += 1
+            print 'Loop idiom mismatch: code %s regs %s steps %d' % (
+                ' '.join('%04x' % h for h in code),
+                dict((r, '%08x' % v) for r, v in regs.items()), steps)
+            print '  stepped %r %r %d' % stepped[:3]
+            print '  bulk    %r %r %d' % bulk[:3]
+    assert mismatches == 0, '%d of %d loops ran differently as idioms' % (mismatches, cases)
+    print 'Loop idioms: %d loops match' % cases
+
+
+def test_simulate_call():
+    d = ImageDevice()
+    d.write_flash(0x3000, thumb_code(
+        0x4901,             # ldr r1, [pc, #4]
+        0x6008,             # str r0, [r1]
+        0x4770,             # bx lr
+        0x46c0,             # nop
+        0x0100, 0x01c0))    # .word 0x1c00100
+    d.blx(0x3001, 0x12345678)
+    assert d.peek(0x1c00100) == 0x12345678, 'Store from blx() is missing, %08x' % d.peek(0x1c00100)
+    print 'Simulated call: ok'
+
+
+def run_hook_events(stepsize, steps = 3000):
+    d = ImageDevice()
+    d.write_flash(0x2000, thumb_code(
+        0x3001,             # adds r0, #1
+        0x46c0,             # nop
+        0xe7fc))            # b 0x2000
+    arm = SimARM(SimARMMemory(d))
+    fired = []
+    def event(arm):
+        fired.append((arm.step_count, arm.regs[0]))
+    def hook(arm):
+        if not arm.events.queue:
+            arm.events.after(37, Event(event))
+    arm.memory.hook(0x2002, hook)
+    arm.reset(0x2001)
+    while arm.step_count < steps:
+        arm.step(stepsize)
+    return fired, arm.capture()
+
+
+def test_hook_events():
+    single = run_hook_events(1)
+    bulk = run_hook_events(3000)
+    assert single == bulk, 'Events from hooks fired at %r, not %r' % (bulk[0][:3], single[0][:3])
+    print 'Hook events: %d fired on time' % len(single[0])
+
+
+def random_alu(rng):
+    """One Thumb data processing instruction that leaves r0 and r1 alone"""
+    rd = rng.randrange(2, 8)
+    rn = rng.randrange(8)
+    rm = rng.randrange(8)
+    kind = rng.randrange(6)
+    if kind == 0:
+        return rng.choice((0x2000, 0x3000, 0x3800)) | (rd << 8) | rng.randrange(0x100)
+    if kind == 1:
+        return 0x2800 | (rn << 8) | rng.randrange(0x100)                       # cmp rn, #imm
+    if kind == 2:
+        return rng.choice((0x1800, 0x1a00, 0x1c00, 0x1e00)) | (rm << 6) | (rn << 3) | rd
+    if kind == 3:
+        return rng.choice((0x0000, 0x0800, 0x1000)) | (rng.randrange(32) << 6) | (rm << 3) | rd
+    op = rng.randrange(16)
+    if op in (8, 10, 11):
+        rd = rn                                                                # tst/cmp/cmn
+    return 0x4000 | (op << 6) | (rm << 3) | rd
+
+
+def random_memop(rng):
+    """One Thumb load or store through r0 or r1, or a load from the literal pool"""
+    rd = rng.randrange(2, 8)
+    if rng.random() < 0.15:
+        return 0x4800 | (rd << 8) | rng.randrange(0x100)                       # ldr rd, [pc, #imm]
+    op = rng.choice((0x6000, 0x6800, 0x7000, 0x7800, 0x8000, 0x8800))
+    if not op & 0x800:
+        rd = rng.randrange(8)
+    return op | (rng.randrange(32) << 6) | (rng.randrange(2) << 3) | rd
+
+
+def random_code(rng):
+    """Halfwords for straight-line Thumb code at 0x2000 that branches back to the top.
+    Conditional branches skip over one instruction, and every push is popped.
+    """
+    code = []
+    for n in range(rng.randrange(4, 100)):
+        kind = rng.random()
+        if kind < 0.2:
+            code += [ 0xd000 | (rng.choice(loop_conditions) << 8), random_alu(rng) ]
+        elif kind < 0.25:
+            regs = rng.randrange(1, 0x100)
+            code += [ 0xb400 | regs, random_alu(rng), 0xbc00 | regs ]          # push, pop
+        elif kind < 0.5:
+            code.append(random_memop(rng))
+        else:
+            code.append(random_alu(rng))
+    return code + [ 0xe000 | (-(len(code) + 2) & 0x7ff) ]
+
+
+def random_registers(rng):
+    regs = dict((r, random_value(rng)) for r in range(2, 8))
+    regs[0] = ram + rng.randrange(0x4000)
+    regs[1] = rng.choice((ram + rng.randrange(0x4000), device_ram + rng.randrange(0x400),
+                          mmio + rng.randrange(0x100)))
+    regs[13] = ram + 0xc000
+    return regs
+
+
+def new_simulator(code, regs, device = None):
+    """A SimARM running 'code' in Thumb state at 0x2000, without loop idioms"""
+    d = device or CallLog(ImageDevice())
+    d.write_flash(0x2000, thumb_code(*code))
+    m = SimARMMemory(d)
+    m.local_ram(ram, ram + ram_size - 1)
+    arm = SimARM(m)
+    arm.recognize_loops = False
+    arm.reset(0x2001)
+    for r, v in regs.items():
+        arm.regs[r] = v
+    return arm
+
+
+def run_code(code, regs, steps, chunks):
+    """Run for 'steps' steps, calling step() with the counts chunks() gives"""
+    arm = new_simulator(code, regs)
+    error = None
+    try:
+        while arm.step_count < steps:
+            arm.step(min(chunks(), steps - arm.step_count))
+        arm.memory.flush()
+    except Exception as e:
+        error = type(e).__name__
+
+    # Translating a block reads flash ahead, which changes when we read it but not what we get
+    calls = [ c for c in arm.memory.device.calls if not (c[0] == 'read_block' and c[1] < 0x200000) ]
+    return error, arm.capture(), arm.step_count, arm.memory.read_local(ram, ram_size), calls
+
+
+def test_blocks(cases = 300, seed = 1):
+    rng = random.Random(seed)
+    mismatches = errors = 0
+    for case in range(cases):
+        code = random_code(rng)
+        regs = random_registers(rng)
+        steps = rng.choice((100, 500, 2000))
+        chunk_rng = random.Random(case)
+        stepped = run_code(code, regs, steps, lambda: 1)
+        runs = (run_code(code, regs, steps, lambda: steps),
+                run_code(code, regs, steps, lambda: chunk_rng.choice((2, 7, 63, 64, 65, 200))))
+        errors += stepped[0] is not None
+        for run in runs:
+            if run != stepped:
+                mismatches += 1
+                print 'Block mismatch: code %s regs %s steps %d' % (
+                    ' '.join('%04x' % h for h in code),
+                    dict((r, '%08x' % v) for r, v in regs.items()), steps)
+                print '  stepped %r %r %d %s' % (stepped[:3] + (stepped[1].diff(run[1]),))
+                print '  blocks  %r %r %d' % run[:3]
+    assert mismatches == 0, '%d of %d runs in blocks differ from single steps' % (mismatches, cases * 2)
+    print 'Blocks: %d runs match single steps, %d ended in errors' % (cases * 2, errors)
+
+
+def run_flags(code, regs, steps, chunks, eager):
+    """Flags at each stop, read with nzcv or, without settling them, with flags_tuple()"""
+    arm = new_simulator(code, regs)
+    error = None
+    flags = {}
+    try:
+        while arm.step_count < steps:
+            arm.step(min(chunks(), steps - arm.step_count))
+            if eager:
+                nzcv = arm.nzcv
+            else:
+                nzcv = flags_tuple(arm._flags)
+            flags[arm.step_count] = (arm.regs[15], tuple(map(bool, nzcv)))
+    except Exception as e:
+        error = type(e).__name__
+    return error, flags
+
+
+def test_lazy_flags(cases = 300, seed = 2):
+    rng = random.Random(seed)
+    mismatches = 0
+    for case in range(cases):
+        code = random_code(rng)
+        regs = random_registers(rng)
+        steps = rng.choice((100, 500))
+        chunk_rng = random.Random(case)
+        eager = run_flags(code, regs, steps, lambda: 1, True)
+        lazy = run_flags(code, regs, steps, lambda: chunk_rng.choice((1, 1, 2, 5, 64, 100)), False)
+        wrong = [ n for n in sorted(lazy[1]) if lazy[1][n] != eager[1].get(n) ]
+        if wrong or lazy[0] != eager[0]:
+            mismatches += 1
+            print 'Flags mismatch: code %s regs %s' % (
+                ' '.join('%04x' % h for h in code),
+                dict((r, '%08x' % v) for r, v in regs.items()))
+            if wrong:
+                print '  at step %d, eager %r lazy %r' % (wrong[0], eager[1].get(wrong[0]), lazy[1][wrong[0]])
+    assert mismatches == 0, '%d of %d runs have lazy flags that differ' % (mismatches, cases)
+    print 'Lazy flags: %d runs match flags evaluated every step' % cases
+
+
+class UnbufferedMemory(SimARMMemory):
+    """Sends every store to the device as soon as it's made, for checking the write buffer"""
+
+    def buffer_store(self, address, data, size):
+        self.post_store(address, data, size)
+
+
+def random_address(rng, size, window = 0x300):
+    """Mostly device RAM, some MMIO, and some just below MMIO space"""
+    kind = rng.random()
+    if kind < 0.1:
+        return mmio + (rng.randrange(window) & -size)
+    if kind < 0.2:
+        return (SimARMMemory.mmio_base - rng.randrange(1, 0x40)) & -size
+    return device_ram + (rng.randrange(window) & -size)
+
+
+def random_stores(rng, count = 300):
+    """(size, address, value) for runs of stores, some repeating a value and some
+    crossing into MMIO space, with a few loads. A value of None is a load.
+    """
+    ops = []
+    while len(ops) < count:
+        size = rng.choice((1, 2, 4))
+        address = random_address(rng, size)
+        value = rng.getrandbits(8 * size)
+        repeat = rng.random() < 0.5
+        for n in range(rng.choice((1, 2, 5, 20, 40))):
+            if rng.random() < 0.05:
+                load_size = rng.choice((1, 2, 4))
+                ops.append((load_size, random_address(rng, load_size), None))
+            ops.append((size, address, value))
+            address += rng.choice((size, size, size, 0, -size))
+            if not repeat:
+                value = rng.getrandbits(8 * size)
+    return ops
+
+
+def run_stores(memory_class, ops, initial):
+    d = CallLog(ImageDevice())
+    d.device.write(device_ram, initial)
+    m = memory_class(d)
+    loads = { 1: m.load_byte, 2: m.load_half, 4: m.load }
+    stores = { 1: m.store_byte, 2: m.store_half, 4: m.store }
+    loaded = []
+    for size, address, value in ops:
+        if value is None:
+            loaded.append(loads[size](address))
+        else:
+            stores[size](address, value)
+    m.flush()
+    hardware = [ c for c in d.calls if len(c) > 1 and isinstance(c[1], (int, long)) and c[1] >= m.mmio_base ]
+    below = d.device.read(m.mmio_base - 0x40, 0x40)
+    return loaded, d.device.read(device_ram, len(initial)), below, hardware
+
+
+def test_store_buffer(cases = 200, seed = 3):
+    rng = random.Random(seed)
+    mismatches = 0
+    for case in range(cases):
+        ops = random_stores(rng)
+        initial = ''.join(chr(rng.getrandbits(8)) for n in range(0x400))
+        expected = run_stores(UnbufferedMemory, ops, initial)
+        buffered = run_stores(SimARMMemory, ops, initial)
+        if buffered != expected:
+            mismatches += 1
+            print 'Store buffer mismatch in case %d:' % case
+            for name, a, b in zip(('loads', 'memory', 'memory below mmio', 'mmio'), expected, buffered):
+                if a != b:
+                    print '  %s differ' % name
+    assert mismatches == 0, '%d of %d store sequences came out differently' % (mismatches, cases)
+    print 'Store buffer: %d store sequences match' % cases
+
+
+class LocalMemoryModel(object):
+    """What SimARMMemory's local pages should hold, as flat arrays.
+    Bytes become local with a value of zero, and everything else is on the device.
+    """
+
+    def __init__(self, address, initial):
+        self.address = address
+        self.local = bytearray(len(initial))
+        self.data = bytearray(len(initial))
+        self.device = bytearray(initial)
+
+    def is_local(self, address, size):
+        offset = address - self.address
+        return '\x00' not in self.local[offset:offset + size]
+
+    def local_ram(self, begin, end):
+        for offset in range(begin - self.address, end + 1 - self.address):
+            if not self.local[offset]:
+                self.local[offset] = 1
+                self.data[offset] = 0
+
+    def read(self, address, size):
+        offset = address - self.address
+        if self.is_local(address, size):
+            return str(self.data[offset:offset + size])
+        return str(self.device[offset:offset + size])
+
+    def write(self, address, s):
+        offset = address - self.address
+        if self.is_local(address, len(s)):
+            self.data[offset:offset + len(s)] = s
+        else:
+            self.device[offset:offset + len(s)] = s
+
+    def available(self, address, limit):
+        offset = address - self.address
+        count = 0
+        while count < limit and self.local[offset + count]:
+            count += 1
+        return count
+
+    def region_kind(self, address, size, store):
+        if self.is_local(address, size):
+            return 'local'
+        first = (address - self.address) & ~0xff
+        last = (address + size - 1 - self.address) | 0xff
+        if '\x01' in self.local[first:last + 1]:
+            return None
+        return 'device'
+
+    def checkpoint(self):
+        return bytearray(self.local), bytearray(self.data)
+
+    def restore(self, snapshot):
+        self.local, self.data = map(bytearray, snapshot)
+
+
+def test_local_memory(cases = 20, ops = 2000, seed = 4, window = 0x2000):
+    rng = random.Random(seed)
+    formats = { 1: '<B', 2: '<H', 4: '<I' }
+    checked = 0
+    for case in range(cases):
+        initial = ''.join(chr(rng.getrandbits(8)) for n in range(window + 0x10))
+        d = ImageDevice()
+        d.write(device_ram, initial)
+        m = SimARMMemory(d)
+        model = LocalMemoryModel(device_ram, initial)
+        loads = { 1: m.load_byte, 2: m.load_half, 4: m.load }
+        stores = { 1: m.store_byte, 2: m.store_half, 4: m.store }
+        checkpoints = []
+        for n in range(ops):
+            kind = rng.random()
+            size = rng.choice((1, 2, 4))
+            address = device_ram + (rng.randrange(window) & -size)
+            where = 'case %d op %d at %08x' % (case, n, address)
+            if kind < 0.03:
+                end = min(address + rng.choice((0, 1, 5, 100, 255, 256, 600)), device_ram + window - 1)
+                m.local_ram(address, end)
+                model.local_ram(address, end)
+            elif kind < 0.35:
+                value = rng.getrandbits(8 * size)
+                stores[size](address, value)
+                model.write(address, struct.pack(formats[size], value))
+            elif kind < 0.6:
+                expected = struct.unpack(formats[size], model.read(address, size))[0]
+                assert loads[size](address) == expected, 'Load differs, ' + where
+            elif kind < 0.7:
+                count = rng.randrange(1, 0x300)
+                expected = model.read(address, count) if model.is_local(address, count) else None
+                assert m.read_local(address, count) == expected, 'read_local differs, ' + where
+            elif kind < 0.8:
+                s = ''.join(chr(rng.getrandbits(8)) for i in range(rng.randrange(1, 0x300)))
+                written = model.is_local(address, len(s))
+                assert m.write_local(address, s) == written, 'write_local differs, ' + where
+                if written:
+                    model.write(address, s)
+            elif kind < 0.85:
+                limit = rng.choice((4, 8, 0x100, 0x400))
+                assert m.local_data_available(address, limit) == model.available(address, limit), (
+                    'local_data_available differs, ' + where)
+            elif kind < 0.9:
+                count = rng.randrange(1, 0x300)
+                store = rng.random() < 0.5
+                assert m.region_kind(address, count, store) == model.region_kind(address, count, store), (
+                    'region_kind differs, ' + where)
+            elif kind < 0.95:
+                checkpoints.append((m.checkpoint(), model.checkpoint()))
+            elif checkpoints:
+                snapshot, model_snapshot = rng.choice(checkpoints)
+                m.flush()
+                m.restore(snapshot)
+                model.restore(model_snapshot)
+            checked += 1
+        m.flush()
+        assert d.read(device_ram, window) == str(model.device[:window]), 'Device memory differs in case %d' % case
+    print 'Local memory: %d operations match a flat model' % checked
+
+
+def random_snapshot_state(rng, arm, address, size):
+    """Scribble on the registers and on local memory in a range"""
+    m = arm.memory
+    for r in range(16):
+        if rng.random() < 0.5:
+            arm.regs[r] = random_value(rng)
+    arm.cpsr = (rng.getrandbits(4) << 28) | (rng.getrandbits(1) << 5)
+    arm.step_count += rng.randrange(1000)
+    for n in range(rng.randrange(30)):
+        a = address + rng.randrange(size - 0x400)
+        kind = rng.random()
+        if kind < 0.1:
+            m.local_ram(a, a + rng.choice((0, 3, 100, 255, 256, 600)))
+        elif kind < 0.2:
+            m.write_local(a & ~0xff, '\x00' * 0x100)
+        else:
+            m.write_local(a, ''.join(chr(rng.getrandbits(8)) for i in range(rng.randrange(1, 64))))
+
+
+def local_bytes(m, address, size):
+    """Every byte of local memory in a range, with None where it isn't local"""
+    return [ m.read_local(a, 1) for a in xrange(address, address + size) ]
+
+
+def test_snapshots(rounds = 40, seed = 5, size = 0x2000):
+    rng = random.Random(seed)
+    tmp = tempfile.mkdtemp()
+    try:
+        arm = SimARM(SimARMMemory(ImageDevice()))
+        arm.memory.local_ram(ram + 0x10, ram + 0x7ff)
+        saved = []
+        for n in range(rounds):
+            random_snapshot_state(rng, arm, ram, size)
+            filebase = os.path.join(tmp, 'state%d' % n)
+            parent = None
+            if saved and rng.random() < 0.7:
+                parent = rng.choice(saved)[0]
+            arm.save_state(filebase, parent)
+            saved.append((filebase, parent, arm.state, local_bytes(arm.memory, ram, size)))
+            if rng.random() < 0.3:
+                # Carry on from the snapshot, with its pages loaded as they're touched
+                arm = SimARM(SimARMMemory(ImageDevice()))
+                arm.load_state(filebase)
+
+        for filebase, parent, state, memory in saved:
+            arm = SimARM(SimARMMemory(ImageDevice()))
+            arm.load_state(filebase)
+            name = '%s (parent %s)' % (os.path.basename(filebase), parent and os.path.basename(parent))
+            assert arm.state == state, 'Core state differs after loading ' + name
+            assert local_bytes(arm.memory, ram, size) == memory, 'Local memory differs after loading ' + name
+    finally:
+        shutil.rmtree(tmp)
+    print 'Snapshots: %d saves load back the same, %d of them deltas' % (
+        rounds, len([ s for s in saved if s[1] ]))
+
+
+def run_events(code, regs, steps, chunks, seed):
+    """Run with events and interrupts scheduled from 'seed' and from a hook,
+    returning every one that fired.
+    """
+    d = ImageDevice()
+    d.write_flash(0x18, arm_code(
+        0xe2877001,         # add r7, r7, #1
+        0xe25ef004))        # subs pc, lr, #4
+    arm = new_simulator(code, regs, d)
+    rng = random.Random(seed)
+    fired = []
+
+    def once(due):
+        def fn(arm):
+            fired.append(('once', due, arm.step_count, arm.regs[15]))
+        return fn
+
+    def chain(arm):
+        fired.append(('chain', None, arm.step_count, arm.regs[15]))
+        if len(fired) < 200:
+            arm.events.after(1 + arm.step_count % 53, Event(chain))
+
+    def periodic(arm):
+        fired.append(('periodic', None, arm.step_count, arm.regs[15]))
+
+    # A hook keeps one event of its own in the queue
+    hooked = []
+    def hook(arm):
+        if not hooked:
+            due = arm.step_count + 1 + arm.step_count % 41
+            hooked.append(arm.events.schedule(due, Event(hook_event(due))))
+    def hook_event(due):
+        def fn(arm):
+            fired.append(('hooked', due, arm.step_count, arm.regs[15]))
+            del hooked[:]
+        return fn
+    arm.memory.hook(0x2000 + 2 * rng.randrange(len(code)), hook)
+
+    for n in range(rng.randrange(10)):
+        due = rng.randrange(steps)
+        event = arm.events.schedule(due, Event(once(due)))
+        if rng.random() < 0.2:
+            arm.events.cancel(event)
+    arm.events.after(rng.randrange(100), Event(chain))
+    arm.events.every(rng.randrange(1, 300), Event(periodic))
+    if rng.random() < 0.5:
+        arm.events.every(rng.randrange(20, 500), Interrupt(0x18, ram + 0xd000))
+
+    error = None
+    try:
+        while arm.step_count < steps:
+            arm.step(min(chunks(), steps - arm.step_count))
+        arm.memory.flush()
+    except Exception as e:
+        error = type(e).__name__
+    return error, fired, arm.capture(), arm.step_count
+
+
+def test_events(cases = 100, seed = 6):
+    rng = random.Random(seed)
+    mismatches = fired = 0
+    for case in range(cases):
+        code = random_code(rng)
+        regs = random_registers(rng)
+        steps = rng.choice((200, 1000, 3000))
+        chunk_rng = random.Random(case)
+        stepped = run_events(code, regs, steps, lambda: 1, case)
+        fired += len(stepped[1])
+        late = [ e for e in stepped[1] if e[1] is not None and e[1] != e[2] ]
+        assert not late, 'Events fired at the wrong step: %r' % late[:3]
+        for run in (run_events(code, regs, steps, lambda: steps, case),
+                    run_events(code, regs, steps, lambda: chunk_rng.choice((3, 64, 100, 1000)), case)):
+            if run != stepped:
+                mismatches += 1
+                print 'Event mismatch in case %d: stepped %r %r, bulk %r %r' % (
+                    case, stepped[0], stepped[2], run[0], run[2])
+                print '  first events stepped %r' % stepped[1][:4]
+                print '  first events bulk    %r' % run[1][:4]
+    assert mismatches == 0, '%d of %d runs fired events differently' % (mismatches, cases * 2)
+    print 'Events: %d fired on time, the same in every step size' % fired
+
+
+def test_decoded_operands(words = 50000, seed = 1):
+    rng = random.Random(seed)
+    mismatches = 0
+    for thumb in (True, False):
+        for n in range(words):
+            data = struct.pack('<I', rng.getrandbits(32))
+            for instr in decode_lines(data, rng.randrange(0x200000) & ~3, thumb):
+                parsed = parse_operands(instr.args)
+                if parsed != instr.operands:
+                    mismatches += 1
+                    print 'Operand mismatch: %s %s' % (instr.op, instr.args)
+                    print '  decoded %r' % (instr.operands,)
+                    print '  parsed  %r' % (parsed,)
+    assert mismatches == 0, '%d decoded instructions disagree with their text' % mismatches
+    print 'Decoded operands: %d words match their text' % (words * 2)
+
+
+def test_objdump(image = None, size = 0x10000, seed = 1):
+    if image:
+        data = open(image, 'rb').read()
+    else:
+        rng = random.Random(seed)
+        data = ''.join(chr(rng.getrandbits(8)) for n in range(size))
+    mismatches = 0
+    for thumb in (True, False):
+        try:
+            text = disassemble_string(data, 0, thumb)
+        except OSError:
+            print 'Objdump: skipped, no %s' % OBJDUMP
+            return
+        expected = [(i.address, i.op, i.args, i.comment) for i in disassembly_lines(text)]
+        decoded = [(i.address, i.op, i.args, i.comment) for i in decode_lines(data, 0, thumb)]
+        for a, b in zip(expected, decoded):
+            if a != b:
+                mismatches += 1
+                if mismatches <= 20:
+                    print 'Objdump mismatch at %08x:' % a[0]
+                    print '  objdump %s\t%s\t; %s' % a[1:]
+                    print '  decoded %s\t%s\t; %s' % b[1:]
+        assert len(expected) == len(decoded), 'Objdump gave %d instructions, decoder gave %d' % (
+            len(expected), len(decoded))
+    assert mismatches == 0, '%d instructions decoded differently from objdump' % mismatches
+    print 'Objdump: %d bytes decode the same' % len(data)
+
+
+if __name__ == '__main__':
+    test_loop_idioms()
+    test_simulate_call()
+    test_hook_events()
+    test_blocks()
+    test_lazy_flags()
+    test_store_buffer()
+    test_local_memory()
+    test_snapshots()
+    test_events()
+    test_decoded_operands()
+    test_objdump(*sys.argv[1:2])
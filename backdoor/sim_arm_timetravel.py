@@ -0,0 +1,196 @@
+# Time travel for the ARM simulator.
+#
+# Every 'interval' steps we take an in-memory checkpoint: CPU state, the
+# event queue, and a copy-on-write snapshot of local memory from
+# SimARMMemory.checkpoint().
+# In between, the results of everything we ask the device are kept in a log.
+#
+# Going back to step N means restoring the last checkpoint at or before N,
+# and running forward again. While we're behind the furthest step we've
+# reached for real (the 'frontier'), the device isn't touched at all: reads
+# come from the log, and writes are dropped since the hardware already has
+# them. Once we catch up to the frontier, we're back on the real device.
+#
+# Anything a hook function keeps outside the simulator isn't rewound.
+#
+# Loop idioms and idle loop fast-forward are turned off. How much they do at
+# once depends on how the steps are split up, and a replay has to ask the
+# device for exactly what the first run did.
+
+__all__ = [ 'TimeTravel' ]
+
+import bisect
+
+# Device methods that only change hardware state. Everything else is a read,
+# and has its result logged. Note that blx() counts as a read.
+write_methods = frozenset(['poke', 'poke_byte', 'fill_words', 'fill_bytes', 'write_block'])
+
+
+class IOLog(object):
+    """Device proxy that logs the result of every read"""
+
+    def __init__(self, device):
+        self.device = device
+        self.results = []
+
+    def __getattr__(self, name):
+        attr = getattr(self.device, name)
+        if name in write_methods or not callable(attr):
+            return attr
+        results = self.results
+
+        def fn(*args, **kw):
+            result = attr(*args, **kw)
+            results.append((name, args, result))
+            return result
+        return fn
+
+
+class IOReplay(object):
+    """Device stand-in that answers reads from an IOLog, starting at 'position'"""
+
+    def __init__(self, log, position):
+        self.log = log
+        self.position = position
+
+    def __getattr__(self, name):
+        attr = getattr(self.log.device, name)
+        if name in write_methods:
+            return lambda *args, **kw: None
+        if not callable(attr):
+            return attr
+
+        def fn(*args, **kw):
+            results = self.log.results
+            if self.position >= len(results):
+                raise IOError("Time travel replay ran out of logged I/O at %s%r" % (name, args))
+            r_name, r_args, result = results[self.position]
+            if r_name != name or r_args != args:
+                raise IOError("Time travel replay diverged: expected %s%r, got %s%r" % (
+                    r_name, r_args, name, args))
+            self.position += 1
+            return result
+        return fn
+
+
+class Checkpoint(object):
+    def __init__(self, arm, log_position):
+        self.step_count = arm.step_count
+        self.core = arm.capture()
+        self.events = arm.events.copy()
+        self.memory = arm.memory.checkpoint()
+        self.log_position = log_position
+
+
+class TimeTravel(object):
+    """Checkpointing wrapper for a SimARM. Step forward with step() rather
+    than arm.step(), and go backwards with goto(), reverse_step() and
+    reverse_continue().
+    """
+
+    def __init__(self, arm, interval = 10000):
+        self.arm = arm
+        self.interval = interval
+        self.log = IOLog(arm.memory.device)
+        arm.memory.device = self.log
+        arm.recognize_loops = False
+        arm.memory.blocks.clear()
+        self.checkpoints = []
+        self.frontier = arm.step_count
+        self._checkpoint()
+
+    def __repr__(self):
+        return '<TimeTravel at step %d, frontier %d, %d checkpoints, %d logged reads>' % (
+            self.arm.step_count, self.frontier, len(self.checkpoints), len(self.log.results))
+
+    @property
+    def replaying(self):
+        return self.arm.step_count < self.frontier
+
+    def _checkpoint(self):
+        self.checkpoints.append(Checkpoint(self.arm, len(self.log.results)))
+
+    def _restore(self, cp):
+        arm = self.arm
+        if not self.replaying:
+            # Finish any stores that are only buffered, so the hardware is
+            # consistent with the frontier before we leave it.
+            arm.memory.flush()
+        arm.memory.restore(cp.memory)
+        arm.restore(cp.core)
+        arm.events = cp.events.copy(arm)
+        if self.replaying:
+            arm.memory.device = IOReplay(self.log, cp.log_position)
+        else:
+            arm.memory.device = self.log
+
+    def _catch_up(self):
+        # Done replaying? Back to the real device.
+        arm = self.arm
+        if arm.step_count >= self.frontier:
+            if arm.memory.device is not self.log:
+                replay = arm.memory.device
+                if replay.position != len(self.log.results):
+                    raise IOError("Time travel replay reached the frontier with %d reads left over" % (
+                        len(self.log.results) - replay.position))
+                arm.memory.device = self.log
+                # Those stores were made for real the first time around
+                arm.memory.write_buffer.flush()
+            self.frontier = arm.step_count
+
+        if arm.step_count >= self.checkpoints[-1].step_count + self.interval:
+            self._checkpoint()
+
+    def step(self, repeat = 1, breakpoint = None):
+        """Step forward, like SimARM.step(). Stops at checkpoint intervals internally."""
+        arm = self.arm
+        while repeat > 0:
+            count = min(repeat, self.checkpoints[-1].step_count + self.interval - arm.step_count)
+            if self.replaying:
+                count = min(count, self.frontier - arm.step_count)
+            count = max(1, count)
+
+            before = arm.step_count
+            arm.step(count, breakpoint)
+            repeat -= max(1, arm.step_count - before)
+            self._catch_up()
+            if arm.regs[15] == breakpoint or arm.memory.watch_hits or arm.breakpoint_hit:
+                return
+
+    def goto(self, step):
+        """Go to the end of a particular step, forwards or backwards"""
+        arm = self.arm
+        if step < arm.step_count:
+            steps = [ cp.step_count for cp in self.checkpoints ]
+            i = max(0, bisect.bisect_right(steps, step) - 1)
+            self._restore(self.checkpoints[i])
+        if step > arm.step_count:
+            self.step(step - arm.step_count)
+
+    def reverse_step(self, count = 1):
+        self.goto(max(self.checkpoints[0].step_count, self.arm.step_count - count))
+
+    def reverse_continue(self, breakpoint):
+        """Go back to the most recent step that ended with the PC at 'breakpoint'.
+        Returns False and stays put if there's no such step since the first checkpoint.
+        """
+        arm = self.arm
+        end = arm.step_count
+        bounds = [ cp.step_count for cp in self.checkpoints ] + [ end ]
+
+        # Search backwards one checkpoint interval at a time
+        for i in range(len(self.checkpoints) - 1, -1, -1):
+            if bounds[i] >= end:
+                continue
+            self._restore(self.checkpoints[i])
+            found = None
+            while arm.step_count < min(bounds[i + 1], end):
+                self.step(min(bounds[i + 1], end) - arm.step_count, breakpoint)
+                if arm.regs[15] == breakpoint and arm.step_count < end:
+                    found = arm.step_count
+            if found is not None:
+                self.goto(found)
+                return True
+
+        self.goto(end)
+        return False
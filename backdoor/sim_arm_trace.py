@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+#
+# Compact binary execution traces for the ARM simulator.
+#
+# Writing a line of text for every step and every memory access is most of
+# what a long %sim run spends its time on. A TraceWriter records the same
+# information as fixed-size 16-byte records instead, and a background thread
+# does the file I/O. The text is only produced when someone asks for it:
+#
+#   ./sim_arm_trace.py trace.bin                  Everything, as trace.log text
+#   ./sim_arm_trace.py trace.bin -s 1000 -e 2000  Just some of the steps
+#
+# Record types, all 16 bytes:
+#
+#   STEP    flags (thumb, nzcv), next pc, step count. Ends a step.
+#   REGS    up to two (register, value) pairs that changed during the step
+#   INSN    first time we see an instruction: address, thumb, and a payload
+#           with its note, op, and args. Keeps the trace self-contained.
+#   LOAD, STORE, FILL, PREFETCH
+#           memory accesses that go past local memory, as in SimARMMemory.log_*
+#   TEXT    anything else the log would have had, HLE output for example
+#
+# Everything up to and including a STEP record belongs to that step.
+# Records with a payload store its length in the header, followed by the
+# payload itself, zero-padded out to a multiple of 16 bytes.
+
+__all__ = [ 'TraceWriter', 'TraceReader' ]
+
+import struct, threading, Queue, sys, argparse
+
+trace_magic = 'SimARM trace v1\n'
+
+STEP, REGS, INSN, LOAD, STORE, FILL, PREFETCH, TEXT = range(1, 9)
+
+step_record = struct.Struct('<BBHIQ')       # type, flags, 0, pc, step_count
+data_record = struct.Struct('<BBHIII')      # type, a, b, x, y, z
+record_size = 16
+
+size_names = { 1: 'byte', 2: 'half', 4: 'word' }
+size_bytes = { 'byte': 1, 'half': 2, 'word': 4 }
+
+
+def padded(payload):
+    return payload + '\0' * (-len(payload) % record_size)
+
+
+class TraceWriter(object):
+    """Writes a binary trace. Hand it to SimARMMemory as 'trace', and call
+    step(arm) after each step. Records are batched, and a background thread
+    writes the batches out.
+    """
+    batch_size = 4096
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'wb')
+        self.file.write(trace_magic)
+        self.batch = []
+        self.regs = [None] * 16
+        self.known_instructions = set()
+        self.queue = Queue.Queue(maxsize = 64)
+        self.thread = threading.Thread(target = self._writer)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __repr__(self):
+        return '<TraceWriter %s>' % self.filename
+
+    def _writer(self):
+        while True:
+            chunk = self.queue.get()
+            if chunk is not None:
+                self.file.write(chunk)
+            self.queue.task_done()
+            if chunk is None:
+                return
+
+    def _append(self, record):
+        batch = self.batch
+        batch.append(record)
+        if len(batch) >= self.batch_size:
+            self.queue.put(''.join(batch))
+            del batch[:]
+
+    def _append_payload(self, rtype, a, x, y, z, payload):
+        self._append(data_record.pack(rtype, a, len(payload), x, y, z) + padded(payload))
+
+    def step(self, arm):
+        """Record the state after a step, like the '# ...' lines in trace.log"""
+        instr = arm.get_next_instruction()
+        key = instr.address | arm.thumb
+        if key not in self.known_instructions:
+            self.known_instructions.add(key)
+            self._append_payload(INSN, arm.thumb, instr.address, 0, 0, '\0'.join((
+                arm.memory.note(instr.address), instr.op, instr.args)))
+
+        regs = arm.regs
+        last = self.regs
+        changed = [ i for i in range(16) if regs[i] != last[i] ]
+        for j in range(0, len(changed), 2):
+            a = changed[j]
+            if j + 1 < len(changed):
+                b = changed[j + 1]
+                self._append(data_record.pack(REGS, a, b, regs[a], regs[b], 0))
+            else:
+                self._append(data_record.pack(REGS, a, 0xffff, regs[a], 0, 0))
+        last[:] = regs
+
+        n, z, c, v = arm.nzcv
+        flags = arm.thumb | (n and 2) | (z and 4) | (c and 8) | (v and 16)
+        self._append(step_record.pack(STEP, flags, 0, instr.address, arm.step_count))
+
+    def load(self, address, data, size):
+        self._append(data_record.pack(LOAD, size_bytes[size], 0, address, data, 0))
+
+    def store(self, address, data, size, message=''):
+        self._append_payload(STORE, size_bytes[size], address, data, 0, message)
+
+    def fill(self, address, pattern, count, size):
+        self._append(data_record.pack(FILL, size_bytes[size], 0, address, pattern, count))
+
+    def prefetch(self, address):
+        self._append(data_record.pack(PREFETCH, 0, 0, address, 0, 0))
+
+    def write(self, text):
+        """Text for the log; lets a TraceWriter stand in for a log file"""
+        while text:
+            chunk, text = text[:0xffff], text[0xffff:]
+            self._append_payload(TEXT, 0, 0, 0, 0, chunk)
+
+    def flush(self):
+        if self.batch:
+            self.queue.put(''.join(self.batch))
+            del self.batch[:]
+        # Wait for the writer to catch up, so the file can be read
+        self.queue.join()
+        self.file.flush()
+
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+        self.file.close()
+
+
+class TraceReader(object):
+    """Reads a binary trace written by TraceWriter"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'rb')
+        if self.file.read(len(trace_magic)) != trace_magic:
+            raise IOError("%s is not a SimARM trace" % filename)
+
+    def __iter__(self):
+        """Iterate over records as tuples: (type, fields...)
+        STEP:  (STEP, step_count, pc, flags)
+        REGS:  (REGS, reg, value)                 one per register
+        INSN:  (INSN, address, thumb, note, op, args)
+        LOAD:  (LOAD, address, data, size)
+        STORE: (STORE, address, data, size, message)
+        FILL:  (FILL, address, pattern, count, size)
+        PREFETCH: (PREFETCH, address)
+        TEXT:  (TEXT, text)
+        """
+        f = self.file
+        f.seek(len(trace_magic))
+        while True:
+            record = f.read(record_size)
+            if len(record) < record_size:
+                return
+            rtype = ord(record[0])
+
+            if rtype == STEP:
+                _, flags, _, pc, step_count = step_record.unpack(record)
+                yield (STEP, step_count, pc, flags)
+                continue
+
+            rtype, a, b, x, y, z = data_record.unpack(record)
+            if rtype == REGS:
+                yield (REGS, a, x)
+                if b != 0xffff:
+                    yield (REGS, b, y)
+            elif rtype == LOAD:
+                yield (LOAD, x, y, size_names[a])
+            elif rtype == FILL:
+                yield (FILL, x, y, z, size_names[a])
+            elif rtype == PREFETCH:
+                yield (PREFETCH, x)
+            else:
+                payload = f.read(b + (-b % record_size))[:b]
+                if rtype == INSN:
+                    note, op, args = payload.split('\0')
+                    yield (INSN, x, a, note, op, args)
+                elif rtype == STORE:
+                    yield (STORE, x, y, size_names[a], payload)
+                elif rtype == TEXT:
+                    yield (TEXT, payload)
+                else:
+                    raise IOError("Unknown record type %d in %s" % (rtype, self.filename))
+
+    def render(self, first_step = 0, last_step = None):
+        """Iterate over text for the log, in the same format %sim writes to trace.log.
+        Optionally only steps from first_step to last_step, inclusive.
+        """
+        reg_names = ('r0', 'r1', 'r2', 'r3', 'r4', 'r5', 'r6', 'r7',
+                     'r8', 'r9', 'r10', 'r11', 'r12', 'sp', 'lr', 'pc')
+        regs = [0] * 16
+        instructions = {}
+        pending = []
+
+        for record in self:
+            rtype = record[0]
+
+            if rtype == REGS:
+                regs[record[1]] = record[2]
+            elif rtype == INSN:
+                instructions[record[1] | record[2]] = record[3:]
+            elif rtype != STEP:
+                pending.append(record)
+            else:
+                _, step_count, pc, flags = record
+                if last_step is not None and step_count > last_step:
+                    return
+                if step_count >= first_step:
+                    for r in pending:
+                        for line in render_record(r):
+                            yield line
+                    note, op, args = instructions.get(pc | (flags & 1), ('', '?', ''))
+                    summary = "%s %s >%08x %5s %-8s %s" % (
+                        str(step_count).rjust(12, '.'),
+                        ''.join(('-N'[flags >> 1 & 1], '-Z'[flags >> 2 & 1], '-C'[flags >> 3 & 1],
+                                 '-V'[flags >> 4 & 1], '-T'[flags & 1])),
+                        pc, note, op, args)
+                    yield '# %-70s %s\n' % (summary, ' '.join(
+                        '%s=%08x' % (reg_names[i], regs[i]) for i in range(15)))
+                del pending[:]
+
+        # A step that was still in progress
+        for r in pending:
+            for line in render_record(r):
+                yield line
+
+
+def render_record(record):
+    """Text for one memory access or TEXT record, as SimARMMemory's logs would have it"""
+    rtype = record[0]
+    if rtype == TEXT:
+        yield record[1]
+    elif rtype == LOAD:
+        _, address, data, size = record
+        yield "arm-mem-LOAD  %4s[%08x] -> %08x\n" % (size, address, data)
+    elif rtype == PREFETCH:
+        yield "arm-prefetch [%08x]\n" % record[1]
+    elif rtype == STORE:
+        _, address, data, size, message = record
+        yield "arm-mem-STORE %4s[%08x] <- %08x %s\n" % (size, address, data, message)
+        for line in replayable_write(address, data, size):
+            yield line
+    elif rtype == FILL:
+        _, address, pattern, count, size = record
+        yield "arm-mem-FILL  %4s[%08x] <- %08x * %04x\n" % (size, address, pattern, count)
+        for i in range(count):
+            for line in replayable_write(address + i * size_bytes[size], pattern, size):
+                yield line
+
+
+def replayable_write(address, data, size):
+    if size == 'word':
+        yield "%%wr %x %x\n" % (address, data)
+    elif size == 'byte':
+        yield "%%wrb %x %x\n" % (address, data)
+    elif size == 'half':
+        yield "%%wrb %x %x\n" % (address, data & 0xff)
+        yield "%%wrb %x %x\n" % (address + 1, data >> 8)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Render a binary SimARM trace as text')
+    parser.add_argument('trace', help = 'Trace file written by %%sim --trace')
+    parser.add_argument('-s', '--start', type = int, default = 0, help = 'First step to show')
+    parser.add_argument('-e', '--end', type = int, help = 'Last step to show')
+    args = parser.parse_args()
+
+    try:
+        for line in TraceReader(args.trace).render(args.start, args.end):
+            sys.stdout.write(line)
+    except IOError:
+        # Closed pipe, probably 'head' or 'less'
+        pass
@@ -0,0 +1,143 @@
+# Memory watchpoints for the ARM simulator.
+#
+# A Watchpoint covers an inclusive address range, and fires on reads ('r'),
+# writes ('w'), or writes that change the value we last saw there ('c').
+# The WatchpointIndex keeps a list of watchpoints per 256-byte bucket, so
+# checking an access is a single dict lookup unless it's near a watchpoint.
+#
+# SimARMMemory only routes loads and stores through the index while at least
+# one watchpoint is set, so there's no cost at all otherwise. When a
+# watchpoint fires, SimARM.step() stops after the instruction that made the
+# access. See SimARMMemory.watch().
+
+__all__ = [ 'Watchpoint', 'WatchpointIndex', 'WatchpointHit', 'parse_watch_spec' ]
+
+bucket_shift = 8
+
+
+class Watchpoint(object):
+    """Watch addresses 'begin' through 'end', inclusive.
+    'kind' is any combination of 'r', 'w', and 'c'.
+    """
+    def __init__(self, begin, end = None, kind = 'w'):
+        if end is None:
+            end = begin
+        if not kind or kind.strip('rwc'):
+            raise ValueError("Watchpoint kind should be made of 'r', 'w', and 'c', not %r" % kind)
+        self.begin = begin
+        self.end = end
+        self.kind = kind
+        self.hits = 0
+
+        # Last known byte values, for 'c'
+        self.known = {}
+
+    def __repr__(self):
+        if self.begin == self.end:
+            where = '%08x' % self.begin
+        else:
+            where = '%08x-%08x' % (self.begin, self.end)
+        return '<Watchpoint %s %s, %d hits>' % (self.kind, where, self.hits)
+
+    def overlaps(self, address, size):
+        return address <= self.end and address + size > self.begin
+
+    def observe(self, address, data, size):
+        """Remember the bytes in an access. Returns True if any of them changed."""
+        changed = False
+        known = self.known
+        for i in range(size):
+            a = address + i
+            if self.begin <= a <= self.end:
+                b = (data >> (8 * i)) & 0xff
+                if known.get(a) != b:
+                    known[a] = b
+                    changed = True
+        return changed
+
+
+class WatchpointHit(object):
+    """One access that set off a watchpoint"""
+    def __init__(self, watchpoint, kind, address, data, size):
+        self.watchpoint = watchpoint
+        self.kind = kind
+        self.address = address
+        self.data = data
+        self.size = size
+
+    def __repr__(self):
+        arrow = { 'r': '->', 'w': '<-', 'c': '<-' }[self.kind]
+        size = { 1: 'byte', 2: 'half', 4: 'word' }[self.size]
+        return '<%s %s[%08x] %s %08x, %r>' % (
+            self.kind, size, self.address, arrow, self.data, self.watchpoint)
+
+
+class WatchpointIndex(object):
+    """Bucketed lookup from addresses to the watchpoints covering them"""
+
+    def __init__(self):
+        self.watchpoints = []
+        self.buckets = {}
+
+    def __len__(self):
+        return len(self.watchpoints)
+
+    def __iter__(self):
+        return iter(self.watchpoints)
+
+    def add(self, wp):
+        self.watchpoints.append(wp)
+        for b in range(wp.begin >> bucket_shift, (wp.end >> bucket_shift) + 1):
+            self.buckets.setdefault(b, []).append(wp)
+        return wp
+
+    def remove(self, wp):
+        self.watchpoints.remove(wp)
+        for b in range(wp.begin >> bucket_shift, (wp.end >> bucket_shift) + 1):
+            bucket = self.buckets[b]
+            bucket.remove(wp)
+            if not bucket:
+                del self.buckets[b]
+
+    def check(self, address, size, data, is_store, hits):
+        """Look at one access, appending a WatchpointHit to 'hits' for each one it sets off"""
+        first = address >> bucket_shift
+        last = (address + size - 1) >> bucket_shift
+        bucket = self.buckets.get(first)
+        if last != first:
+            # Unaligned access across buckets
+            other = self.buckets.get(last)
+            if other:
+                bucket = (bucket or []) + [ wp for wp in other if wp not in (bucket or ()) ]
+        if not bucket:
+            return
+        for wp in bucket:
+            if not wp.overlaps(address, size):
+                continue
+            if is_store:
+                changed = 'c' in wp.kind and wp.observe(address, data, size)
+                if 'w' in wp.kind:
+                    kind = 'w'
+                elif changed:
+                    kind = 'c'
+                else:
+                    continue
+            else:
+                if 'c' in wp.kind:
+                    wp.observe(address, data, size)
+                if 'r' not in wp.kind:
+                    continue
+                kind = 'r'
+            wp.hits += 1
+            hits.append(WatchpointHit(wp, kind, address, data, size))
+
+
+def parse_watch_spec(spec, parse_int = lambda s: int(s, 16)):
+    """Parse '[KIND:]BEGIN[-END]' into a Watchpoint. KIND defaults to 'w'."""
+    kind = 'w'
+    if ':' in spec:
+        kind, spec = spec.split(':', 1)
+    if '-' in spec:
+        begin, end = spec.split('-', 1)
+        return Watchpoint(parse_int(begin), parse_int(end), kind)
+    return Watchpoint(parse_int(spec), kind = kind)
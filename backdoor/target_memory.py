@@ -26,6 +26,11 @@ hook_code  = 0x1e44000
 bitbang_backdoor = 0x1e48000
 cpu8051_backdoor = 0x1e49000
 
+# Stack for code that ImageDevice.blx() runs in the simulator. Grows down
+# from the bounce buffer.
+
+sim_blx_stack = 0x1e4f000
+
 # Bounce buffer for getting data to/from other CPUs via the ARM
 
 bounce_buffer      = 0x1e4f000